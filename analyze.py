@@ -6,43 +6,53 @@
 # MIT License
 
 import njelib
-import sys
+import argparse
+
+def show(record):
+    fields = record.to_dict()
+    for i in sorted(fields):
+        print('record['+i+'] : %r' % fields[i])
+
+parser = argparse.ArgumentParser(description='Offline analysis of raw NJE data and pcap/pcapng captures')
+parser.add_argument('files', nargs='+', help='raw NJE data or capture files')
+parser.add_argument('-j', '--workers', type=int, default=1,
+                    help='decode on this many processes, 0 for one per core (default: 1)')
+args = parser.parse_args()
 
 nje = njelib.NJE()
-nje.set_debuglevel(1)
 nje.set_offline()
-nje.analyze(sys.argv[1])
+if args.workers == 1 and len(args.files) == 1:
+    nje.set_debuglevel(1)
+    nje.analyze(args.files[0])
+else:
+    nje.analyze_files(args.files, args.workers or None)
 
-print "=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-"
-print '[+] Analysis Complete\n'
+print("=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-")
+print('[+] Analysis Complete\n')
 
 if len(nje.getNMR()) > 0:
-    print "[+] NMR Records"
+    print("[+] NMR Records")
 
 for record in nje.getNMR():
-    print "==================="
+    print("===================")
     if 'NMRUSER' in record:
-        print "[+] User Message"
-        print "[+] To User:", record['NMRUSER']
-        print "[+] Message:", record['NMRMSG']
-
-    for i in sorted(record):
-        print 'record['+i+'] : %r' % record[i]
+        print("[+] User Message")
+        print("[+] To User:", record['NMRUSER'].decode('latin-1'))
+        print("[+] Message:", record['NMRMSG'].decode('latin-1'))
+    show(record)
 
 if len(nje.getSYSIN()) > 0:
-    print "[+] SYSIN Records"
+    print("[+] SYSIN Records")
 
 for record in nje.getSYSIN():
-    for i in sorted(record):
-        print 'record['+i+'] : %r' % record[i]
+    show(record)
     if 'Record' in record:
-        print record['Record']
+        print(record['Record'].decode('latin-1'))
 
 if len(nje.getSYSOUT()) > 0:
-    print "[+] SYSOUT Records\n"
+    print("[+] SYSOUT Records\n")
 for record in nje.getSYSOUT():
-    print "==================="
-    for i in sorted(record):
-        print 'record['+i+'] : %r' % record[i]
+    print("===================")
+    show(record)
     if 'Record' in record:
-        print record['Record']
+        print(record['Record'].decode('latin-1'))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# Parses a synthetic stream of data set headers (NDH) with the old
+# slice-and-unpack parser and with the precompiled struct layouts in
+# njerecords, reading the fields a SYSOUT writer needs from each one.
+#
+# Usage: python bench/bench_headers.py [count]
+
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import njelib
+import njerecords
+
+def e(text, length=8):
+	return text.ljust(length)[:length].encode('cp500')
+
+def dataset_header(dsno):
+	""" Builds a data set header with a general and a security section """
+	general = (struct.pack('>HBB', 116, 0, 0) + e('NEWYORK') + e('') + e('PROC') +
+		e('STEP%d' % (dsno % 10)) + e('SYSPRINT') + struct.pack('>H', dsno) + b"\x00" +
+		e('A', 1) + struct.pack('>i', 1000 + dsno) + b"\x84\x02" + struct.pack('>H', 133) +
+		b"\x01\x00\x3C\x00" + e('STD') + e('') + e('') + e('') + e('JOBNAME') +
+		b"\x80\x40\x00\x00" + e('LINE') + struct.pack('>i', 0))
+	security = (struct.pack('>HBBhBB', 88, 0x8C, 0, 4, 0, 0x80) + b"\x50\x01\x80\x07\x08\x03\x00\x00" +
+		e('') + e('NEWYORK') + e('IBMUSER') + e('NEWYORK') + e('SYS1') + e('INTRDR') + e('') +
+		e('IBMUSER') + e('SYS1'))
+	body = general + security
+	return struct.pack('>HBB', len(body) + 4, 0, 0) + body
+
+def legacy_dataset_headers(nje, d):
+	# dataset_headers() as it was before the struct layouts
+	EbcdicToAscii = lambda s: (bytes((s,)) if type(s) == int else s).decode('cp500').encode('latin-1')
+	get_bit = nje.get_bit
+	job = {
+		'NDHLEN' : struct.unpack(">H",d[0:2])[0],
+		'NDHFLAGS': d[2:3],
+		'NDHSEQ': d[3:4]
+		}
+	d = d[4:]
+	header = d[2:3]
+	length = struct.unpack(">H",d[0:2])[0]
+	job.update( {
+	'NDHGLEN'  : length,
+	'NDHGTYPE' : header,
+	'NDHGMOD'  : ord(d[3:4]),
+	'NDHGNODE' : EbcdicToAscii(d[4:12]),
+	'NDHGRMT'  : EbcdicToAscii(d[12:20]),
+	'NDHGPROC' : EbcdicToAscii(d[20:28]),
+	'NDHGSTEP' : EbcdicToAscii(d[28:36]),
+	'NDHGDD'   : EbcdicToAscii(d[36:44]),
+	'NDHGDSNO' : struct.unpack(">H",d[44:46])[0],
+	'NDHGCLAS' : EbcdicToAscii(d[47]),
+	'NDHGNREC' : struct.unpack(">i",d[48:52])[0],
+	'NDHGFLG1' : ord(d[52:53]),
+	'NDHGF1SP' : get_bit(ord(d[52:53]),7),
+	'NDHGF1HD' : get_bit(ord(d[52:53]),6),
+	'NDHGF1LG' : get_bit(ord(d[52:53]),5),
+	'NDHGF1OV' : get_bit(ord(d[52:53]),4),
+	'NDHGF1IN' : get_bit(ord(d[52:53]),3),
+	'NDHGF1LC' : get_bit(ord(d[52:53]),2),
+	'NDHGF1ST' : get_bit(ord(d[52:53]),1),
+	'NDHGF1DF' : get_bit(ord(d[52:53]),0),
+	'NDHGRCFM' : ord(d[53:54]),
+	'NDHGLREC' : struct.unpack(">H",d[54:56])[0],
+	'NDHGDSCT' : ord(d[56:57]),
+	'NDHGFCBI' : ord(d[57:58]),
+	'NDHGLNCT' : ord(d[58:59]),
+	'NDHGFORM' : EbcdicToAscii(d[60:68]),
+	'NDHGFCB'  : EbcdicToAscii(d[68:76]),
+	'NDHGUCS'  : EbcdicToAscii(d[76:84]),
+	'NDHGXWTR' : EbcdicToAscii(d[84:92]),
+	'NDHGNAME' : EbcdicToAscii(d[92:100]),
+	'NDHGFLG2' : ord(d[100:101]),
+	'NDHGF2PR' : get_bit(ord(d[100:101]),7),
+	'NDHGF2PU' : get_bit(ord(d[100:101]),6),
+	'NDHGF2NM' : get_bit(ord(d[100:101]),5),
+	'NDHGF2HB' : get_bit(ord(d[100:101]),4),
+	'NDHGF2HA' : get_bit(ord(d[100:101]),3),
+	'NDHGUCSO' : ord(d[101:102]),
+	'NDHGUCSD' : get_bit(ord(d[101:102]),7),
+	'NDHGUCSF' : get_bit(ord(d[101:102]),6),
+	'NDHGPMDE' : EbcdicToAscii(d[104:112]),
+	'NDHGSEGN' : struct.unpack(">i",d[112:116])[0]
+	} )
+	d = d[length:]
+	while len(d) > 1:
+		header = d[2:3]
+		if header == b"\x8C":
+			job.update( {
+				'NDHTLEN'  : struct.unpack(">H",d[0:2])[0],
+				'NDHTTYPE' : header,
+				'NDHTMOD'  : d[3:4],
+				'NDHTLENP' : struct.unpack(">h",d[4:6])[0],
+				'NDHTFLG0' : ord(d[6:7]),
+				'NDHTF0JB' : get_bit(ord(d[7:8]),7)
+				} )
+			d = d[8:]
+			job.update( {
+				'NDHTLENT' : ord(d[0:1]),
+				'NDHTVERS' : ord(d[1:2]),
+				'NDHTFLG1' : ord(d[2:3]),
+				'NDHT1EN'  : get_bit(ord(d[2:3]),7),
+				'NDHT1EXT' : get_bit(ord(d[2:3]),6),
+				'NDHTSTYP' : ord(d[3:4]),
+				'NDHTFLG2' : ord(d[4:5]),
+				'NDHT2DFT' : get_bit(ord(d[4:5]),7),
+				'NDHT2MLO' : get_bit(ord(d[4:5]),5),
+				'NDHT2SHI' : get_bit(ord(d[4:5]),4),
+				'NDHT2TRS' : get_bit(ord(d[4:5]),3),
+				'NDHT2SUS' : get_bit(ord(d[4:5]),2),
+				'NDHT2RMT' : get_bit(ord(d[4:5]),1),
+				'NDHTPOEX' : ord(d[5:6]),
+				'RESERVED' : d[6:8],
+				'NDHTSECL' : EbcdicToAscii(d[8:16]),
+				'NDHTCNOD' : EbcdicToAscii(d[16:24]),
+				'NDHTSUSR' : EbcdicToAscii(d[24:32]),
+				'NDHTSNOD' : EbcdicToAscii(d[32:40]),
+				'NDHTSGRP' : EbcdicToAscii(d[40:48]),
+				'NDHTPOEN' : EbcdicToAscii(d[48:56]),
+				'RESERVED' : EbcdicToAscii(d[56:64]),
+				'NDHTOUSR' : EbcdicToAscii(d[64:72]),
+				'NDHTOGRP' : EbcdicToAscii(d[72:80]),
+			} )
+			d = d[job['NDHTLEN'] - 8:]
+		else:
+			break
+	return job
+
+FIELDS = ('NDHGSTEP', 'NDHGDD', 'NDHGDSNO', 'NDHGLREC', 'NDHGF1SP')
+
+def run(name, parse, stream):
+	start = time.perf_counter()
+	for d in stream:
+		header = parse(d)
+		for field in FIELDS:
+			header[field]
+	elapsed = time.perf_counter() - start
+	print("%-28s %8.2f s  %10.0f headers/s" % (name, elapsed, len(stream) / elapsed))
+
+def main():
+	count = int(sys.argv[1]) if sys.argv[1:] else 1000000
+	nje = njelib.NJE()
+	nje.set_offline()
+	distinct = [dataset_header(i) for i in range(1000)]
+	stream = [distinct[i % 1000] for i in range(count)]
+
+	# Both parsers have to agree before timing them
+	new = njerecords.DatasetHeader(distinct[7])
+	old = legacy_dataset_headers(nje, distinct[7])
+	if dict(new) != old:
+		print("[!] Parsers disagree: %r" % [k for k in old if new.get(k) != old[k]])
+		sys.exit(1)
+
+	print("%d data set headers" % count)
+	run("before (slice and unpack)", lambda d: legacy_dataset_headers(nje, d), stream)
+	run("after (struct layouts)", nje.dataset_headers, stream)
+	run("after, every field", lambda d: njerecords.DatasetHeader(d).to_dict(), stream)
+
+if __name__ == '__main__':
+	main()
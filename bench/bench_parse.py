@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# Parses a 1 MB SYSOUT transmission (133 byte ASA print lines, packed in
+# 32K transmission blocks the way a mainframe sends them) with the old
+# slice-and-dict processData() and with parse_records(), which walks the
+# blocks with a memoryview and hands out payload views, on its own and
+# through NJEParser fed in TCP sized pieces.
+#
+# Pass a file with a raw transmission (e.g. extracted from a capture) to
+# parse that instead of the synthetic one.
+#
+# Usage: python bench/bench_parse.py [megabytes | capture file]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import njelib
+from bench_scb import sysout_corpus
+
+def transmission(size):
+	""" About size bytes of SYSOUT records as sent on the wire. Print lines
+		compress about 4:1 so four times as much output goes in. """
+	corpus = sysout_corpus(size * 4)
+	records = [{'RCB': b"\x99", 'SRCB': b"\xA0", 'Data': bytes((134,)) + b"\xF1" + corpus[i:i + 133]}
+		for i in range(0, len(corpus), 133)]
+	nje = njelib.NJE()
+	nje.FCS = b"\x8F\xCF"
+	blocks = []
+	nje.sendData = blocks.append
+	nje.sendNJE_multiple(records)
+	return b''.join(blocks)
+
+def legacy_processData(nje, data):
+	# processData() as it was before parse_records()
+	received_data = []
+	d = data
+	while len(d) > 0:
+		i = 1
+		data = d
+		total_length = nje.readTTB(data) - 12
+		data = data[8:-4]
+		while i <= total_length:
+			record_length = nje.readTTR(data)
+			current_record = data[4:4 + record_length]
+			if record_length == 6:
+				received_data.append({'RCB': b"\x00", 'SRCB': b"\x00", 'Data': b"\x00"})
+			elif record_length > 2:
+				current_record = current_record[5:]
+				while len(current_record) > 1:
+					packet_dict = {
+						'RCB' : njelib.my_to_bytes(current_record[0]),
+						'SRCB' : njelib.my_to_bytes(current_record[1])
+						}
+					current_record = current_record[2:]
+					if nje.compressed(packet_dict['RCB']):
+						data = nje.readSCB(current_record)
+						packet_dict['Data'] = data[0]
+						current_record = current_record[data[1]:]
+					else:
+						packet_dict['Data'] = current_record
+						current_record = current_record[record_length:]
+					received_data.append(packet_dict)
+			else:
+				received_data.append({'Data': current_record})
+			data += data[4 + record_length:]
+			i += record_length + 4
+			i += 1
+		d = d[total_length+12:]
+	return received_data
+
+def feed(data, size):
+	""" Feeds data to an NJEParser the way TCP hands it over """
+	parser = njelib.NJEParser()
+	records = []
+	for pos in range(0, len(data), size):
+		records += parser.feed(data[pos:pos + size])
+	return records
+
+def run(name, parse, data, nje):
+	start = time.perf_counter()
+	records = parse(data)
+	took = time.perf_counter() - start
+	mb = len(data) / 1048576.0
+	print("%-34s %8.3f s  %8.2f MB/s  %8d records/s" % (name, took, mb / took, len(records) / took))
+	return records
+
+def main():
+	if sys.argv[1:] and os.path.isfile(sys.argv[1]):
+		with open(sys.argv[1], 'rb') as capture:
+			data = capture.read()
+	else:
+		size = int(float(sys.argv[1]) * 1048576) if sys.argv[1:] else 1048576
+		data = transmission(size)
+	nje = njelib.NJE()
+	nje.set_offline()
+	print("%d bytes in the transmission" % len(data))
+	old = run("before (processData, dicts)", lambda d: legacy_processData(nje, d), data, nje)
+	views = run("after (parse_records, views)", lambda d: list(njelib.parse_records(d)), data, nje)
+	kept = run("after, keeping every payload", lambda d: [(r, s, bytes(p)) for r, s, p in njelib.parse_records(d)], data, nje)
+	run("NJEParser.feed(), 1460 byte reads", lambda d: feed(d, 1460), data, nje)
+	if [r['Data'] for r in old] != [p for r, s, p in kept]:
+		print("[!] Parsers don't agree")
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Round trip benchmark for SCB compression.
+#
+# Builds multi-MB SYSIN (80 byte JCL cards) and SYSOUT (133 byte print
+# lines) corpora in EBCDIC, compresses them with scb_segments() and
+# decompresses every segment with NJE.readSCB() and all of them at once
+# with scb_decode_records(), checking the result.
+#
+# Usage: python bench/bench_scb.py [megabytes]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import njelib
+
+def sysin_corpus(size):
+	random.seed(175)
+	cards = [
+		"//STEP%02d   EXEC PGM=IEBGENER",
+		"//SYSUT1   DD DSN=PROD.PAYROLL.DATA%02d,DISP=SHR",
+		"//SYSUT2   DD SYSOUT=*                  STEP %02d",
+		"//SYSPRINT DD SYSOUT=*,DCB=BLKSIZE=%02d33",
+		"//* COMMENT %02d",
+		"  TIME %02d",
+	]
+	lines = []
+	total = 0
+	while total < size:
+		line = random.choice(cards) % random.randint(0, 99)
+		lines.append(line.ljust(80))
+		total += 80
+	return "".join(lines).encode('cp500')[:size]
+
+def sysout_corpus(size):
+	random.seed(2252)
+	lines = []
+	total = 0
+	while total < size:
+		kind = random.randint(0, 3)
+		if kind == 0:
+			line = " " * 133
+		elif kind == 1:
+			line = "-" * 133
+		else:
+			line = ("%8d  PAYROLL1  %-20s %12.2f" % (total, "EMPLOYEE" + str(total % 977), total / 7.0)).ljust(133)
+		lines.append(line)
+		total += 133
+	return "".join(lines).encode('cp500')[:size]
+
+def roundtrip(nje, name, data):
+	start = time.perf_counter()
+	segments = list(njelib.scb_segments(data, b"\x99\x80"))
+	compressed = time.perf_counter() - start
+
+	start = time.perf_counter()
+	out = []
+	for segment in segments:
+		out.append(nje.readSCB(segment[2:])[0])
+	decompressed = time.perf_counter() - start
+
+	# Every segment decoded in one call into a preallocated buffer
+	block = b''.join(segments) + b"\x00"
+	buf = bytearray(len(data))
+	start = time.perf_counter()
+	records, pos = njelib.scb_decode_records(block, memoryview(buf))
+	bulk = time.perf_counter() - start
+
+	if b''.join(out) != data or buf != data or len(records) != len(segments):
+		print("[!] %s did not survive the round trip" % name)
+		sys.exit(1)
+	mb = len(data) / 1048576.0
+	ratio = sum(len(s) for s in segments) / float(len(data))
+	print("%-8s %6.1f MB  %6d segments  ratio %.2f  makeSCB %7.2f MB/s  readSCB %7.2f MB/s  scb_decode_records %7.2f MB/s" %
+		(name, mb, len(segments), ratio, mb / compressed, mb / decompressed, mb / bulk))
+
+def main():
+	size = int(float(sys.argv[1]) * 1048576) if sys.argv[1:] else 4 * 1048576
+	nje = njelib.NJE()
+	nje.set_offline()
+	roundtrip(nje, "SYSIN", sysin_corpus(size))
+	roundtrip(nje, "SYSOUT", sysout_corpus(size))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# End to end timings against the loopback NJE node in njeserver.py, which
+# runs in this process unless --host is given:
+#
+#	handshake    connect, OPEN/ACK, SOH ENQ, I/J/L signon and signoff
+#	reset        the same with a J record event number of 0, which makes
+#	             the signon I/J/K/L (in-process server only)
+#	command      an operator command and its multi-line $HASP reply
+#	jobs         JCL submitted over parallel SYSIN streams until the SYSOUT
+#	             of every job is back (jobs/s, SYSOUT records/s and MB/s)
+#
+# Usage: python bench/bench_server.py [-n rounds] [-j jobs] [-l lines]
+#                                     [--host host -p port --node node]
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import njelib
+import njerecords
+import njeserver
+
+JCL = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'JCL', 'nop.jcl')
+
+def summary(name, times):
+	""" One line with the min, median, 95th percentile and max of times, in ms """
+	times = sorted(t * 1000 for t in times)
+	median = times[len(times) // 2]
+	p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+	print("%-10s %6d %10.3f %10.3f %10.3f %10.3f" % (name, len(times), times[0], median, p95, times[-1]))
+
+def connect(host, port, node):
+	nje = njelib.NJE('WASHDC', node)
+	if not nje.session(host, port):
+		sys.exit("[!] Couldn't sign on to %s at %s:%s" % (node, host, port))
+	return nje
+
+def handshake(host, port, node, rounds):
+	times = []
+	for i in range(rounds):
+		start = time.perf_counter()
+		nje = connect(host, port, node)
+		times.append(time.perf_counter() - start)
+		nje.signoff()
+	return times
+
+def command(host, port, node, rounds, text):
+	nje = connect(host, port, node)
+	times = []
+	for i in range(rounds):
+		nje.replies = []
+		start = time.perf_counter()
+		nje.sendNMR(text, True)
+		while not nje.replies:
+			if not nje.receive():
+				sys.exit("[!] No reply to %s" % text)
+		times.append(time.perf_counter() - start)
+	nje.replies = None
+	nje.signoff()
+	return times
+
+def jobs(host, port, node, count):
+	""" Returns (seconds, SYSOUT records, SYSOUT bytes) for count jobs """
+	nje = connect(host, port, node)
+	start = time.perf_counter()
+	handles = [nje.enqueue(JCL) for i in range(count)]
+	while nje.sock and not all(job.done for job in handles):
+		if not nje.receive():
+			break
+	elapsed = time.perf_counter() - start
+	records = size = 0
+	for job in handles:
+		if not job.future.done() or job.future.exception() is not None:
+			sys.exit("[!] %r didn't finish" % job)
+		for record in job.pending:
+			records += 1
+			if isinstance(record, njerecords.DataRecord):
+				size += len(record.raw)
+	nje.signoff()
+	return elapsed, records, size
+
+def main():
+	parser = argparse.ArgumentParser(description='End to end timings against a loopback NJE node')
+	parser.add_argument('-n', '--rounds', type=int, default=50, help='handshakes and commands to time (default: 50)')
+	parser.add_argument('-j', '--jobs', type=int, default=100, help='jobs to send (default: 100)')
+	parser.add_argument('-l', '--lines', type=int, default=njeserver.SYSOUT_LINES,
+		help='print lines in every job\'s output (default: %d)' % njeserver.SYSOUT_LINES)
+	parser.add_argument('-c', '--command', default='$D NJEDEF', help='command to time (default: $D NJEDEF)')
+	parser.add_argument('--host', help='time an NJE node already running there instead')
+	parser.add_argument('-p', '--port', type=int, default=njelib.NJE_PORT, help='port of --host (default: 175)')
+	parser.add_argument('--node', default='NEWYORK', help='node name of --host (default: NEWYORK)')
+	args = parser.parse_args()
+
+	njelib.set_tracing(0)
+	servers = []
+	if args.host:
+		host, port = args.host, args.port
+	else:
+		servers = [njeserver.NJEServer(args.node, sysout_lines=args.lines, signon_event=event).start() for event in (1, 0)]
+		host, port = servers[0].address
+	print("[+] %s at %s:%d" % (args.node, host, port))
+
+	print("\n%-10s %6s %10s %10s %10s %10s" % ("ms", "count", "min", "median", "p95", "max"))
+	summary('handshake', handshake(host, port, args.node, args.rounds))
+	if servers:
+		summary('reset', handshake(servers[1].address[0], servers[1].address[1], args.node, args.rounds))
+	summary('command', command(host, port, args.node, args.rounds, args.command))
+
+	elapsed, records, size = jobs(host, port, args.node, args.jobs)
+	print("\n%d jobs in %.3f s: %.1f jobs/s, %d SYSOUT records (%.0f/s), %.2f MB of print lines (%.2f MB/s)" % (
+		args.jobs, elapsed, args.jobs / elapsed, records, records / elapsed, size / 1048576.0, size / 1048576.0 / elapsed))
+
+	for server in servers:
+		server.close()
+
+if __name__ == '__main__':
+	main()
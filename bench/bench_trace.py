@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# Measures what debug tracing costs when it is turned off.
+#
+# Compares a disabled trace call against the old NJE.msg() behaviour
+# (stack walk plus eager hex dump on every call) and times the hot
+# decoding paths with tracing off.
+#
+# Usage: python bench/bench_trace.py [iterations]
+
+import inspect
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import njelib
+
+def old_msg(nje, msg, *args):
+	# What NJE.msg() used to do for every call, even with debugging off
+	curframe = inspect.currentframe()
+	calframe = inspect.getouterframes(curframe, 2)
+	caller = calframe[1][3]
+	if nje.debuglevel > 0:
+		print(caller, msg, args)
+
+def main():
+	iterations = int(sys.argv[1]) if sys.argv[1:] else 100000
+	nje = njelib.NJE('WASHDC', 'NEWYORK')
+	nje.set_offline()
+	njelib.set_tracing(0)
+
+	record = nje.AsciiToEbcdic("//H4CKRNJE JOB (1234567),'ABC 123',CLASS=A," + " " * 30)
+	compressed = nje.makeSCB(record)[0]
+
+	tests = [
+		("old msg() with eager phex", lambda: old_msg(nje, "Compressed Record: {0}".format(nje.phex(compressed)))),
+		("disabled trace with LazyHex", lambda: nje.records_log.debug("Compressed Record: %s", njelib.LazyHex(compressed))),
+		("readSCB", lambda: nje.readSCB(compressed)),
+		("makeSCB", lambda: nje.makeSCB(record)),
+	]
+	print("%-32s %12s" % ("test", "usec/call"))
+	for name, func in tests:
+		elapsed = timeit.timeit(func, number=iterations)
+		print("%-32s %12.3f" % (name, elapsed / iterations * 1e6))
+
+if __name__ == '__main__':
+	main()
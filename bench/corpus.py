@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# Deterministic synthetic NJE corpus for the benchmarks.
+#
+# Everything comes from a seeded random.Random, so the same size and seed
+# always give the same bytes and timings can be compared between runs and
+# between versions of the library:
+#
+#	JCL decks          80 byte cards, job header, data records and trailer
+#	SYSOUT             133 byte print lines with long runs of blank lines,
+#	                   rules and banners of repeated characters, report lines
+#	$HASP replies      multi-line operator command replies as NMRs
+#
+# Usage: python bench/corpus.py [megabytes] [seed]   (prints a summary)
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import njelib
+from bench_headers import dataset_header
+
+SEED = 175
+JOBNAMES = ('PAYROLL1', 'GLPOST', 'ARAGING', 'BKUPDAY', 'IEFBR14', 'DB2REORG', 'CICSLOG', 'SMFDUMP')
+PROGRAMS = ('IEBGENER', 'IDCAMS', 'IEFBR14', 'SORT', 'IKJEFT01', 'DSNUTILB', 'ADRDSSU')
+
+def jcl_deck(rnd, number):
+	""" One job's JCL as a list of 80 column cards """
+	name = rnd.choice(JOBNAMES)
+	cards = ["//%-8s JOB (ACCT%04d),'BATCH %d',CLASS=A,MSGCLASS=K" % (name, rnd.randint(0, 9999), number),
+		"//*  GENERATED DECK %d" % number]
+	for step in range(rnd.randint(1, 6)):
+		cards.append("//STEP%02d   EXEC PGM=%s" % (step, rnd.choice(PROGRAMS)))
+		for dd in range(rnd.randint(1, 4)):
+			cards.append("//DD%02d     DD DSN=PROD.%s.D%05d,DISP=SHR" % (dd, name, rnd.randint(0, 99999)))
+		cards.append("//SYSPRINT DD SYSOUT=*")
+		if rnd.random() < 0.3:
+			cards.append("//SYSIN    DD *")
+			cards += ["  SORT FIELDS=(%d,%d,CH,A)" % (rnd.randint(1, 60), rnd.randint(1, 20)) for i in range(rnd.randint(1, 5))]
+			cards.append("/*")
+	return name, [card.ljust(80)[:80] for card in cards]
+
+def sysout_lines(rnd, size):
+	""" About size bytes of 133 column print lines, ASA carriage control in
+		the first column """
+	lines = []
+	total = 0
+	page = 0
+	while total < size:
+		kind = rnd.random()
+		if kind < 0.25:
+			# Runs of blank lines, the best case for SCB compression
+			block = [" " * 133] * rnd.randint(5, 60)
+		elif kind < 0.35:
+			page += 1
+			block = ["1" + ("*" * 40 + "  PAGE %5d  " % page + "*" * 40).ljust(132),
+				"0" + "-" * 132, " " + ("=" * rnd.randint(20, 132)).ljust(132)]
+		else:
+			block = [(" %8d  %-8s  %-24s %12.2f %12.2f" % (total, rnd.choice(JOBNAMES), "ACCOUNT%06d" % rnd.randint(0, 999999),
+				rnd.random() * 1e6, rnd.random() * 1e4)).ljust(133) for i in range(rnd.randint(1, 30))]
+		lines += block
+		total += 133 * len(block)
+	return lines
+
+def hasp_reply(rnd, number):
+	""" The lines of a multi-line reply to a $D command """
+	name = rnd.choice(JOBNAMES)
+	lines = ["$HASP890 JOB(%s)  %s" % (name, rnd.choice(("STATUS=(AWAITING HARDCOPY)", "STATUS=(EXECUTING/SY1)", "STATUS=(AWAITING EXECUTION)")))]
+	lines += ["$HASP890 JOB(%s)  CLASS=A,PRIORITY=%d,SYSAFF=(ANY),HOLD=(NONE)" % (name, rnd.randint(1, 15))]
+	for i in range(rnd.randint(0, 8)):
+		lines.append("$HASP608 JOB%05d %-8s  AWAITING OUTPUT  %d LINES" % (number, name, rnd.randint(1, 100000)))
+	lines.append("$HASP646 %d.%04d PERCENT SPOOL UTILIZATION" % (rnd.randint(0, 99), rnd.randint(0, 9999)))
+	return lines
+
+class Corpus:
+	""" Synthetic NJE data of about size bytes of each kind, in every form
+		the benchmarks need: text, EBCDIC records, record payloads as they
+		come off the wire and whole transmission blocks. """
+	def __init__(self, size=1048576, seed=SEED):
+		rnd = random.Random(seed)
+		self.size = size
+		self.seed = seed
+		self.nje = nje = njelib.NJE('WASHDC', 'NEWYORK')
+		nje.set_offline()
+		nje.FCS = b"\x8F\xCF"
+		nje.target_node = b"\x01" # what signon would have set
+
+		self.jcl = [] # cards of all decks
+		self.job_headers = [] # NJH payloads
+		self.sysin_records = []
+		number = 1
+		total = 0
+		while total < size:
+			name, cards = jcl_deck(rnd, number)
+			header = nje.makeSYSIN_header(len(cards), number, 'BENCH', 'A', 'K', name, '1234', 'IBMUSER', 'SYS1')
+			self.job_headers.append(header)
+			self.sysin_records.append({'RCB': b"\x98", 'SRCB': b"\xC0", 'Data': header})
+			for card in nje.codec.encode_records(cards):
+				self.sysin_records.append({'RCB': b"\x98", 'SRCB': b"\x80", 'Data': b"\x50" + card})
+			self.sysin_records.append({'RCB': b"\x98", 'SRCB': b"\xD0", 'Data': nje.makeSYSIN_footer()})
+			self.jcl += cards
+			total += 80 * len(cards)
+			number += 1
+
+		self.sysout = sysout_lines(rnd, size)
+		self.sysout_ebcdic = nje.codec.encode_records(self.sysout)
+		self.dataset_headers = [dataset_header(dsno) for dsno in range(1, max(2, len(self.sysout) // 20) + 1)]
+		self.sysout_records = [{'RCB': b"\x99", 'SRCB': b"\xC0", 'Data': self.job_headers[0]}]
+		per_dataset = len(self.sysout_ebcdic) // len(self.dataset_headers) + 1
+		for pos, line in enumerate(self.sysout_ebcdic):
+			if pos % per_dataset == 0:
+				self.sysout_records.append({'RCB': b"\x99", 'SRCB': b"\xE0", 'Data': self.dataset_headers[pos // per_dataset]})
+			self.sysout_records.append({'RCB': b"\x99", 'SRCB': b"\xA0", 'Data': bytes((len(line),)) + line})
+		self.sysout_records.append({'RCB': b"\x99", 'SRCB': b"\xD0", 'Data': nje.makeSYSIN_footer()})
+
+		self.hasp = [] # lines of all replies
+		self.nmr = [] # NMR payloads, one per line
+		total = 0
+		while total < size // 8:
+			for line in hasp_reply(rnd, len(self.nmr)):
+				self.hasp.append(line)
+				self.nmr.append(nje.nmr_record(line, False))
+				total += len(self.nmr[-1])
+
+		self.segments = [segment for line in self.sysout_ebcdic for segment in njelib.scb_segments(line)]
+		self.sysin_wire = self.transmission(self.sysin_records)
+		self.sysout_wire = self.transmission(self.sysout_records)
+
+	def transmission(self, records):
+		""" The bytes on the wire (transmission blocks, TTB and all) that
+			carry records """
+		sent = []
+		self.nje.sendData = sent.append
+		self.nje.sendNJE_multiple(records)
+		return b''.join(sent)
+
+	def summary(self):
+		lines = ["seed %d, %d bytes of each kind" % (self.seed, self.size)]
+		lines.append("%6d JCL cards in %d jobs, %d bytes on the wire" % (len(self.jcl), len(self.job_headers), len(self.sysin_wire)))
+		lines.append("%6d SYSOUT lines in %d data sets, %d bytes on the wire" % (len(self.sysout), len(self.dataset_headers),
+			len(self.sysout_wire)))
+		lines.append("%6d $HASP reply lines (NMRs)" % len(self.nmr))
+		return "\n".join(lines)
+
+def main():
+	size = int(float(sys.argv[1]) * 1048576) if sys.argv[1:] else 1048576
+	seed = int(sys.argv[2]) if sys.argv[2:] else SEED
+	print(Corpus(size, seed).summary())
+
+if __name__ == '__main__':
+	main()
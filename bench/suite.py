@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# Microbenchmarks for the protocol hot paths, run over the synthetic corpus
+# in corpus.py: SCB compression and decompression, block parsing, NMR and
+# header decoding and the EBCDIC conversions.
+#
+# For every function it reports throughput (MB/s and records/s, best of
+# --repeat runs) and memory: the peak traced by tracemalloc during one run
+# and what that run left allocated. Results can be saved as a JSON
+# baseline and later runs compared against it; a function that got slower
+# (or needs more memory) by more than --tolerance percent is a regression
+# and makes the exit status 1.
+#
+# Usage: python bench/suite.py [-s megabytes] [-r repeat] [-k name,...]
+#                              [--save baseline.json] [--compare baseline.json]
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import njelib
+from corpus import Corpus, SEED
+
+BASELINE_VERSION = 1
+
+class Case:
+	""" One benchmark: run() goes over the whole input once, which is
+		size bytes in records records """
+	def __init__(self, name, run, size, records):
+		self.name = name
+		self.run = run
+		self.size = size
+		self.records = records
+
+def cases(corpus):
+	nje = corpus.nje
+	codec = nje.codec
+	sysout = corpus.sysout
+	lines = corpus.sysout_ebcdic
+	segments = corpus.segments
+	wires = (corpus.sysin_wire, corpus.sysout_wire)
+	wire_records = sum(len(list(njelib.parse_records(wire))) for wire in wires)
+
+	def makeSCB():
+		for line in lines:
+			nje.makeSCB(line)
+
+	def readSCB():
+		for segment in segments:
+			nje.readSCB(segment)
+
+	def processData():
+		for wire in wires:
+			for record in nje.processData(wire):
+				pass
+
+	def process_nmr():
+		for data in corpus.nmr:
+			nje.process_nmr({'Data': data})['NMRMSG']
+
+	def job_headers():
+		for data in corpus.job_headers:
+			header = nje.job_headers(data)
+			header['NJHGJNAM'], header['NJHGUSID'], header['NJHGORGN']
+
+	def dataset_headers():
+		for data in corpus.dataset_headers:
+			header = nje.dataset_headers(data)
+			header['NDHGSTEP'], header['NDHGDD'], header['NDHGDSNO']
+
+	def AsciiToEbcdic():
+		for line in sysout:
+			nje.AsciiToEbcdic(line)
+
+	def EbcdicToAscii():
+		for line in lines:
+			nje.EbcdicToAscii(line)
+
+	def encode_records():
+		codec.encode_records(sysout)
+
+	def decode_records():
+		codec.decode_records(lines)
+
+	text = sum(len(line) for line in lines)
+	return [
+		Case('makeSCB', makeSCB, text, len(lines)),
+		Case('readSCB', readSCB, text, len(segments)),
+		Case('processData', processData, sum(len(wire) for wire in wires), wire_records),
+		Case('process_nmr', process_nmr, sum(len(data) for data in corpus.nmr), len(corpus.nmr)),
+		Case('job_headers', job_headers, sum(len(data) for data in corpus.job_headers), len(corpus.job_headers)),
+		Case('dataset_headers', dataset_headers, sum(len(data) for data in corpus.dataset_headers), len(corpus.dataset_headers)),
+		Case('AsciiToEbcdic', AsciiToEbcdic, text, len(lines)),
+		Case('EbcdicToAscii', EbcdicToAscii, text, len(lines)),
+		Case('encode_records', encode_records, text, len(lines)),
+		Case('decode_records', decode_records, text, len(lines)),
+	]
+
+def measure(case, repeat):
+	""" Returns the results of one case as a dict """
+	best = None
+	for i in range(repeat):
+		gc.collect()
+		start = time.perf_counter()
+		case.run()
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+
+	gc.collect()
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	case.run()
+	current, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	best = max(best, 1e-9)
+	return {
+		'seconds': best,
+		'bytes': case.size,
+		'records': case.records,
+		'mb_s': case.size / 1048576.0 / best,
+		'records_s': case.records / best,
+		'peak_kb': (peak - before) / 1024.0,
+		'kept_kb': (current - before) / 1024.0,
+	}
+
+def compare(results, baseline, tolerance):
+	""" Prints the change of every case against baseline and returns the
+		names of the ones that regressed """
+	regressed = []
+	print("\n%-16s %12s %12s %8s %10s %10s %8s" % ("vs baseline", "MB/s was", "MB/s now", "change", "peak was", "peak now", "change"))
+	for name, now in results.items():
+		was = baseline['results'].get(name)
+		if was is None:
+			print("%-16s %12s" % (name, "new"))
+			continue
+		speed = (now['mb_s'] / was['mb_s'] - 1) * 100 if was['mb_s'] else 0.0
+		memory = (now['peak_kb'] / was['peak_kb'] - 1) * 100 if was['peak_kb'] > 1 else 0.0
+		flag = ''
+		if speed < -tolerance or memory > tolerance:
+			regressed.append(name)
+			flag = '  REGRESSION'
+		print("%-16s %12.2f %12.2f %+7.1f%% %10.1f %10.1f %+7.1f%%%s" % (name, was['mb_s'], now['mb_s'], speed,
+			was['peak_kb'], now['peak_kb'], memory, flag))
+	return regressed
+
+def main():
+	parser = argparse.ArgumentParser(description='Microbenchmarks for the njelib hot paths')
+	parser.add_argument('-s', '--size', type=float, default=1.0, help='megabytes of each kind of corpus (default: 1)')
+	parser.add_argument('--seed', type=int, default=SEED, help='corpus seed (default: %d)' % SEED)
+	parser.add_argument('-r', '--repeat', type=int, default=5, help='runs per case, the best counts (default: 5)')
+	parser.add_argument('-k', '--only', help='comma separated names of the cases to run')
+	parser.add_argument('--save', metavar='FILE', help='save the results as a JSON baseline')
+	parser.add_argument('--compare', metavar='FILE', help='compare with a JSON baseline')
+	parser.add_argument('--tolerance', type=float, default=10.0, help='percent slower or bigger that counts as a regression (default: 10)')
+	args = parser.parse_args()
+
+	njelib.set_tracing(0)
+	corpus = Corpus(int(args.size * 1048576), args.seed)
+	print(corpus.summary())
+	print("\n%-16s %10s %9s %12s %14s %10s %10s" % ("function", "MB", "MB/s", "records", "records/s", "peak KB", "kept KB"))
+	results = {}
+	only = set(args.only.split(',')) if args.only else None
+	for case in cases(corpus):
+		if only is not None and case.name not in only:
+			continue
+		result = results[case.name] = measure(case, args.repeat)
+		print("%-16s %10.2f %9.2f %12d %14.0f %10.1f %10.1f" % (case.name, case.size / 1048576.0, result['mb_s'],
+			case.records, result['records_s'], result['peak_kb'], result['kept_kb']))
+
+	status = 0
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		if (baseline.get('size'), baseline.get('seed')) != (corpus.size, corpus.seed):
+			print("\n[!] The baseline was made with a different corpus (size %s, seed %s)" % (baseline.get('size'), baseline.get('seed')))
+		regressed = compare(results, baseline, args.tolerance)
+		if regressed:
+			print("\n[!] Regressions: %s" % ', '.join(regressed))
+			status = 1
+	if args.save:
+		with open(args.save, 'w') as f:
+			json.dump({
+				'version': BASELINE_VERSION,
+				'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+				'python': platform.python_version(),
+				'implementation': platform.python_implementation(),
+				'machine': platform.machine(),
+				'size': corpus.size,
+				'seed': corpus.seed,
+				'repeat': args.repeat,
+				'results': results,
+			}, f, indent=1, sort_keys=True)
+		print("\n[+] Baseline saved to %s" % args.save)
+	sys.exit(status)
+
+if __name__ == '__main__':
+	main()
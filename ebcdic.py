@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+## EBCDIC translation tables used by njelib
+#
+# Every conversion is a single bytes.translate() call against tables built
+# once at import time. EBCDIC is translated to and from ISO-8859-1
+# (latin-1) so national characters survive instead of failing an ASCII
+# re-encode. Plain ASCII text is unaffected since it is a subset of latin-1.
+#
+# Supported code pages:
+#   cp037  : USA/Canada
+#   cp500  : International (what the library has always used, aka EBCDIC-CP-BE)
+#   cp1047 : Latin-1/Open Systems (USS, z/OS UNIX)
+#
+#########
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########
+
+DEFAULT_CODEPAGE = 'cp500'
+
+# CP1047 is CP037 with six code points moved around:
+#        037   1047
+#   5F    ¬     ^
+#   AD    Ý     [
+#   B0    ^     ¬
+#   BA    [     Ý
+#   BB    ]     ¨
+#   BD    ¨     ]
+CP1047_FROM_CP037 = {0x5F: 0xB0, 0xAD: 0xBA, 0xB0: 0x5F, 0xBA: 0xAD, 0xBB: 0xBD, 0xBD: 0xBB}
+
+def make_tables(codepage):
+	""" Returns a tuple of (EBCDIC to latin-1, latin-1 to EBCDIC) translate tables """
+	if codepage == 'cp1047':
+		cp037 = make_tables('cp037')[0]
+		to_latin1 = bytes(cp037[CP1047_FROM_CP037.get(i, i)] for i in range(256))
+	else:
+		to_latin1 = bytes(range(256)).decode(codepage).encode('latin-1')
+	to_ebcdic = bytearray(256)
+	for ebcdic_byte, latin1_byte in enumerate(to_latin1):
+		to_ebcdic[latin1_byte] = ebcdic_byte
+	return (to_latin1, bytes(to_ebcdic))
+
+TABLES = dict((codepage, make_tables(codepage)) for codepage in ('cp037', 'cp500', 'cp1047'))
+CODEPAGES = tuple(sorted(TABLES))
+SHARED = {}
+
+def shared(codepage=DEFAULT_CODEPAGE):
+	""" Returns the one Codec for codepage kept by this module. Pickled
+		codecs come back as these, so a pickled record only carries the
+		code page name and not its translate tables. """
+	if codepage not in SHARED:
+		SHARED[codepage] = Codec(codepage)
+	return SHARED[codepage]
+
+class Codec:
+	""" Converts between EBCDIC and latin-1 for one code page. Each NJE
+		session holds one, chosen when the session is created. """
+	def __init__(self, codepage=DEFAULT_CODEPAGE):
+		codepage = codepage.lower().replace('-', '')
+		if codepage == 'ebcdiccpbe':
+			codepage = 'cp500'
+		if codepage not in TABLES:
+			raise ValueError("Unsupported code page {0}. Use one of: {1}".format(codepage, ', '.join(CODEPAGES)))
+		self.codepage = codepage
+		self.to_latin1, self.to_ebcdic = TABLES[codepage]
+
+	def __reduce__(self):
+		return (shared, (self.codepage,))
+
+	def encode(self, s):
+		''' Converts a str or latin-1 bytes to EBCDIC bytes '''
+		if type(s) == str:
+			s = s.encode('latin-1', 'replace')
+		return s.translate(self.to_ebcdic)
+
+	def decode(self, s):
+		''' Converts EBCDIC bytes (or any bytes-like object) to latin-1 bytes '''
+		return bytes(s).translate(self.to_latin1)
+
+	def encode_records(self, records):
+		''' Converts a list of str or bytes records to a list of EBCDIC bytes
+			with a single translate call '''
+		return self.split(self.encode(self.join(records, 'latin-1')), records)
+
+	def decode_records(self, records):
+		''' Converts a list of EBCDIC records to a list of latin-1 bytes
+			with a single translate call '''
+		return self.split(self.decode(self.join(records)), records)
+
+	def join(self, records, encoding=None):
+		if encoding:
+			records = [r.encode(encoding, 'replace') if type(r) == str else r for r in records]
+		return b''.join(records)
+
+	def split(self, block, records):
+		out = []
+		pos = 0
+		for record in records:
+			out.append(block[pos:pos + len(record)])
+			pos += len(record)
+		return out
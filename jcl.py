@@ -70,4 +70,4 @@ print("===================")
 print("[+] Records in SYSOUT:")
 for record in nje.getSYSOUT():
     if 'Record' in record:
-        print(record['Record'].decode('ascii'))
+        print(record['Record'].decode('latin-1'))
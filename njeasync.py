@@ -0,0 +1,404 @@
+#!/usr/bin/python
+
+## asyncio NJE sessions
+#
+# AsyncNJE does what the NJE class does, with every operation that waits
+# on the network turned into a coroutine, so one event loop can keep links
+# to dozens of nodes open without a thread per link:
+#
+#	nje = njeasync.AsyncNJE("WASHDC", "NEWYORK")
+#	if await nje.session("3.1.33.7", 175):
+#		print(await nje.sendCommand("$D NJEDEF", timeout=10))
+#
+# Records are built and parsed by the same code as NJE, only reading and
+# writing the connection is different. Every coroutine takes an optional
+# timeout in seconds (asyncio.TimeoutError when it runs out) and can be
+# cancelled like any other task.
+#
+#########
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########
+
+import asyncio
+
+import njekeepalive
+import njelib
+
+class AsyncNJE(njelib.NJE):
+	""" NJE session driven by asyncio streams """
+	def __init__(self, rhost='', ohost='', host='', port=0, password='', rip='127.0.0.1', codepage=njelib.ebcdic.DEFAULT_CODEPAGE):
+		# Connecting happens in session(), not when the object is made
+		njelib.NJE.__init__(self, rhost, ohost, '', port, password, rip, codepage)
+		self.host = host
+		self.reader = None
+		self.writer = None
+		self.again = False # a record asked for the reply to be read, see receive()
+		self.reading = False # a coroutine is in read()
+		self.poller = None # keepalive task's pending read, see keepalive_loop()
+
+	async def connect(self, host, port=0, timeout=30):
+		"""Connects to an NJE Server. aka a Mainframe!"""
+		self.ssl = False
+		if not port:
+			port = njelib.NJE_PORT
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		context = None
+		if self.cafile is not None:
+			self.msg("Trying SSL Connection")
+			context = self.tls_context()
+		try:
+			self.reader, self.writer = await asyncio.wait_for(
+				asyncio.open_connection(host, port, ssl=context, server_hostname=host if context else None), timeout)
+		except (OSError, asyncio.TimeoutError) as e:
+			self.msg("Connection Failed: %s", e)
+			return False
+		self.ssl = context is not None
+		self.sock = self.writer
+		self.liveness.reset()
+		return True
+
+	def disconnect(self):
+		"""Close the connection."""
+		self.writer = None
+		if self.poller is not None:
+			self.poller.cancel()
+			self.poller = None
+		njelib.NJE.disconnect(self)
+
+	def sendData(self, data):
+		""" Queues raw data for the NJE server, flush() sends it """
+		if not self.writer:
+			return
+		self.wire_log.debug("Sending  >> '%s'", njelib.LazyHex(data))
+		self.writer.write(data)
+		self.liveness.sent()
+
+	async def flush(self):
+		if self.writer:
+			await self.writer.drain()
+
+	async def read(self, timeout=None):
+		""" Reads whatever arrives next into the parser. Returns False if the
+			connection was closed. """
+		self.reading = True
+		try:
+			if self.poller is not None:
+				# The keepalive task is waiting for data, take over from it
+				poller, self.poller = self.poller, None
+				poller.cancel()
+				await asyncio.wait([poller])
+				if not poller.cancelled() and poller.exception() is None:
+					return poller.result()
+			return self.received(await asyncio.wait_for(self.reader.read(njelib.RECV_SIZE), timeout))
+		finally:
+			self.reading = False
+
+	def received(self, chunk):
+		if not chunk:
+			self.wire_log.debug("Connection closed by peer")
+			self.disconnect()
+			return False
+		self.parser.push(chunk)
+		self.liveness.received()
+		return True
+
+	async def poll(self):
+		return self.received(await self.reader.read(njelib.RECV_SIZE))
+
+	async def getControlRecord(self, timeout=None):
+		data = self.parser.take(njelib.CONTROL_LEN)
+		while data is None:
+			if not self.writer or not await self.read(timeout):
+				return b''
+			data = self.parser.take(njelib.CONTROL_LEN)
+		self.wire_log.debug("Recieved << '%s'", njelib.LazyHex(data))
+		return data
+
+	async def getData(self, timeout=None):
+		""" Returns the next complete TTB block(s), see NJE.getData() """
+		blocks = self.parser.blocks()
+		while not blocks:
+			if not self.writer or not await self.read(timeout):
+				return b''
+			blocks = self.parser.blocks()
+		data = b''.join(blocks)
+		self.wire_log.debug("Recieved << '%s'", njelib.LazyHex(data))
+		return data
+
+	def receive(self):
+		# Called by record handlers (e.g. a J record with no event number)
+		# that need the reply to what they sent. That read can't happen in
+		# here, so receive_async() does it once the handler returns.
+		self.again = True
+
+	async def receive_async(self, timeout=None):
+		""" Reads the next block(s) and processes the records. Returns False
+			if nothing arrived within timeout seconds or the link went away. """
+		while True:
+			self.again = False
+			try:
+				data = await self.getData(timeout)
+			except asyncio.TimeoutError:
+				return False
+			if not data:
+				return False
+			self.records = self.processData(data)
+			self.process_RCB()
+			self.pump()
+			await self.flush()
+			if not self.again:
+				return True
+
+	async def linger_async(self, wait=None):
+		""" Processes the blocks that have already arrived, or with wait
+			keeps processing blocks for as long as they arrive within wait
+			seconds of each other """
+		if wait:
+			while await self.receive_async(wait):
+				pass
+			return
+		blocks = self.parser.blocks()
+		if blocks:
+			self.records = self.processData(b''.join(blocks))
+			self.process_RCB()
+			self.pump()
+			await self.flush()
+
+	def start_keepalive(self, interval=njekeepalive.INTERVAL, dead_after=None):
+		""" Starts the keepalive service as a task on the running loop, see
+			NJE.start_keepalive() """
+		self.stop_keepalive()
+		self.liveness.set_interval(interval, dead_after)
+		self.keepalive_service = asyncio.ensure_future(self.keepalive_loop())
+		return self.keepalive_service
+
+	def stop_keepalive(self):
+		task = self.keepalive_service
+		self.keepalive_service = None
+		if task is not None and task is not asyncio.current_task():
+			task.cancel()
+
+	async def keepalive_loop(self):
+		""" While no other coroutine is reading, keeps a read pending and
+			processes what it gets. Sends heartbeats and drops a dead link
+			like NJE.keepalive(). """
+		tick = self.liveness.tick()
+		while self.writer:
+			if self.poller is None and not self.reading:
+				self.poller = asyncio.ensure_future(self.poll())
+			poller = self.poller
+			if poller is not None:
+				await asyncio.wait([poller], timeout=tick)
+			else:
+				await asyncio.sleep(tick)
+			if poller is not None and poller is self.poller and poller.done():
+				self.poller = None
+				if poller.cancelled() or poller.exception() is not None:
+					self.disconnect()
+					return
+				while self.liveness.sent_recently() and self.writer and not self.reading:
+					# Leave the reply to whoever sent something just now
+					await asyncio.sleep(tick)
+				blocks = self.parser.blocks() if self.writer and not self.reading else None
+				if blocks:
+					self.records = self.processData(b''.join(blocks))
+					self.process_RCB()
+					self.pump()
+			if not self.writer:
+				return
+			action = self.liveness.check()
+			if action == njekeepalive.DEAD:
+				self.msg("Nothing from %s for %s seconds, dropping the link", self.host, self.liveness.dead_after)
+				self.disconnect()
+				return
+			if action == njekeepalive.HEARTBEAT:
+				self.handshake_log.debug("Link quiet for %s seconds, sending a heartbeat", self.liveness.interval)
+				self.sendHeartbeat()
+				self.liveness.heartbeat_sent()
+			await self.flush()
+
+	async def initiate(self, timeout=None):
+		""" Implement NJE initialization procedure, see NJE.initiate() """
+		self.msg("Initiating Singon to %s:%s", self.host, self.port)
+		self.sendData(self.open_record(self.writer.get_extra_info('peername')[0]))
+		await self.flush()
+		if not self.check_control(await self.getControlRecord(timeout)):
+			return False
+		self.send_SOHENQ()
+		await self.flush()
+		return self.check_ack(list(self.processData(await self.getData(timeout))))
+
+	async def signon(self, timeout=None):
+		""" Sends the initial signon record and handles the reply """
+		if not self.connected:
+			return False
+		self.send_I_record()
+		await self.flush()
+		await self.receive_async(timeout)
+		return self.check_signon()
+
+	async def session(self, host, port=175, timeout=30, password=''):
+		""" Creates an NJE session by building the connection """
+		if not await self.connect(host, port, timeout):
+			return False
+		if password:
+			self.password = password
+		try:
+			if not await self.initiate(timeout):
+				self.msg("Failed to Initiate Connection")
+				return False
+			if not await self.signon(timeout):
+				self.msg("Failed to Signon")
+				return False
+		except asyncio.TimeoutError:
+			self.msg("Timed out starting the session")
+			self.disconnect()
+			return False
+		return True
+
+	async def signoff(self):
+		""" Sends the signoff record and closes the connection once the
+			other side has read it, see NJE.shutdown() """
+		writer = self.writer
+		if writer is None:
+			self.disconnect()
+			return
+		self.stop_keepalive()
+		if self.poller is not None:
+			self.poller.cancel()
+			await asyncio.wait([self.poller])
+			self.poller = None
+		self.sendData(self.signoff_record())
+		try:
+			await asyncio.wait_for(self.shutdown_async(), self.linger)
+		except (asyncio.TimeoutError, OSError):
+			pass
+		self.disconnect()
+		try:
+			await writer.wait_closed()
+		except OSError:
+			pass
+
+	async def shutdown_async(self):
+		await self.writer.drain()
+		if self.writer.can_write_eof():
+			self.writer.write_eof()
+		while await self.reader.read(njelib.RECV_SIZE):
+			pass
+
+	async def sendCommand(self, command, timeout=None, signoff=True, wait=None):
+		""" uses 'command' to create a node message record (NMR), sends it
+			and returns the reply, see NJE.sendCommand(). Pass signoff=False
+			to keep the session open. """
+		async def run():
+			self.msg("Sending command: %s", command)
+			self.sendNMR(command, True)
+			await self.flush()
+			await self.receive_async()
+			# Multi-line replies can span several blocks
+			await self.linger_async(wait)
+			return self.command_reply(self.replies)
+		self.replies = []
+		try:
+			return await asyncio.wait_for(run(), timeout)
+		finally:
+			self.replies = None
+			if signoff:
+				await self.signoff()
+
+	async def sendMessage(self, message, user='', timeout=None, signoff=True, wait=None):
+		""" Sends message to user (or the console), see NJE.sendMessage() """
+		msg = "Sending Message: " + message
+		if user:
+			msg += " to user " + user.upper()
+		self.msg(msg)
+		return await self.sendMessages([(message, user)], timeout=timeout, signoff=signoff, wait=wait)
+
+	async def sendMessages(self, messages, user='', timeout=None, signoff=True, wait=None):
+		""" Sends many messages at once, see NJE.sendMessages() """
+		records = []
+		for message in messages:
+			to = user
+			if not isinstance(message, str):
+				message, to = message
+			records.append({'RCB': b"\x9A", 'SRCB': b"\x00", 'Data': self.nmr_record(message, False, to)})
+		self.msg("Sending %s messages", len(records))
+		async def run():
+			self.sendNJE_multiple(records)
+			await self.flush()
+			if wait:
+				return await self.wait_replies(wait)
+			return True
+		self.replies = [] if wait else None
+		try:
+			return await asyncio.wait_for(run(), timeout)
+		finally:
+			self.replies = None
+			if signoff:
+				await self.signoff()
+
+	async def wait_replies(self, wait):
+		""" Same as NJE.wait_replies() """
+		loop = asyncio.get_running_loop()
+		deadline = loop.time() + wait
+		while self.writer and not self.replies:
+			remaining = deadline - loop.time()
+			if remaining <= 0:
+				break
+			await self.receive_async(remaining)
+		return self.command_reply(self.replies)
+
+	async def send_queue(self, jobs=None, timeout=None):
+		""" Same as NJE.send_queue(), timeout applies to each read """
+		await self.flush()
+		while self.writer and self.queued(jobs):
+			if not await self.receive_async(timeout):
+				break
+
+	async def submit(self, filename, userid='ibmuser', group='sys1', keep=False, timeout=None, callback=None):
+		""" Sends JCL file as user and returns a Job handle. Use
+			'async for record in job' to read the output as it arrives. """
+		job = self.enqueue(filename, userid, group, keep, timeout, callback)
+		await asyncio.wait_for(self.send_queue([job]), timeout)
+		return job
+
+	async def submit_all(self, filenames, userid='ibmuser', group='sys1', keep=False, timeout=None, callback=None):
+		""" Sends several JCL files back to back, see NJE.submit_all().
+			Returns the list of Job handles. """
+		jobs = [self.enqueue(filename, userid, group, keep, timeout, callback) for filename in filenames]
+		await asyncio.wait_for(self.send_queue(jobs), timeout)
+		return jobs
+
+	async def sendJCL(self, filename, userid='ibmuser', group='sys1', timeout=None, signoff=True):
+		""" sends JCL file as user and waits for the job's output, which
+			ends up in getSYSOUT() """
+		async def run():
+			job = await self.submit(filename, userid, group, keep=True)
+			await job.wait_async()
+			return job
+		try:
+			return await asyncio.wait_for(run(), timeout)
+		finally:
+			if signoff:
+				await self.signoff()
+
+	async def dumbClient(self):
+		""" Connects to an NJE server and does nothing """
+		self.msg("Starting Dumb Client")
+		while self.writer:
+			await self.receive_async()
@@ -0,0 +1,306 @@
+#!/usr/bin/python
+
+## Capture index for njelib
+#
+# Keeps what was decoded from capture files in an SQLite database, so
+# questions like "which captures have job PAYROLL1 from WASHDC" don't mean
+# decoding everything again:
+#
+#	index = njeindex.Index("captures.db")
+#	index.update(glob.glob("/taps/*.pcapng"), workers=8)
+#	for job in index.jobs(name="PAYROLL1", origin="WASHDC"):
+#		print(job['path'], job['jobid'], job['first_time'])
+#		for found in index.records(job):
+#			print(found.record)
+#
+# For every job (job header to job trailer on one stream) it keeps the job
+# name and number, origin and execution node, user, the names of its data
+# sets and where in the capture it starts: the file offset of the packet,
+# the connection and the TCP sequence number of the block. records() seeks
+# there and decodes that one connection until the job trailer. Operator
+# messages are kept whole. update() only decodes captures that are new or
+# changed since they were last indexed.
+#
+#########
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########
+
+import logging
+import os
+import sqlite3
+import time
+
+import ebcdic
+import njeparallel
+import njepcap
+import njerecords
+
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS captures (
+	id INTEGER PRIMARY KEY,
+	path TEXT UNIQUE NOT NULL,
+	size INTEGER NOT NULL,
+	mtime REAL NOT NULL,
+	indexed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+	id INTEGER PRIMARY KEY,
+	capture INTEGER NOT NULL REFERENCES captures(id) ON DELETE CASCADE,
+	rcb INTEGER NOT NULL,
+	name TEXT, jobid INTEGER, origin TEXT, dest TEXT, user TEXT,
+	src TEXT, sport INTEGER, dst TEXT, dport INTEGER,
+	seq INTEGER, first_offset INTEGER, last_offset INTEGER,
+	first_time REAL, last_time REAL,
+	records INTEGER NOT NULL DEFAULT 0,
+	complete INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS datasets (
+	job INTEGER NOT NULL REFERENCES jobs(id) ON DELETE CASCADE,
+	dsno INTEGER, name TEXT, proc TEXT, step TEXT, dd TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+	id INTEGER PRIMARY KEY,
+	capture INTEGER NOT NULL REFERENCES captures(id) ON DELETE CASCADE,
+	time REAL, offset INTEGER,
+	src TEXT, sport INTEGER, dst TEXT, dport INTEGER,
+	from_node TEXT, to_node TEXT, user TEXT, text TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_name ON jobs(name);
+CREATE INDEX IF NOT EXISTS jobs_jobid ON jobs(jobid);
+CREATE INDEX IF NOT EXISTS jobs_origin ON jobs(origin);
+CREATE INDEX IF NOT EXISTS jobs_dest ON jobs(dest);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs(user);
+CREATE INDEX IF NOT EXISTS jobs_capture ON jobs(capture);
+CREATE INDEX IF NOT EXISTS datasets_job ON datasets(job);
+CREATE INDEX IF NOT EXISTS datasets_name ON datasets(name);
+CREATE INDEX IF NOT EXISTS messages_time ON messages(time);
+CREATE INDEX IF NOT EXISTS messages_capture ON messages(capture);
+'''
+
+# Query keywords and the columns they match
+JOB_COLUMNS = {'name': 'jobs.name', 'jobid': 'jobs.jobid', 'origin': 'jobs.origin',
+	'dest': 'jobs.dest', 'user': 'jobs.user', 'path': 'captures.path'}
+MESSAGE_COLUMNS = {'from_node': 'messages.from_node', 'to_node': 'messages.to_node',
+	'user': 'messages.user', 'path': 'captures.path'}
+
+log = logging.getLogger('njelib.index')
+
+def text(value):
+	""" A decoded EBCDIC field as a stripped str, or None """
+	if value is None:
+		return None
+	if isinstance(value, bytes):
+		value = value.decode('latin-1')
+	return value.strip() or None
+
+def continuation(record):
+	""" True for the second and later segments of a header too long for
+		one record. The segment number is in the low bits of the byte
+		after the flags (NJHSEQ, NDHSEQ, NJTSEQ). """
+	return len(record.data) > 3 and record.data[3] & 0x7F != 0
+
+def condition(column, value):
+	""" SQL condition and parameters for column matching value. Values with
+		* or ? in them are glob patterns. """
+	if isinstance(value, str) and ('*' in value or '?' in value):
+		return column + ' GLOB ?', [value]
+	return column + ' = ?', [value]
+
+class Index:
+	""" SQLite index of the jobs and messages in capture files """
+	def __init__(self, path, ports=njepcap.NJE_PORTS, codepage=ebcdic.DEFAULT_CODEPAGE):
+		self.path = path
+		self.ports = ports
+		self.codepage = codepage
+		self.db = sqlite3.connect(path)
+		self.db.row_factory = sqlite3.Row
+		self.db.execute('PRAGMA foreign_keys = ON')
+		version = self.db.execute('PRAGMA user_version').fetchone()[0]
+		if version not in (0, SCHEMA_VERSION):
+			raise ValueError("{0} is an index of version {1}, this is version {2}".format(path, version, SCHEMA_VERSION))
+		self.db.executescript(SCHEMA)
+		self.db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+	def stale(self, paths):
+		""" The captures out of paths that are new or changed since they were
+			indexed """
+		found = []
+		for path in paths:
+			path = os.path.abspath(path)
+			stat = os.stat(path)
+			row = self.db.execute('SELECT size, mtime FROM captures WHERE path = ?', (path,)).fetchone()
+			if row is None or row['size'] != stat.st_size or row['mtime'] != stat.st_mtime:
+				found.append(path)
+		return found
+
+	def update(self, paths, workers=1):
+		""" Indexes the captures out of paths that are new or changed and
+			returns their paths. Changed captures are indexed again from the
+			start. workers is passed on to njeparallel. """
+		if isinstance(paths, str):
+			paths = [paths]
+		paths = self.stale(paths)
+		for path in paths:
+			with open(path, 'rb') as f:
+				if not njepcap.is_capture(f.read(4)):
+					raise ValueError("{0} isn't a pcap or pcapng file".format(path))
+		if not paths:
+			return paths
+		with self.db:
+			ids = {}
+			for path in paths:
+				stat = os.stat(path)
+				self.db.execute('DELETE FROM captures WHERE path = ?', (path,))
+				ids[path] = self.db.execute('INSERT INTO captures (path, size, mtime, indexed) VALUES (?, ?, ?, ?)',
+							(path, stat.st_size, stat.st_mtime, time.time())).lastrowid
+			open_jobs = {} # (path, flow, RCB) -> job row id
+			count = 0
+			for path, found in njeparallel.records(paths, workers, self.ports, self.codepage):
+				self.add(ids[path], (path, found.flow, found.RCB), found, open_jobs)
+				count += 1
+			log.info("Indexed %s records from %s captures", count, len(paths))
+		return paths
+
+	def add(self, capture, key, found, open_jobs):
+		""" Adds one FlowRecord to the index """
+		record = found.record
+		flow = found.flow
+		if found.RCB == 0x9A:
+			self.db.execute('INSERT INTO messages (capture, time, offset, src, sport, dst, dport, '
+					'from_node, to_node, user, text) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+					(capture, found.time, found.offset) + tuple(flow) + (text(record.get('NMRFMNOD')),
+					text(record.get('NMRTONOD')), text(record.get('NMRUSER')), text(record.get('NMRMSG'))))
+			return
+		if isinstance(record, njerecords.JobHeader) and not continuation(record):
+			job = self.db.execute('INSERT INTO jobs (capture, rcb, name, jobid, origin, dest, user, '
+					'src, sport, dst, dport, seq, first_offset, last_offset, first_time, last_time) '
+					'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+					(capture, found.RCB, text(record['NJHGJNAM']), record['NJHGJID'], text(record['NJHGORGN']),
+					text(record['NJHGXEQN']), text(record['NJHGUSID'])) + tuple(flow) +
+					(found.seq, found.offset, found.offset, found.time, found.time)).lastrowid
+			open_jobs[key] = job
+			return
+		job = open_jobs.get(key)
+		if job is None:
+			return
+		if isinstance(record, njerecords.DatasetHeader) and not continuation(record):
+			self.db.execute('INSERT INTO datasets (job, dsno, name, proc, step, dd) VALUES (?, ?, ?, ?, ?, ?)',
+					(job, record['NDHGDSNO'], text(record['NDHGNAME']), text(record['NDHGPROC']),
+					text(record['NDHGSTEP']), text(record['NDHGDD'])))
+		complete = isinstance(record, njerecords.JobTrailer)
+		self.db.execute('UPDATE jobs SET records = records + 1, last_offset = ?, last_time = ?, complete = ? WHERE id = ?',
+				(found.offset, found.time, int(complete), job))
+		if complete:
+			del open_jobs[key]
+
+	def jobs(self, dsname=None, since=None, until=None, **match):
+		""" Returns the jobs matching the keywords (name, jobid, origin, dest,
+			user, path, dsname) whose first record falls between since and
+			until, oldest first. Each is an sqlite3.Row. """
+		where, params = [], []
+		for keyword, value in match.items():
+			if keyword not in JOB_COLUMNS:
+				raise TypeError("Unknown job field " + keyword)
+			if value is not None:
+				sql, values = condition(JOB_COLUMNS[keyword], value)
+				where.append(sql)
+				params += values
+		if dsname is not None:
+			sql, values = condition('datasets.name', dsname)
+			where.append('jobs.id IN (SELECT job FROM datasets WHERE ' + sql + ')')
+			params += values
+		if since is not None:
+			where.append('jobs.first_time >= ?')
+			params.append(since)
+		if until is not None:
+			where.append('jobs.first_time <= ?')
+			params.append(until)
+		query = 'SELECT jobs.*, captures.path FROM jobs JOIN captures ON captures.id = jobs.capture'
+		if where:
+			query += ' WHERE ' + ' AND '.join(where)
+		return self.db.execute(query + ' ORDER BY jobs.first_time, jobs.id', params).fetchall()
+
+	def datasets(self, job):
+		""" The data sets of a job row """
+		return self.db.execute('SELECT * FROM datasets WHERE job = ? ORDER BY dsno', (job['id'],)).fetchall()
+
+	def captures(self, **match):
+		""" Paths of the captures that hold jobs matching the keywords of jobs() """
+		return sorted(set(job['path'] for job in self.jobs(**match)))
+
+	def messages(self, contains=None, since=None, until=None, **match):
+		""" Returns the operator messages matching the keywords (from_node,
+			to_node, user, path) whose text has contains in it, oldest
+			first """
+		where, params = [], []
+		for keyword, value in match.items():
+			if keyword not in MESSAGE_COLUMNS:
+				raise TypeError("Unknown message field " + keyword)
+			if value is not None:
+				sql, values = condition(MESSAGE_COLUMNS[keyword], value)
+				where.append(sql)
+				params += values
+		if contains is not None:
+			where.append("instr(messages.text, ?) > 0")
+			params.append(contains)
+		if since is not None:
+			where.append('messages.time >= ?')
+			params.append(since)
+		if until is not None:
+			where.append('messages.time <= ?')
+			params.append(until)
+		query = 'SELECT messages.*, captures.path FROM messages JOIN captures ON captures.id = messages.capture'
+		if where:
+			query += ' WHERE ' + ' AND '.join(where)
+		return self.db.execute(query + ' ORDER BY messages.time, messages.id', params).fetchall()
+
+	def records(self, job):
+		""" Yields the FlowRecords of a job row, from its job header to its
+			job trailer, reading the capture from where the job starts """
+		flow = njepcap.Flow(job['src'], job['sport'], job['dst'], job['dport'])
+		decoder = njepcap.Decoder(self.codepage)
+		resume = (job['first_offset'], flow, job['seq'])
+		started = False
+		for flow, found_time, offset, seq, RCB, SRCB, data in njepcap.payloads(job['path'], self.ports, resume=resume):
+			if RCB != job['rcb']:
+				continue
+			record = decoder.record(RCB, SRCB, data)
+			if isinstance(record, njerecords.JobHeader) and not continuation(record):
+				if started:
+					return # the next job, this one had no trailer
+				if record['NJHGJID'] != job['jobid']:
+					continue
+				started = True
+			if started:
+				yield njepcap.FlowRecord(flow, found_time, offset, RCB, record, seq)
+				if isinstance(record, njerecords.JobTrailer):
+					return
+
+	def forget(self, path):
+		""" Drops a capture from the index """
+		with self.db:
+			self.db.execute('DELETE FROM captures WHERE path = ?', (os.path.abspath(path),))
+
+	def close(self):
+		self.db.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+## Heartbeats and link liveness used by njelib
+#
+# JES2 drops a link that stays quiet for too long, and a peer that went
+# away is only noticed the next time something is sent. The keepalive
+# service fixes both: while a session is idle it reads and processes
+# whatever arrives (answering the other node's heartbeats), sends a
+# heartbeat of its own once the link has been quiet for interval seconds
+# and drops the link when nothing at all has come in for dead_after
+# seconds. It runs on a thread for NJE sessions and as a task on the event
+# loop for AsyncNJE sessions:
+#
+#	nje.start_keepalive(interval=30)
+#	print(nje.liveness.state(nje.connected))	# 'alive', 'waiting', 'dead' or 'down'
+#
+#########
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########
+
+import threading
+import time
+
+INTERVAL = 30 # Seconds of quiet before we send a heartbeat
+DEAD_FACTOR = 3 # The link is dead after this many intervals without a byte from the peer
+TICK = 1.0 # Longest the service sleeps between checks
+
+# What check() asks for
+HEARTBEAT = 'heartbeat'
+DEAD = 'dead'
+
+# Link states
+ALIVE = 'alive' # the peer sent something recently
+WAITING = 'waiting' # we sent a heartbeat and haven't heard back yet
+DOWN = 'down' # not connected
+
+class Liveness:
+	""" Keeps track of when a link last sent and received data and decides
+		when it needs a heartbeat and when it's dead """
+	def __init__(self, interval=INTERVAL, dead_after=None):
+		self.set_interval(interval, dead_after)
+		self.reset()
+
+	def set_interval(self, interval, dead_after=None):
+		self.interval = interval
+		self.dead_after = dead_after if dead_after is not None else interval * DEAD_FACTOR
+
+	def reset(self):
+		now = time.monotonic()
+		self.last_sent = now
+		self.last_received = now
+		self.heartbeat = None # when our unanswered heartbeat went out
+
+	def sent(self):
+		self.last_sent = time.monotonic()
+
+	def received(self):
+		self.last_received = time.monotonic()
+
+	def heartbeat_sent(self):
+		self.last_sent = self.heartbeat = time.monotonic()
+
+	def answered(self):
+		""" Called for every heartbeat the peer sends. Returns True if it's
+			the answer to ours, False if it wants an answer. """
+		if self.heartbeat is None:
+			return False
+		self.heartbeat = None
+		return True
+
+	def tick(self):
+		""" How often the service should check the link """
+		return min(TICK, self.interval / 4.0)
+
+	def sent_recently(self, now=None):
+		""" True if something went out in the last tick, so its reply may
+			be on the way to whoever sent it """
+		if now is None:
+			now = time.monotonic()
+		return now - self.last_sent < self.tick()
+
+	def quiet(self, now=None):
+		""" Seconds since anything was sent or received """
+		if now is None:
+			now = time.monotonic()
+		return now - max(self.last_sent, self.last_received)
+
+	def check(self, now=None):
+		""" Returns DEAD if the peer has been silent for dead_after seconds,
+			HEARTBEAT if the link has been quiet for interval seconds and
+			None if there's nothing to do """
+		if now is None:
+			now = time.monotonic()
+		if now - self.last_received >= self.dead_after:
+			return DEAD
+		if self.quiet(now) >= self.interval:
+			return HEARTBEAT
+		return None
+
+	def state(self, connected=True, now=None):
+		if not connected:
+			return DOWN
+		if self.check(now) == DEAD:
+			return DEAD
+		if self.heartbeat is not None and self.last_received < self.heartbeat:
+			return WAITING
+		return ALIVE
+
+	def __repr__(self):
+		return 'Liveness(interval={0}, dead_after={1})'.format(self.interval, self.dead_after)
+
+class KeepaliveThread(threading.Thread):
+	""" Runs the keepalive service of an NJE session, see NJE.keepalive() """
+	def __init__(self, nje):
+		threading.Thread.__init__(self, name='njelib-keepalive', daemon=True)
+		self.nje = nje
+		self.stopped = threading.Event()
+
+	def run(self):
+		while not self.stopped.wait(self.nje.liveness.tick()):
+			if not self.nje.sock or not self.nje.keepalive():
+				break
+
+	def stop(self):
+		self.stopped.set()
+		if self.is_alive() and threading.current_thread() is not self:
+			self.join()
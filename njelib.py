@@ -31,24 +31,352 @@
 #########
 
 import socket
-import inspect
+import logging
 import sys
 import ssl
 import re
 import struct
 import time
+import threading
 import traceback
+import collections
+import concurrent.futures
 from select import select
 import binascii
 from binascii import hexlify, unhexlify
 from bitstring import BitStream, BitArray
+import ebcdic
+import njerecords
+import njestore
+import njespool
+import njestreams
+import njekeepalive
+import njepcap
+import njeparallel
 
 DEBUGLEVEL = 0
 NJE_PORT = 175
 SPACE = b'\x40'
-SYSIN = []
-SYSOUT = []
-NMR = []
+RECV_SIZE = 65536 # Size of the reusable socket receive buffer
+LINGER = 0.25 # Seconds signoff() waits for the other side to close the connection
+TTB_LEN = 8 # Length of the Transmission Block header
+CONTROL_LEN = 33 # Length of the OPEN/ACK/NAK control record
+BUFSIZE = 32768 # Our buffer size (NCCIBUFSZ) sent in the I record
+MIN_BUFSIZE = 300 # Smallest buffer that still holds a full SCB record
+# TTB header and trailer, TTR, DLE STX, BCB, FCS and the end of block RCB
+BLOCK_OVERHEAD = TTB_LEN + 4 + 4 + 2 + 1 + 2 + 1
+FIRST_JOB_NUMBER = 49 # Job number of the first job a session sends
+MAX_JOB_NUMBER = 32767 # NJHGJID is a signed halfword
+
+SCB_MAX = 253 # Most bytes one SCB record holds (255 - RCB - SRCB)
+SCB_LITERAL_MAX = 63 # Most uncompressed characters behind one SCB
+# Runs worth compressing: 2-31 blanks or 3-31 of any other character
+SCB_RUN = re.compile(rb'\x40{2,31}|(.)\1{2,30}', re.DOTALL)
+
+# String Control Byte decoding table, one (kind, count) entry per SCB value.
+# 0x40-0x7F aren't defined and are skipped, like readSCB always did.
+SCB_END, SCB_BLANKS, SCB_REPEAT, SCB_LITERAL, SCB_SKIP = range(5)
+SCB_TABLE = tuple(
+	(SCB_END, 0) if (scb & 0xC0) == 0x00 else
+	(SCB_SKIP, 0) if (scb & 0xC0) == 0x40 else
+	(SCB_LITERAL, scb & 0x3F) if (scb & 0xC0) == 0xC0 else
+	(SCB_REPEAT, scb & 0x1F) if (scb & 0xE0) == 0xA0 else
+	(SCB_BLANKS, scb & 0x1F)
+	for scb in range(256) )
+SCB_BLANK_RUNS = tuple(SPACE * count for count in range(32))
+
+# Debug tracing categories, each one is the logger 'njelib.<category>'
+#  wire      : raw bytes sent and received, TTB/TTR framing
+#  compress  : SCB compression/decompression
+#  records   : NJE record, header and NMR processing
+#  handshake : connection, signon and everything else
+TRACE_CATEGORIES = ('wire', 'compress', 'records', 'handshake')
+log = logging.getLogger('njelib')
+trace_handler = None
+
+class NJETrace(logging.LoggerAdapter):
+	""" Tags debug messages with the session they came from. Nothing is
+		formatted unless the category is enabled. """
+	def process(self, msg, kwargs):
+		kwargs['extra'] = {'session': self.extra.trace_name()}
+		return msg, kwargs
+
+class TraceFilter(logging.Filter):
+	def filter(self, record):
+		if not hasattr(record, 'session'):
+			record.session = 'NJE'
+		return True
+
+class LazyHex:
+	""" Hex dumps bytes when (and only if) a debug message is printed """
+	__slots__ = ('data',)
+	def __init__(self, data):
+		self.data = data
+	def __str__(self):
+		return phex(self.data)
+
+def phex(stuff):
+	hexed = bytes(stuff).hex()
+	return ' '.join(hexed[i:i+2] for i in range(0, len(hexed), 2))
+
+def scb_segments(data, prefix=b''):
+	""" SCB compresses data of any size. Generates one compressed segment for
+		every SCB_MAX bytes of data, each starting with prefix (usually RCB + SRCB)
+		and ending with the 0x00 end of record SCB. The input is walked once
+		through a memoryview so large payloads compress in linear time.
+
+		String Control Byte (Pg 123):
+			0x80 + n  : n blanks (0x40)
+			0xA0 + n  : the next character repeated n times
+			0xC0 + n  : n uncompressed characters follow
+			0x00      : end of record
+	"""
+	view = memoryview(data)
+	length = len(view)
+	pos = 0
+	while True:
+		end = min(pos + SCB_MAX, length)
+		segment = bytearray(prefix)
+		literal = pos # start of the uncompressed characters not written yet
+		for run in SCB_RUN.finditer(view, pos, end):
+			start = run.start()
+			while literal < start:
+				count = min(start - literal, SCB_LITERAL_MAX)
+				segment.append(0xC0 + count)
+				segment += view[literal:literal + count]
+				literal += count
+			count = run.end() - start
+			if run.group(1) is None:
+				segment.append(0x80 + count)
+			else:
+				segment.append(0xA0 + count)
+				segment.append(view[start])
+			literal = run.end()
+		while literal < end:
+			count = min(end - literal, SCB_LITERAL_MAX)
+			segment.append(0xC0 + count)
+			segment += view[literal:literal + count]
+			literal += count
+		segment.append(0x00)
+		yield bytes(segment)
+		pos = end
+		if pos >= length:
+			break
+
+def scb_compressed(RCB):
+	""" True if records with this RCB (an int) carry SCB compressed data:
+		NMRs (9A), SYSIN (98-F8) and SYSOUT (99-F9) """
+	return (RCB == 0x9A) or ((RCB & 0x0F) == 0x08) or ((RCB & 0x0F) == 0x09)
+
+def scb_decode_into(data, out, offset=0, pos=0):
+	""" Decompresses one SCB record from data, starting at pos, into out
+		starting at offset. out can be a bytearray, which grows as needed, or a
+		writable memoryview big enough for the result. Literal runs are copied
+		as slices. Returns a tuple of the position in data after the end of
+		record byte and the offset in out after the decompressed record. """
+	view = memoryview(data)
+	length = len(view)
+	while pos < length:
+		kind, count = SCB_TABLE[view[pos]]
+		pos += 1
+		if kind == SCB_LITERAL:
+			chunk = view[pos:pos + count]
+			count = len(chunk)
+			out[offset:offset + count] = chunk
+			pos += count
+		elif kind == SCB_BLANKS:
+			out[offset:offset + count] = SCB_BLANK_RUNS[count]
+		elif kind == SCB_REPEAT:
+			if pos >= length:
+				break
+			out[offset:offset + count] = bytes((view[pos],)) * count
+			pos += 1
+		elif kind == SCB_SKIP:
+			continue
+		else:
+			break
+		offset += count
+	return (pos, offset)
+
+def scb_decode_records(data, out, pos=0, offset=0):
+	""" Decompresses consecutive RCB SRCB <SCB record> groups from data into out
+		in one call, stopping at the end of block RCB (0x00), the first
+		uncompressed record or the end of data. Returns a list of
+		(RCB, SRCB, start, end) tuples, where start and end are offsets of the
+		record's data in out, and the position in data where decoding stopped. """
+	view = memoryview(data)
+	length = len(view)
+	records = []
+	while pos + 1 < length:
+		RCB = view[pos]
+		SRCB = view[pos + 1]
+		if RCB == 0x00 or not scb_compressed(RCB):
+			break
+		start = offset
+		pos, offset = scb_decode_into(view, out, offset, pos + 2)
+		records.append((RCB, SRCB, start, offset))
+	return (records, pos)
+
+HEARTBEAT = (0x00, 0x00, memoryview(b"\x00")) # what parse_records() yields for a heartbeat
+LENGTH = struct.Struct('>H') # TTB and TTR length, two bytes in
+
+def parse_records(data, session=None):
+	""" Walks the TTB blocks in data and yields an (RCB, SRCB, payload) tuple
+		for every NJE record in them. RCB and SRCB are ints and payload is a
+		memoryview. Uncompressed payloads point into data, SCB compressed
+		ones into one buffer per TTR that the whole TTR is decompressed into.
+		Nothing else is copied, call bytes() on payloads you keep.
+
+		Heartbeats come out as (0, 0, b'\x00') and short control sequences
+		(e.g. DLE ACK0) as (None, None, payload). If session is given its
+		server_seq (BCB) and FCS are updated from every TTR. """
+	view = memoryview(data)
+	total = len(view)
+	pos = 0
+	while pos + TTB_LEN <= total:
+		block_end = pos + LENGTH.unpack_from(view, pos + 2)[0]
+		if block_end < pos + TTB_LEN + 4:
+			break
+		block_end = min(block_end, total)
+		rpos = pos + TTB_LEN
+		while rpos + 4 <= block_end - 4:
+			length = LENGTH.unpack_from(view, rpos + 2)[0]
+			start = rpos + 4
+			end = min(start + length, block_end - 4)
+			rpos = start + length
+			if length == 6:
+				yield HEARTBEAT
+			elif length > 2:
+				# DLE STX BCB FCS, then RCB SRCB data ... ending with RCB 00
+				if session is not None:
+					session.server_seq = bytes(view[start + 2:start + 3])
+					session.FCS = bytes(view[start + 3:start + 5])
+				yield from parse_ttr(view[:end], start + 5)
+			elif length:
+				yield (None, None, view[start:end])
+		pos = block_end
+
+def parse_ttr(view, pos):
+	""" Yields the records in one TTR, starting at pos in view """
+	out = bytearray()
+	found = [] # (RCB, SRCB, True if in out, start, end)
+	end = len(view)
+	while pos + 1 < end:
+		RCB = view[pos]
+		if RCB == 0x00:
+			break
+		if scb_compressed(RCB):
+			records, pos = scb_decode_records(view, out, pos, len(out))
+			found.extend((RCB, SRCB, True, start, stop) for RCB, SRCB, start, stop in records)
+		else:
+			# Uncompressed records (control records) take up the rest of the TTR
+			found.append((RCB, view[pos + 1], False, pos + 2, end))
+			pos = end
+	decoded = memoryview(out)
+	for RCB, SRCB, compressed, start, stop in found:
+		yield (RCB, SRCB, (decoded if compressed else view)[start:stop])
+
+class NJEParser:
+	""" Sans-I/O NJE parser. Hand it bytes as they arrive, in any size, with
+		feed() and it returns the records of every TTB block that's now
+		complete. A partial block is kept until the rest of it shows up, its
+		length is read once and nothing is parsed twice. The same parser is
+		used for sockets, asyncio streams, capture files and benchmarks. """
+	def __init__(self, session=None):
+		self.session = session # gets server_seq and FCS updates, see parse_records()
+		self.buffer = bytearray()
+		self.need = 0 # length of the block at the front of buffer, 0 if not known yet
+
+	def push(self, data):
+		""" Adds received bytes without parsing them """
+		self.buffer += data
+
+	def take(self, length):
+		""" Removes and returns length raw bytes (e.g. the control record,
+			which isn't wrapped in a TTB), or None if they haven't arrived """
+		if len(self.buffer) < length:
+			return None
+		data = bytes(self.buffer[:length])
+		del self.buffer[:length]
+		self.need = 0
+		return data
+
+	def blocks(self, data=b''):
+		""" Adds data and returns a list of the TTB blocks that are complete """
+		if data:
+			self.buffer += data
+		buffer = self.buffer
+		size = len(buffer)
+		found = []
+		pos = 0
+		while True:
+			need = self.need
+			if not need:
+				if size - pos < TTB_LEN:
+					break
+				need = LENGTH.unpack_from(buffer, pos + 2)[0]
+				if need < TTB_LEN:
+					# Not a TTB, hand back whatever we have
+					need = size - pos
+				self.need = need
+			if size - pos < need:
+				break
+			found.append(bytes(buffer[pos:pos + need]))
+			pos += need
+			self.need = 0
+		if pos:
+			del buffer[:pos]
+		return found
+
+	def feed(self, data):
+		""" Adds data and returns a list of (RCB, SRCB, payload) tuples for
+			every record in the blocks that are now complete """
+		records = []
+		for block in self.blocks(data):
+			records.extend(parse_records(block, self.session))
+		return records
+
+	def pending(self):
+		""" Number of bytes held for a block that isn't complete """
+		return len(self.buffer)
+
+	def reset(self):
+		self.buffer.clear()
+		self.need = 0
+
+def set_tracing(level, categories=TRACE_CATEGORIES):
+	""" Turns debug tracing on (level > 0) or off for the given categories.
+		The first time it's turned on a handler printing to stdout is added to
+		the 'njelib' logger. Tracing can also be set up with the logging module
+		directly using the 'njelib.<category>' loggers. """
+	global trace_handler
+	if level > 0 and trace_handler is None:
+		trace_handler = logging.StreamHandler(sys.stdout)
+		trace_handler.addFilter(TraceFilter())
+		trace_handler.setFormatter(logging.Formatter('%(session)s: [%(funcName)s] %(message)s'))
+		log.addHandler(trace_handler)
+		log.propagate = False
+	for category in categories:
+		logging.getLogger('njelib.' + category).setLevel(logging.DEBUG if level > 0 else logging.WARNING)
+
+def pack_blocks(segments, bufsize):
+	""" Groups NJE records (RCB SRCB data, already compressed) into lists
+		that each fit one transmission block of at most bufsize bytes.
+		Records are never split, they're already the smallest legal unit. """
+	room = bufsize - BLOCK_OVERHEAD
+	block = []
+	used = 0
+	for segment in segments:
+		if used + len(segment) > room and block:
+			yield block
+			block = []
+			used = 0
+		if len(segment) > room:
+			raise ValueError("NJE record of {0} bytes doesn't fit a {1} byte buffer".format(len(segment), bufsize))
+		block.append(segment)
+		used += len(segment)
+	if block:
+		yield block
 
 def my_to_bytes(a):
 		# print("-->my_to_bytes",type(a))
@@ -68,9 +396,96 @@ def my_from_bytes(a):
 		else:
 			print("--->my_from_bytes unsupported type",type(a))
 
+class Job:
+	""" Handle for a job sent with NJE.submit(). Iterating over it yields the
+		SYSOUT records (JobHeader, DatasetHeader, DataRecord, JobTrailer) as
+		they come off the wire and stops after the job trailer. """
+	def __init__(self, nje, number, name, keep=False, timeout=None, callback=None):
+		self.nje = nje
+		self.number = number
+		self.name = name
+		self.jobid = 'JOB{0:05d}'.format(number)
+		self.keep = keep # also leave the records in the session's SYSOUT store
+		self.timeout = timeout # seconds to wait for the next record, None waits forever
+		self.pending = collections.deque()
+		self.messages = [] # NMRs that mention the job
+		self.header = None
+		self.trailer = None
+		self.sent = False # the other node acknowledged the SYSIN stream
+		self.done = False
+		self.future = concurrent.futures.Future() # resolved with the job when its output is complete
+		if callback is not None:
+			self.future.add_done_callback(lambda future: callback(self))
+
+	def feed(self, record):
+		""" Called by the session for every SYSOUT record of this job """
+		if isinstance(record, njerecords.JobHeader) and self.header is None:
+			self.header = record
+		elif isinstance(record, njerecords.JobTrailer):
+			self.trailer = record
+			self.done = True
+		self.pending.append(record)
+		if self.done and not self.future.done():
+			self.future.set_result(self)
+
+	def fail(self, error):
+		""" Ends the job without output, the future gets error """
+		self.done = True
+		if not self.future.done():
+			self.future.set_exception(error)
+
+	def mentioned(self, text):
+		""" True if an NMR text has the job's number in it """
+		return self.jobid.encode('latin-1') in text
+
+	def __iter__(self):
+		deadline = None
+		while True:
+			while self.pending:
+				deadline = None
+				yield self.pending.popleft()
+			if self.done or not self.nje.sock:
+				return
+			if self.timeout is not None:
+				if deadline is None:
+					deadline = time.time() + self.timeout
+				elif time.time() >= deadline:
+					return
+			self.nje.receive()
+
+	def wait(self):
+		""" Reads the job's output to the end and returns it as a list """
+		return list(self)
+
+	def __aiter__(self):
+		return self.arecords()
+
+	async def arecords(self):
+		""" Same as iterating over the job, for jobs sent with AsyncNJE """
+		while True:
+			while self.pending:
+				yield self.pending.popleft()
+			if self.done or not self.nje.sock:
+				return
+			if not await self.nje.receive_async(self.timeout):
+				return
+
+	async def wait_async(self):
+		return [record async for record in self]
+
+	def spool(self, directory, raw=False):
+		""" Writes the job's output to one file per spool data set in
+			directory as it arrives and returns the list of files """
+		return njespool.SpoolWriter(directory, raw).write_all(self)
+
+	def __repr__(self):
+		state = 'done' if self.done else 'sent' if self.sent else 'queued'
+		return 'Job({0}, {1!r}, {2})'.format(self.number, self.name, state)
+
 class NJE:
-	def __init__(self, rhost='', ohost='', host='', port=0, password='', rip='127.0.0.1'):
+	def __init__(self, rhost='', ohost='', host='', port=0, password='', rip='127.0.0.1', codepage=ebcdic.DEFAULT_CODEPAGE):
 		self.debuglevel = DEBUGLEVEL
+		self.codec	= ebcdic.Codec(codepage)
 		self.host	= host
 		self.port	= port
 		self.sock	= None
@@ -94,6 +509,27 @@ class NJE:
 		self.own_node	= b'\x01' # Node is default 1. Can be changed to anything
 		self.sequence	= 0x80
 		#self.sequence	= b'\x80'
+		self.wire_log	= NJETrace(logging.getLogger('njelib.wire'), self)
+		self.compress_log	= NJETrace(logging.getLogger('njelib.compress'), self)
+		self.records_log	= NJETrace(logging.getLogger('njelib.records'), self)
+		self.handshake_log	= NJETrace(logging.getLogger('njelib.handshake'), self)
+		self.recv_buf	= bytearray(RECV_SIZE) # reused for every recv_into()
+		self.parser	= NJEParser(self) # holds bytes received but not yet returned
+		self.linger	= LINGER
+		self.bufsize	= BUFSIZE # what we offer in the I record
+		self.peer_bufsize	= None # NCCIBUFSZ from the other side's J record
+		self.set_store()
+		self.jobs	= [] # Jobs waiting for SYSOUT, see submit()
+		self.queue	= collections.deque() # (Job, SYSIN records) waiting for a stream, see enqueue()
+		self.job_number	= FIRST_JOB_NUMBER - 1 # last job number handed out
+		self.streams	= njestreams.StreamManager() # SYSIN and SYSOUT streams of the link
+		self.spool	= None # SpoolWriter for SYSOUT, see set_spool()
+		self.spanned	= njerecords.Reassembler() # SYSOUT records split in segments
+		self.io_lock	= threading.RLock() # held while reading, see keepalive()
+		self.send_lock	= threading.RLock() # held from taking a sequence number until its block is sent
+		self.liveness	= njekeepalive.Liveness() # when the link last sent and received
+		self.keepalive_service	= None # KeepaliveThread, see start_keepalive()
+		self.replies	= None # NMRs received while sendCommand() waits for its reply
 		if host:
 			self.signon(self.host, self.port)
 
@@ -106,19 +542,12 @@ class NJE:
 		self.host = host
 		self.port = port
 		self.timeout = timeout
-		print("cafile",self.cafile,"certfile",self.certfile,"keystorePassword",self.certpassword)
+		self.msg("cafile %s certfile %s", self.cafile, self.certfile)
 		if self.cafile is not None:
 			try:
 			
 				self.msg("Trying SSL Connection")
-				# added by Colin
-				context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-				if self.cafile is not None:
-					context.load_verify_locations(cafile=self.cafile)
-				if self.certfile is not None:
-					context.load_cert_chain(self.certfile,keyfile=self.keyfile,password=self.certpassword)
-				context.verify_mode = ssl.CERT_REQUIRED
-				context.check_hostname = True 
+				context = self.tls_context()
 				non_ssl = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 				ssl_sock = context.wrap_socket(sock=non_ssl,server_hostname=host)
 				# ssl_sock = ssl.wrap_socket(sock=non_ssl,cert_reqs=ssl.CERT_NONE)
@@ -127,20 +556,20 @@ class NJE:
 				self.sock = ssl_sock
 				self.ssl = True
 			except Exception as e:
-				print(e)
+				self.msg("SSL Connection Failed: %s", e)
 				return
 				
 		#except ssl.SSLError, e:
 		if self.ssl is False:
 #		                      self.msg("SSL Failed Trying Non-SSL Connection")
 			try:
-				print("Non SSL")
+				self.msg("Non SSL")
 				sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 				sock.settimeout(timeout)
 				sock.connect((host,port))
 				self.sock = sock
 			except Exception as e:
-				self.msg("Non-SSL Connection Failed: {0}".format(e))
+				self.msg("Non-SSL Connection Failed: %s", e)
 				return False
                 #except Exception, e:
                 #       self.msg('SSL Connection Failed Error: %r', e)
@@ -150,14 +579,36 @@ class NJE:
 		#except Exception, e:
 		#	self.msg('SSL Connection Failed Error: %r', e)
 		#	return False
+		self.liveness.reset()
 		return True
 
+	def tls_context(self):
+		""" Builds the SSL context for the certificates given to setTLS() """
+		# added by Colin
+		context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+		if self.cafile is not None:
+			context.load_verify_locations(cafile=self.cafile)
+		if self.certfile is not None:
+			context.load_cert_chain(self.certfile,keyfile=self.keyfile,password=self.certpassword)
+		context.verify_mode = ssl.CERT_REQUIRED
+		context.check_hostname = True 
+		return context
+
 	def disconnect(self):
 		"""Close the connection."""
 		self.msg("Disconnecting")
 		sock = self.sock
 		self.sequence = 0x80 #reset sequence
 		self.connected = False
+		self.stop_keepalive()
+		self.parser.reset()
+		self.spanned.reset()
+		self.streams.reset()
+		self.peer_bufsize = None
+		for job in [job for job, records in self.queue] + self.jobs:
+			job.fail(ConnectionError("NJE connection closed before " + job.jobid + " finished"))
+		self.queue.clear()
+		self.jobs = []
 		# are the following statments in the wong order?
 		self.sock = 0
 		if sock:
@@ -165,6 +616,12 @@ class NJE:
 
 	def signoff(self):
 		#Sends a B Record
+		with self.send_lock:
+			self.sendData(self.signoff_record())
+		self.shutdown()
+		self.disconnect()
+
+	def signoff_record(self):
 		adios = (b'\x00\x00\x00\x19\x00\x00\x00\x00\x00\x00\x00\x09\x10\x02' +
 #				   self.sequence.to_bytes(1,"big") +
 				   my_to_bytes(self.sequence) +
@@ -172,8 +629,30 @@ class NJE:
 		
         # The following tries to send an int with value 0 ...! 
 		#self.msg("Sending Signoff Record: {0}".format(self.EbcdicToAscii(adios[18])))
-		self.sendData(adios)
-		self.disconnect()
+		return adios
+
+	def shutdown(self, wait=None):
+		""" Tells the other side we're done sending and waits up to wait
+			seconds (self.linger by default) for it to close the connection.
+			Closing a socket with unread data in it resets the connection,
+			which can throw away what we sent before the other side read it. """
+		if not self.sock or self.offline:
+			return
+		if wait is None:
+			wait = self.linger
+		deadline = time.monotonic() + wait
+		with self.io_lock:
+			try:
+				self.sock.shutdown(socket.SHUT_WR)
+				while True:
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						break
+					self.sock.settimeout(remaining)
+					if not self.sock.recv(RECV_SIZE):
+						break
+			except (OSError, ValueError):
+				pass
 
 	def set_offline(self):
 		""" Sets the system to offline mode, used for processing
@@ -183,69 +662,71 @@ class NJE:
 		self.offline = True
 
 	def msg(self, msg, *args):
-		## expects strings
-		"""Print a debug message, when the debug level is > 0.
+		"""Log a handshake/session debug message when tracing is enabled.
 
 		If extra arguments are present, they are substituted in the
-		message using the standard string formatting operator.
+		message using the standard string formatting operator, but only
+		if the message is actually going to be printed.
 
 		"""
+		self.handshake_log.debug(msg, *args, stacklevel=2)
 
-		curframe = inspect.currentframe()
-		calframe = inspect.getouterframes(curframe, 2)
-		caller = calframe[1][3]
-
-		if self.debuglevel > 0:
-			if self.offline:
-				print('NJE: [{0}]'.format(caller), end =" ")
-			else:
-				print('NJE({0},{1}): [{2}]'.format(self.host, self.port, caller), end =" ")
-
-			if args:
-				#print('GOT HERE')
-				print(msg, args)
-			else:
-				print(msg)
-
-	def set_debuglevel(self, debuglevel):
+	def set_debuglevel(self, debuglevel, categories=TRACE_CATEGORIES):
 		"""Set the debug level.
 		The higher it is, the more debug output you get (on sys.stdout).
+		categories limits the output to some of: wire, compress, records, handshake
 		"""
 		self.debuglevel = debuglevel
+		set_tracing(debuglevel, categories)
 		if self.debuglevel > 0:
 			self.msg("Enabling Debugging Records")
 
+	def trace_name(self):
+		""" Prefix used for this session's debug messages """
+		if self.offline:
+			return 'NJE'
+		return 'NJE({0},{1})'.format(self.host, self.port)
+
 	def INC_SEQUENCE(self):
 		prev = self.sequence
 		self.sequence = (self.sequence & 0x0F)+1|0x80
-		self.msg("Incremented sequence number from {0} to {1}".format(prev, self.sequence))
+		self.msg("Incremented sequence number from %s to %s", prev, self.sequence)
+
+	def set_bufsize(self, bufsize):
+		""" Sets the buffer size we offer in the initial signon record. Has
+			to be set before signing on. Blocks we send are never bigger than
+			this or the other side's buffer size, whichever is smaller. """
+		if not MIN_BUFSIZE <= bufsize <= 0xFFFF:
+			raise ValueError("Buffer size has to be between {0} and 65535".format(MIN_BUFSIZE))
+		self.bufsize = bufsize
+
+	def link_bufsize(self):
+		""" The biggest transmission block we're allowed to send """
+		if self.peer_bufsize and self.peer_bufsize >= MIN_BUFSIZE:
+			return min(self.bufsize, self.peer_bufsize)
+		return self.bufsize
 
 	def changeNode(self, node):
 		''' Node is the number of the node you'd like to be '''
-		self.msg("Changing " + self.own_node + " to " + node)
+		self.msg("Changing %s to %s", LazyHex(self.own_node), LazyHex(node))
 		self.own_node = node
 
+	def set_codepage(self, codepage):
+		""" Sets the EBCDIC code page for this session: cp037, cp500 or cp1047 """
+		self.codec = ebcdic.Codec(codepage)
+		self.msg("Using EBCDIC code page %s", self.codec.codepage)
+
 	def AsciiToEbcdic(self, s):
-		# Assume s is bytes or string, convert to bytes first
-		if (type(s) != bytes):
-			s=bytes(s.encode('ascii'))
-		''' Converts Ascii to EBCDIC '''
-		return s.decode('ascii').encode('EBCDIC-CP-BE')
+		''' Converts Ascii (str or latin-1 bytes) to EBCDIC '''
+		return self.codec.encode(s)
 
 	def EbcdicToAscii(self, s):
-		# Assume s is bytes or string, convert to bytes first
-		if (type(s) != bytes):
-			if (type(s) == str):
-				s=bytes(s.encode('EBCDIC-CP-BE'))
-			elif (type(s) == int):
-				#s=s.to_bytes(1,"big")
-				s=my_to_bytes(s)
-			else:
-				print("Cannot convert EbcdicToAscii, Exiting")
-				raise ValueError('Cannot convert EbcdicToAscii, Exiting')
-				sys.exit(-1)
-		''' Converts EBCDIC to UTF-8 '''
-		return s.decode('EBCDIC-CP-BE').encode('ascii')
+		''' Converts EBCDIC to latin-1 bytes '''
+		if type(s) == int:
+			s = my_to_bytes(s)
+		elif type(s) == str:
+			s = s.encode('latin-1')
+		return self.codec.decode(s)
 
 	def initiate(self):
 		""" Implement NJE initialization procedure
@@ -275,11 +756,17 @@ class NJE:
 				   - X'03' Link found attempting an active open.
 				   - X'04' (Undocumented) Invalid RHOST with valid OHOST
 		"""
-		self.msg("Initiating Singon to " + self.host + ":" + str(self.port))
+		self.msg("Initiating Singon to %s:%s", self.host, self.port)
 
+		self.sendData(self.open_record(socket.gethostbyname(self.host)))
 
+		if not self.check_control(self.getControlRecord()):
+			return False
+		self.send_SOHENQ()
+		return self.check_ack(list(self.processData(self.getData())))
 
-		ip	   = socket.gethostbyname(self.host)
+	def open_record(self, ip):
+		""" Builds the OPEN control record for the node at address ip """
 		self.OIP   = socket.inet_aton(ip)
 		nje_packet = (self.TYPE + self.RHOST + self.RIP + self.OHOST +
 				  self.OIP + self.R )
@@ -291,15 +778,16 @@ class NJE:
 		# print(self.EbcdicToAscii(self.OHOST))
 		# print(type(self.EbcdicToAscii(self.OHOST)))
 		# sys.exit(-1)
-		t=self.EbcdicToAscii(self.TYPE).decode('ascii')
-		r=self.EbcdicToAscii(self.RHOST).decode('ascii')
-		o=self.EbcdicToAscii(self.OHOST).decode('ascii')
-		self.msg("Sending  >> TYPE: {0} RHOST: {1} OHOST: {2}".format(t,r,o))
-
-		self.sendData(nje_packet)
-
-		buff   = self.getData()
-		self.msg("Buffer Recieved: Length({0})".format(len(buff)))
+		t=self.EbcdicToAscii(self.TYPE).decode('latin-1')
+		r=self.EbcdicToAscii(self.RHOST).decode('latin-1')
+		o=self.EbcdicToAscii(self.OHOST).decode('latin-1')
+		self.msg("Sending  >> TYPE: %s RHOST: %s OHOST: %s", t, r, o)
+		return nje_packet
+
+	def check_control(self, buff):
+		""" Checks the reply to our OPEN control record. Returns True if
+			the other side accepted it. """
+		self.msg("Buffer Recieved: Length(%s)", len(buff))
 		if len(buff) < 1:
 			return False
 
@@ -315,17 +803,17 @@ class NJE:
 		#bR = buff[32]
 
 
-		self.msg("Response << TYPE: {0:s} RHOST: {1:s} OHOST: {2:s} R: {3:d}".format(bTYPE.decode(), bRHOST.decode(), bRHOST.decode(), bR))
+		self.msg("Response << TYPE: %s RHOST: %s OHOST: %s R: %d", bTYPE.decode('latin-1'), bRHOST.decode('latin-1'), bOHOST.decode('latin-1'), bR)
 
 
 		if bR == 4:
 			print("[!] Incorrect RHOST ({0}) for OHOST: ({1})\n[!] Or RHOST already connected to OHOST"
-		 		.format(self.EbcdicToAscii(self.RHOST).decode('ascii').strip(),
-			 	self.EbcdicToAscii(self.OHOST).decode('ascii').strip()))
+		 		.format(self.EbcdicToAscii(self.RHOST).decode('latin-1').strip(),
+			 	self.EbcdicToAscii(self.OHOST).decode('latin-1').strip()))
 			self.disconnect()
 			return False
 		elif bR == 1:
-			print("[!] Incorrect RHOST (" + self.EbcdicToAscii(self.RHOST).strip() + ") and/or OHOST (" + self.EbcdicToAscii(self.OHOST).strip() + ")")
+			print("[!] Incorrect RHOST (" + self.EbcdicToAscii(self.RHOST).decode('latin-1').strip() + ") and/or OHOST (" + self.EbcdicToAscii(self.OHOST).decode('latin-1').strip() + ")")
 			self.disconnect()
 			return False
 		elif bR != 0:
@@ -333,10 +821,11 @@ class NJE:
 			self.disconnect()
 			return False
 		self.connected = True
-		self.send_SOHENQ()
-		buff = self.processData(self.getData())
+		return True
 
-		if buff[0]['Data'] != b'\x10\x70':
+	def check_ack(self, buff):
+		""" Checks that the records in buff start with DLE ACK0, the reply to SOH ENQ """
+		if not buff or buff[0][2] != b'\x10\x70':
 			print("[!] Sent SOH ENQ but did not recieve DLE ACK0")
 			self.disconnect()
 			return False
@@ -353,14 +842,17 @@ class NJE:
 		#self.INC_SEQUENCE() # Increment the sequence number by 1 now
 		self.records = self.processData(self.getData())
 		self.process_RCB()
+		return self.check_signon()
 
+	def check_signon(self):
+		""" Returns True if we're still connected after the signon records """
 		if not self.connected:
 			return False
 
 #		self.msg("Sequence is: " + self.phex(self.sequence.to_bytes(1,"big")))
-		self.msg("Sequence is: " + self.phex(my_to_bytes(self.sequence)))
-		self.msg("Own Node   : " + self.phex(self.own_node))
-		self.msg("Dest Node  : " + self.phex(self.target_node))
+		self.msg("Sequence is: %s", LazyHex(my_to_bytes(self.sequence)))
+		self.msg("Own Node   : %s", LazyHex(self.own_node))
+		self.msg("Dest Node  : %s", LazyHex(self.target_node))
 		self.signed_on = True
 		return True
 	def setTLS(self,certfile=None,cafile=None, keyfile=None, password=None):
@@ -396,7 +888,10 @@ class NJE:
 
 		RCB = b"\x9A"
 		SRCB = b"\x00"
+		self.sendNJE(RCB, SRCB, self.nmr_record(message, cmd, user), True)
 
+	def nmr_record(self, message, cmd=False, user=''):
+		""" Returns the data of an NMR with a command or a message """
 		if cmd:
 			self.msg("Creating NMR Command")
 			NMRFLAG  = b"\x90" #NMRFLAGC Set to 'on'. From IBM "If on, the NMR contains a command"
@@ -412,7 +907,7 @@ class NJE:
 				NMRFLAG = b"\x10" # Console Message
 				NMROUT	= b"\x00\x00\x00\x00\x00\x00\x00\x00"
 			else:
-				self.msg("Creating NMR Message for User: {0}".format(user))
+				self.msg("Creating NMR Message for User: %s", user)
 				NMRFLAG = b"\x20"
 				NMROUT	= self.padding(user.upper())
 			NMRLEVEL = b"\x30" #Normal messages
@@ -427,8 +922,7 @@ class NJE:
 		NMRML	= my_to_bytes(len(NMRMSG))
 		NMR_packet =( NMRFLAG + NMRLEVEL + NMRTYPE  + NMRML + NMRTO +
 				  NMROUT + NMRFM + NMRMSG	)
-
-		self.sendNJE(RCB, SRCB, NMR_packet, True)
+		return NMR_packet
 
 
 	def sendNJE(self, RCB, SRCB, data, compress=False):
@@ -447,31 +941,25 @@ class NJE:
 				- if the data is compressed and exceeds 253 bytes it is truncated and a new
 				  record is created with RCB + SRCB
 		"""
-		self.msg("Creating NJE Record with RCB of {0} and SRCB of {1}".format(RCB, SRCB))
+		self.records_log.debug("Creating NJE Record with RCB of %s and SRCB of %s", RCB, SRCB)
 		nje_record = RCB + SRCB
 		if compress:
-			self.msg("Compressing {0} bytes".format(len(data)))
-			d = self.makeSCB(data)
-			nje_record += d[0]
-			self.msg("Bytes Remaining: {0}".format(d[1]))
-			while d[1] > 0:
-				self.msg("Record length of 255 exceeded. {0} bytes remain".format(d[1]))
-				data = data[:d[1]]
-				d = self.makeSCB(data)
-				nje_record += RCB + SRCB + d[0]
+			self.records_log.debug("Compressing %s bytes", len(data))
+			nje_record = b''.join(scb_segments(data, RCB + SRCB))
 		else:
 			nje_record += data
 
 		DS  = b"\x10" + b"\x02" #DLE-STX
 		#BCB  = chr(self.sequence)
 #		BCB  = self.sequence.to_bytes(1,"big")
-		BCB  = my_to_bytes(self.sequence)
 		FCS  = self.FCS
-		TTR = self.calcTTR(DS + BCB + FCS + nje_record)
-		records = TTR + DS + BCB + FCS + nje_record
-		self.sendData(self.makeTTB(records))
-		self.INC_SEQUENCE()
-		self.msg("Sent NJE Record")
+		with self.send_lock:
+			BCB  = my_to_bytes(self.sequence)
+			TTR = self.calcTTR(DS + BCB + FCS + nje_record)
+			records = TTR + DS + BCB + FCS + nje_record
+			self.sendData(self.makeTTB(records))
+			self.INC_SEQUENCE()
+		self.records_log.debug("Sent NJE Record")
 
 	def sendNJE_multiple(self, records, compress=True):
 		""" Uses a list of tuples with RCB, SRCB and Data to create multiple NJE
@@ -491,45 +979,43 @@ class NJE:
 				  record is created with RCB + SRCB
 		"""
 
-		nje_record = b''
+		segments = []
+		bufsize = self.link_bufsize()
 
 		for record in records:
-			self.msg("Creating NJE Record with RCB of {0} and SRCB of {1}".format(record['RCB'], record['SRCB']))
-			nje_record += record['RCB'] + record['SRCB']
+			self.records_log.debug("Creating NJE Record with RCB of %s and SRCB of %s", record['RCB'], record['SRCB'])
 			data = record['Data']
 			if compress:
-				self.msg("Compressing {0} bytes".format(len(data)))
-				d = self.makeSCB(data)
-				nje_record += d[0]
-				#self.msg("Bytes Remaining: %r", d[1])
-				while d[1] > 0:
-					self.msg("Record length of 255 exceeded. {0} bytes remain".format(d[1]))
-					data = data[-d[1]:]
-					d = self.makeSCB(data)
-					nje_record += record['RCB'] + record['SRCB'] + d[0]
+				self.records_log.debug("Compressing %s bytes", len(data))
+				segments.extend(scb_segments(data, record['RCB'] + record['SRCB']))
 			else:
-				nje_record += data
-
-		#adding an EOR record:
-		nje_record += b"\x00"
+				segments.append(record['RCB'] + record['SRCB'] + data)
 
+		# Fill each transmission block up to the negotiated buffer size,
+		# every block gets its own BCB and ends with an EOR record
 		DS  = b"\x10" + b"\x02" #DLE-STX
-#		BCB  = self.sequence.to_bytes(1,"big")
-		BCB  = my_to_bytes(self.sequence)
 		FCS  = self.FCS
-		TTR = self.calcTTR(DS + BCB + FCS + nje_record)
-		records = TTR + DS + BCB + FCS + nje_record
-		self.sendData(self.makeTTB(records))
-		self.INC_SEQUENCE()
-		self.msg("Sent {0} NJE Records".format(len(records)))
+		blocks = []
+		with self.send_lock:
+			for block in pack_blocks(segments, bufsize):
+#				BCB  = self.sequence.to_bytes(1,"big")
+				BCB  = my_to_bytes(self.sequence)
+				block.insert(0, DS + BCB + FCS)
+				block.append(b"\x00")
+				nje_record = b''.join(block)
+				blocks.append(self.makeTTB(self.calcTTR(nje_record) + nje_record))
+				self.INC_SEQUENCE()
+			self.sendData(b''.join(blocks))
+		self.records_log.debug("Sent %s NJE Records in %s blocks of up to %s bytes", len(segments), len(blocks), bufsize)
 
 	def sendHeartbeat(self):
 		self.msg("Sending Hearbeat Request Reply")
-#		BCB  = self.sequence.to_bytes(1,"big")
-		BCB  = my_to_bytes(self.sequence)
-		self.sendData(b"\x00\x00\x00\x16\x00\x00\x00\x00\x00\x00\x00\x06\x10\x02" +
-					  BCB + self.FCS + b"00\x00\x00\x00\x00")
-		self.INC_SEQUENCE()
+		with self.send_lock:
+#			BCB  = self.sequence.to_bytes(1,"big")
+			BCB  = my_to_bytes(self.sequence)
+			self.sendData(b"\x00\x00\x00\x16\x00\x00\x00\x00\x00\x00\x00\x06\x10\x02" +
+						  BCB + self.FCS + b"\x00" + b"\x00\x00\x00\x00")
+			self.INC_SEQUENCE()
 
 	def check_signoff(self, buf):
 		if self.EbcdicToAscii(buf[18]) == b'B':
@@ -558,7 +1044,7 @@ class NJE:
 		LEN = b"\x29" # LENGTH OF RECORD
 		NCCIEVNT = b"\x00" * 4
 		NCCIREST = b"\x00\x64" # Node Resistance
-		BUFSIZE = b"\x80\x00" # Buffer Size. Set to: 32768
+		BUFSIZE = struct.pack('>H', self.bufsize) # Buffer Size. Defaults to 32768
 		PASSWORD = self.padding(self.password)*2
 		NCCIFLG = b"\x00" # 0 for initial signon
 		NCCIFEAT = b"\x15\x00\x00\x00"
@@ -609,108 +1095,166 @@ class NJE:
 		''' returns an int of the length '''
 		return self.hsize(TTR[2:4])
 
+	def fillBuffer(self):
+		''' Reads what's waiting on the socket into the parser. Returns False
+			if the socket timed out or the peer closed the connection '''
+		try:
+			count = self.sock.recv_into(self.recv_buf)
+		except socket.error:
+			return False
+		if count == 0:
+			self.wire_log.debug("Connection closed by peer")
+			self.disconnect()
+			return False
+		self.parser.push(memoryview(self.recv_buf)[:count])
+		self.liveness.received()
+		return True
+
+	def getControlRecord(self):
+		''' Returns the OPEN/ACK/NAK control record, which isn't wrapped in a TTB '''
+		if self.offline:
+			self.wire_log.debug('Offline Mode: Not Retrieving data')
+			return
+		with self.io_lock:
+			data = self.parser.take(CONTROL_LEN)
+			while data is None:
+				if not self.sock or not self.fillBuffer():
+					return b''
+				data = self.parser.take(CONTROL_LEN)
+		self.wire_log.debug("Recieved << '%s'", LazyHex(data))
+		return data
+
 	def getData(self):
+		''' Returns the next complete TTB block, plus any further complete blocks
+			that have already arrived. Returns as soon as a block is complete
+			instead of waiting for the socket to time out. Any trailing partial
+			block is kept in the parser for the next call. '''
 		if self.offline:
-			self.msg('Offline Mode: Not Retrieving data')
+			self.wire_log.debug('Offline Mode: Not Retrieving data')
 			return
-		data = b''
-		r, w, e = select([self.sock], [], [])
-		for i in r:
-			try:
-				buf = self.sock.recv(256)
-				data += buf
+		with self.io_lock:
+			blocks = self.parser.blocks()
+			while not blocks:
+				if not self.sock or not self.fillBuffer():
+					return b''
+				blocks = self.parser.blocks()
+		data = b''.join(blocks)
+		self.wire_log.debug("Recieved << '%s'", LazyHex(data))
+		return data
 
-				while( buf != b''):
-					buf = self.sock.recv(256)
-					data += buf
-				if(buf == b''):
+	def poll(self):
+		""" Reads whatever has already arrived into the parser without
+			waiting for more """
+		with self.io_lock:
+			while self.sock and (select([self.sock], [], [], 0)[0] or (self.ssl and self.sock.pending())):
+				if not self.fillBuffer():
 					break
-			except socket.error:
-				# traceback.print_exc()
-				pass
-		self.msg("Recieved << '{0}'".format(self.phex(data)))
+
+	def start_keepalive(self, interval=njekeepalive.INTERVAL, dead_after=None):
+		""" Starts a thread that keeps the link warm while the session is
+			idle: it processes what arrives (and answers heartbeats), sends a
+			heartbeat after interval seconds of quiet and disconnects once
+			nothing has come in for dead_after seconds (three intervals by
+			default). See link_state(). """
+		self.stop_keepalive()
+		self.liveness.set_interval(interval, dead_after)
+		self.keepalive_service = njekeepalive.KeepaliveThread(self)
+		self.keepalive_service.start()
+
+	def stop_keepalive(self):
+		if self.keepalive_service is not None:
+			self.keepalive_service.stop()
+			self.keepalive_service = None
+
+	def keepalive(self):
+		""" One round of the keepalive service. It only processes what
+			arrived when nobody else is reading and nothing was sent for a
+			moment, so it never takes the reply to something the session
+			just sent. Returns False once the link is gone. """
+		if not self.io_lock.acquire(blocking=False):
+			return True
+		try:
+			if not self.sock:
+				return False
+			if self.liveness.sent_recently():
+				return True
+			self.poll()
+			if not self.liveness.sent_recently():
+				blocks = self.parser.blocks()
+				if blocks:
+					self.records = self.processData(b''.join(blocks))
+					self.process_RCB()
+					self.pump()
+			action = self.liveness.check()
+			if action == njekeepalive.DEAD:
+				self.msg("Nothing from %s for %s seconds, dropping the link", self.host, self.liveness.dead_after)
+				self.disconnect()
+				return False
+			if action == njekeepalive.HEARTBEAT:
+				self.handshake_log.debug("Link quiet for %s seconds, sending a heartbeat", self.liveness.interval)
+				self.sendHeartbeat()
+				self.liveness.heartbeat_sent()
+			return bool(self.sock)
+		finally:
+			self.io_lock.release()
+
+	def link_state(self):
+		""" 'alive', 'waiting' (for the answer to our heartbeat), 'dead' or 'down' """
+		return self.liveness.state(bool(self.sock))
+
+	def getMoreData(self, wait=None):
+		''' Returns the blocks that have already arrived, without waiting
+			for more. With wait keeps collecting blocks for as long as they
+			arrive within wait seconds of each other. Used for replies spread
+			over several blocks. '''
+		if self.offline or not self.sock:
+			return b''
+		if not wait:
+			self.poll()
+			with self.io_lock:
+				return b''.join(self.parser.blocks())
+		data = b''
+		timeout = self.sock.gettimeout()
+		self.sock.settimeout(wait)
+		try:
+			block = self.getData()
+			while block:
+				data += block
+				block = self.getData()
+		finally:
+			if self.sock:
+				self.sock.settimeout(timeout)
 		return data
 
 	def sendData(self, data):
 		"""Sends raw data to the NJE server """
 		if self.sock == 0:
 			return  
-		self.msg("Sending  >> '{0}'".format(self.phex(data)))
+		self.wire_log.debug("Sending  >> '%s'", LazyHex(data))
 		if self.offline:
-			self.msg('Offline Mode: Not Sending data')
+			self.wire_log.debug('Offline Mode: Not Sending data')
 			return
 		self.sock.sendall(data)
+		self.liveness.sent()
 
 	def processData(self, data):
-		"""Process Data Streams returns an array """
-		#if not self.connected:
-		#	return data
-
-		received_data = []
-		d = data
-		while len(d) > 0:
-			i = 1
-			data = d
-			total_length = self.readTTB(data) - 12
-			data = data[8:-4] #The TTB is 8 bytes at the begining and a footer of 4 bytes
-			self.msg("Total Length (TTB - 12): {0}".format(total_length))
-			while i <= total_length:
-				record_length = self.readTTR(data)
-				self.msg("Record Length (TTR): {0}".format(record_length))
-				current_record = data[4:4 + record_length]
-				self.msg("Compressed Record: {0}".format(self.phex(current_record)))
-				if record_length == 6:
-					#hearbeat
-					packet_dict = {
-					'RCB'  : b"\x00",
-					'SRCB' : b"\x00",
-					'Data' : b"\x00"
-					}
-					received_data.append(packet_dict)
-				elif record_length > 2:
-					DLESTX = current_record[0:2]
-					self.server_seq = current_record[2:3]
-					self.FCS = current_record[3:5]
-					current_record = current_record[5:]
-					while len(current_record) > 1:
-						packet_dict = {
-							'RCB' : my_to_bytes(current_record[0]),
-#							'RCB' : current_record[0].to_bytes(1,"big"),
-#							'SRCB' : current_record[1].to_bytes(1,"big")
-							'SRCB' : my_to_bytes(current_record[1])
-							}
-						current_record = current_record[2:]
-						if self.compressed(packet_dict['RCB']):
-							data = self.readSCB(current_record)
-							packet_dict['Data'] = data[0]
-							current_record = current_record[data[1]:]
-						else:
-							packet_dict['Data'] = current_record
-							current_record = current_record[record_length:]
-						self.msg("Adding Record with RCB {0} and SRCB {1}".format(packet_dict['RCB'], packet_dict['SRCB']))
-						self.msg("Decompressed Record: {0}".format(self.phex(packet_dict['Data'])))
-						received_data.append(packet_dict)
-				else:
-					packet_dict = { 'Data' :current_record}
-					received_data.append(packet_dict)
-
-				data += data[4 + record_length:]
-				i += record_length + 4
-				i += 1
-			d = d[total_length+12:]
-			self.msg("Total Length: {0}".format(len(d)))
-		return received_data
+		""" Returns an iterator of (RCB, SRCB, payload) tuples for the NJE
+			records in data, see parse_records(). Records are parsed as
+			they're asked for. """
+		if not data:
+			return iter(())
+		self.wire_log.debug("Total Length: %s", len(data))
+		if not self.wire_log.isEnabledFor(logging.DEBUG):
+			return parse_records(data, self)
+		return self.traceRecords(parse_records(data, self))
+
+	def traceRecords(self, records):
+		for RCB, SRCB, payload in records:
+			self.wire_log.debug("Record with RCB %s and SRCB %s: %s", RCB, SRCB, LazyHex(payload))
+			yield (RCB, SRCB, payload)
 
 	def phex(self, stuff):
-		#print(stuff)
-		#print(type(stuff))
-		#sys.exit(-3)
-		if (type(stuff) != bytes):
-			print("Fatal error: phex input should be bytes")
-			sys.exit(-3)
-
-		hexed = stuff.hex()
-		return ' '.join(hexed[i:i+2] for i in range(0, len(hexed), 2))
+		return phex(stuff)
 
 	def process_RCB(self):
 		# Record Control Byte				(Pg 124)
@@ -729,88 +1273,107 @@ class NJE:
 			9A	Operator command/console message
 
 		"""
-		prev_rcb = prev_srcb = prev_data = ''
-
-		self.msg("Processing {0} NJE Records".format(len(self.records)))
-		# for record in self.records:
-		#	self.msg("record[RCB]: %r", self.phex(record['RCB']))
-		#	self.msg("record[SRCB]: %r", self.phex(record['SRCB']))
-		#	self.msg("record[Data]: %r", self.phex(record['Data']))
-		#	self.msg("Record Len: %i", len(record['Data']))
-
-		for record in self.records:
-
-##			self.msg("RCB: '\\x{0:02x}'".format(int.from_bytes(record['RCB'],"big")))
-			self.msg("RCB: '\\x{0:02x}'".format(my_from_bytes(record['RCB'])))
-##			self.msg("SRCB: '\\x{0:02x}'".format(int.from_bytes(record['SRCB'],"big")))
-			self.msg("SRCB: '\\x{0:02x}'".format(my_from_bytes(record['SRCB'])))
-			#self.msg("Record: %r", self.phex(record['Data']))
-	
-			total_len = len(record['RCB']) + len(record['SRCB']) + len(record['Data'])
-	
-			if total_len == 255:
-				self.msg("Record Exceeds Total Size. Truncated Record.")
-				self.msg("Total Length: {0}".format(total_len))
-				prev_rcb = record['RCB']
-				prev_srcb = record['SRCB']
-				prev_data = record['Data']
-				continue
+		self.records_log.debug("Processing NJE Records")
 
-			if prev_rcb == record['RCB'] and prev_srcb == record['SRCB']:
-				cur_data = prev_data + record['Data'][4:] #Skip the sequence packets
-				record['Data'] = cur_data
-				prev_rcb = ''
+		for RCB, SRCB, payload in self.records:
 
-			RCB = ord(record['RCB'])
+			self.records_log.debug("RCB: %s", RCB)
+			self.records_log.debug("SRCB: %s", SRCB)
 
-			if record['RCB'] == b"\x00" and record['SRCB'] == b'\x00' and record['Data'] == b"\x00":
-				self.sendHeartbeat()
+			if RCB is None:
+				continue
+
+			if RCB == 0x00 and SRCB == 0x00 and payload == b"\x00":
+				if not self.liveness.answered():
+					self.sendHeartbeat()
+				continue
 
+			# Only records that are kept get copied out of the block
+			record = {'RCB': my_to_bytes(RCB), 'SRCB': my_to_bytes(SRCB), 'Data': payload}
 
 			if RCB == 0x00:
-				self.msg("End-of-block (BSC) (00)")
+				self.records_log.debug("End-of-block (BSC) (00)")
 				return "EOB"
 			elif RCB == 0x90:
-				self.msg("Type: Request to initiate stream (90)")
-				record['stream'] = record['SRCB']
-				self.msg("Stream: {0}".format(record['stream']))
-				#I'll allow it
-				RCB = b"\xA0"
-				SRCB = record['stream']
-				self.sendNJE(RCB, SRCB, b"\x00\x00")
-				return
+				self.records_log.debug("Type: Request to initiate stream (90)")
+				self.records_log.debug("Stream: %s", record['SRCB'])
+				if self.streams.incoming(SRCB) is not None:
+					#I'll allow it
+					self.sendNJE(b"\xA0", record['SRCB'], b"\x00\x00")
+				else:
+					self.records_log.debug("Stream %s is busy, refusing it", record['SRCB'])
+					self.sendNJE(b"\xB0", record['SRCB'], b"\x00\x00")
 			elif RCB == 0xA0:
-				self.msg("Type: Permission to initiate stream (A0)")
-				record['streaming'] = True
-
+				self.records_log.debug("Type: Permission to initiate stream (A0)")
+				self.streams.control(RCB, SRCB)
 			elif RCB == 0xB0:
-				self.msg("Type: Negative permission or receiver cancel (B0)")
+				self.records_log.debug("Type: Negative permission or receiver cancel (B0)")
+				# Take the job before the stream is released, whatever state it's in
+				stream = self.streams.get(SRCB)
+				job = state = None
+				if stream is not None and stream.state != njestreams.RECEIVING:
+					job, state = stream.job, stream.state
+				self.streams.control(RCB, SRCB)
+				if job is not None:
+					if job in self.jobs:
+						self.jobs.remove(job)
+					if state == njestreams.REQUESTED:
+						self.msg("Stream %s was refused, %s not sent", record['SRCB'], job.jobid)
+						job.fail(ConnectionRefusedError("NJE stream refused for " + job.jobid))
+					else:
+						self.msg("Stream %s was cancelled by the receiver, %s failed", record['SRCB'], job.jobid)
+						job.fail(ConnectionAbortedError("NJE stream cancelled for " + job.jobid))
 			elif RCB == 0xC0:
-				self.msg("Type: Acknowledge transmission complete (C0)")
+				self.records_log.debug("Type: Acknowledge transmission complete (C0)")
+				job = self.streams.job(SRCB, njestreams.CLOSING)
+				self.streams.control(RCB, SRCB)
+				if job is not None:
+					job.sent = True
 			elif RCB == 0xD0:
-				self.msg("Type: Ready to receive stream (D0)")
+				self.records_log.debug("Type: Ready to receive stream (D0)")
 			elif RCB == 0xE0:
-				self.msg("Type: BCB sequence error (E0)")
+				self.records_log.debug("Type: BCB sequence error (E0)")
 			elif RCB == 0xF0:
-				self.msg("Type: General control record (F0)")
+				self.records_log.debug("Type: General control record (F0)")
+				record['Data'] = bytes(payload)
 				self.process_NCCR(record)
 			elif RCB == 0x9A:
-				self.msg("Type: Operator command/console message (9A)")
+				self.records_log.debug("Type: Operator command/console message (9A)")
+				record['Data'] = bytes(payload)
 				data = self.process_nmr(record)
-				if 'NMRMSG' in data:
-					self.msg("{0} >> {1}: \"{2}\"".format(data['NMRFMNOD'].strip().decode('ascii'),
-										data['NMRTONOD'].strip().decode('ascii'), data['NMRMSG'].decode('ascii')))
-					if 'NMRMSG' in NMR:
-						data['NMRMSG'] = NMR['NMRMSG'] + "\n" + data['NMRMSG']
-				NMR.append(data)
+				if 'NMRMSG' in data and self.records_log.isEnabledFor(logging.DEBUG):
+					self.records_log.debug("%s >> %s: \"%s\"", data['NMRFMNOD'].strip().decode('latin-1'),
+									data['NMRTONOD'].strip().decode('latin-1'), data['NMRMSG'].decode('latin-1'))
+				self.nmr.append(data)
+				if self.replies is not None:
+					self.replies.append(data)
+				if self.jobs:
+					self.route_nmr(data)
+			elif SRCB == 0x00 and (RCB & 0x0F) in (0x08, 0x09):
+				self.records_log.debug("End of stream %s, acknowledging it", record['RCB'])
+				self.streams.finished(RCB)
+				self.spanned.discard(RCB)
+				self.sendNJE(b"\xC0", record['RCB'], b"\x00\x00")
 			elif (RCB & 0x0F) == 0x08:
-				self.msg("Type: SYSIN record (98-F8)")
+				self.records_log.debug("Type: SYSIN record (98-F8)")
+				record['Data'] = bytes(payload)
 				data = self.process_SYSIN(record)
-				SYSIN.append(data)
+				self.sysin.append(data)
 			elif (RCB & 0x0F) == 0x09:
-				self.msg("Type: SYSOUT record (99-F9)")
+				self.records_log.debug("Type: SYSOUT record (99-F9)")
+				whole = self.spanned.add(RCB, SRCB, payload)
+				if whole is None:
+					self.records_log.debug("Spanned record segment, %s bytes", len(payload))
+					continue
+				record['SRCB'] = my_to_bytes(whole[0])
+				record['Data'] = whole[1]
 				data = self.process_SYSOUT(record)
-				SYSOUT.append(data)
+				if self.route_sysout(data, RCB):
+					pass
+				elif self.spool is not None:
+					self.spool.write(data)
+				else:
+					self.sysout.append(data)
 
 	def process_NCCR(self, record):
 		""" Networking Connection Control Records (NCCR)
@@ -823,7 +1386,7 @@ class NJE:
 			B - Signoff
 			"""
 
-		SRCB = self.EbcdicToAscii(record['SRCB']).decode('ascii')
+		SRCB = self.EbcdicToAscii(record['SRCB']).decode('latin-1')
 
 		if SRCB == "I":
 			self.msg("[NCCR] I - Initial Signon")
@@ -832,10 +1395,12 @@ class NJE:
 			record['NCCIDL'] = record['Data'][0:1]
 			record['NCCINODE'] = self.EbcdicToAscii(record['Data'][1:9])
 			record['NCCIQUAL'] = record['Data'][9:10]
-			self.msg("NCCIQUAL: '{0}'".format(self.phex(record['NCCIQUAL'])))
+			self.msg("NCCIQUAL: '%s'", LazyHex(record['NCCIQUAL']))
 			record['NCCIEVNT'] = record['Data'][10:14]
 			record['NCCIREST'] = record['Data'][14:16]
 			record['NCCIBUFSZ'] = record['Data'][16:18]
+			self.peer_bufsize = self.hsize(record['NCCIBUFSZ'])
+			self.msg("NCCIBUFSZ: %s, sending blocks of up to %s bytes", self.peer_bufsize, self.link_bufsize())
 			record['NCCILPAS'] = self.EbcdicToAscii(record['Data'][18:26])
 			record['NCCINPAS'] = self.EbcdicToAscii(record['Data'][26:34])
 			#record['NCCIPRAW'] = record['Data'][28:32]
@@ -847,8 +1412,7 @@ class NJE:
 			if record['NCCIEVNT'] == b"\x00\x00\x00\x00":
 				# Reset the connection with type K
 				self.send_reset() #Type 'K'
-				self.records = self.processData(self.getData())
-				self.process_RCB()
+				self.receive()
 			else:
 				# We're not the big boss, send concurrence
 				self.send_concurrence(record['NCCIEVNT']) #Type 'L'
@@ -887,18 +1451,17 @@ class NJE:
 		self.sendNJE(RCB, SRCB, con)
 		#self.sendData(self.makeTTB(self.makeTTR_dbh(concurrent_signon)))
 
-	def request_stream(self):
-		""" Requests to initiate an NJE stream """
+	def request_stream(self, SRCB=b"\x98"):
+		""" Requests to initiate the NJE stream with RCB SRCB """
 		RCB = b"\x90"
-		SRCB = b"\x98"
 		DATA = b"\x00\x00"
-		self.msg("Requesting NJE Stream")
+		self.msg("Requesting NJE Stream %s", LazyHex(SRCB))
 		self.sendNJE(RCB, SRCB, DATA)
 
 	def process_SYSIN(self, data):
 		"""
 		Processes SYSIN data which is in the format as below.
-		Returns a dictionary of values.
+		Returns a DataRecord, JobHeader, DatasetHeader or JobTrailer.
 
 		98-F8	NJE SYSIN control information as follows:
 					1000 0000 - Standard record
@@ -909,28 +1472,18 @@ class NJE:
 					1111 0000 - Reserved for IBM's use
 		"""
 		SRCB = ord(data['SRCB']) & 0xF0
-		self.msg("Processing SYSIN. SRCB: {0}".format(data['SRCB']))
+		self.records_log.debug("Processing SYSIN. SRCB: %s", data['SRCB'])
 		# http://www-01.ibm.com/support/knowledgecenter/SSB27U_5.4.0/com.ibm.zvm.v54.dmta7/jhf.htm%23jhf
 		d = data['Data']
-		#self.msg(self.phex(d))
-		job = {}
-
-		if SRCB == 0x80:
-			self.msg("Standard record")
-			LRECL = ord(d[0:1])
-			self.msg("Record length: {0}".format(LRECL))
-			record = self.EbcdicToAscii(d[1:]).ljust(LRECL)
-			self.msg("Record: {0}".format(record))
-			job['Record'] = record
-		elif SRCB == 0xC0:
-			job.update(self.job_headers(d))
+
+		if SRCB == 0xC0:
+			return self.job_headers(d)
 		elif SRCB == 0xE0:
-			self.msg("Data set header")
+			return self.dataset_headers(d)
 		elif SRCB == 0xD0:
-			job.update(self.job_footers(d))
-			self.msg("Footer Length: {0}".format(job['NJTGLEN']))
-
-		return job
+			return self.job_footers(d)
+		self.records_log.debug("Standard record")
+		return self.data_record(d, 0x80)
 
 	def process_SYSOUT(self, data):
 		"""
@@ -951,447 +1504,93 @@ class NJE:
 						1101 0000 - Job trailer
 						1111 0000 - Reserved for IBM's use
 		"""
-		job = {}
 		d = data['Data']
-		self.msg("Processing SYSOUT. SRCB: {0}".format(data['SRCB']))
-		if (ord(data['SRCB']) & 0xC0) == 0xC0:
-			self.msg("Processing Header")
-			SRCB = ord(data['SRCB']) & 0xF0
-			if SRCB == 0x80:
-				self.msg("Standard record")
-				LRECL = ord(d[0:1])
-				self.msg("Record length: {0}".format(LRECL))
-				record = self.EbcdicToAscii(d[1:]).ljust(LRECL)
-				self.msg("Record: {0}".format(record))
-				job['Record'] = record
-			elif SRCB == 0xC0:
-				job.update(self.job_headers(d))
+		SRCB = ord(data['SRCB'])
+		self.records_log.debug("Processing SYSOUT. SRCB: %s", data['SRCB'])
+		if (SRCB & 0xC0) == 0xC0:
+			self.records_log.debug("Processing Header")
+			SRCB = SRCB & 0xF0
+			if SRCB == 0xC0:
+				return self.job_headers(d)
 			elif SRCB == 0xE0:
-				self.msg("Data set header")
-				job.update(self.dataset_headers(d))
+				self.records_log.debug("Data set header")
+				return self.dataset_headers(d)
 			elif SRCB == 0xD0:
-				job.update(self.job_footers(d))
-				self.msg("Footer Length: {0}".format(job['NJTGLEN']))
-		elif (ord(data['SRCB']) & 0x8F) == 0x80:
-			SRCB = ord(data['SRCB']) & 0xF0
-			if SRCB == 0x80:
-				self.msg("No carriage control")
-				LRECL = ord(d[0:1])
-				record = self.EbcdicToAscii(d[1:]).ljust(LRECL)
-				self.msg("Record: {0}".format(record))
-				job['Record'] = record
-			elif SRCB == 0x90:
-				self.msg("Machine carriage control")
-			elif SRCB == 0xA0:
-				self.msg("ASA carriage control")
-				length = ord(d[0:1])
-				self.msg("Length: {0}".format(length))
-				record = self.EbcdicToAscii(d[1:])
-				job['ASA'] = record[0]
-				self.msg("Record: {0}".format(len(record)))
-				job['Record'] = record
-			elif SRCB == 0xB0:
-				self.msg("CPDS page mode records (with carriage control)")
-
-		return job
+				return self.job_footers(d)
+		return self.data_record(d, SRCB)
+
+	def data_record(self, d, SRCB):
+		""" Returns the SYSIN/SYSOUT data record in d as a DataRecord """
+		record = njerecords.DataRecord(d, SRCB, self.codec)
+		if self.records_log.isEnabledFor(logging.DEBUG):
+			self.records_log.debug("Carriage control: %s", {0x80: 'None', 0x90: 'Machine',
+							0xA0: 'ASA', 0xB0: 'CPDS page mode'}[record.carriage])
+			self.records_log.debug("Record length: %s", d[0] if d else 0)
+			if 'Record' in record:
+				self.records_log.debug("Record: %s", record['Record'])
+		return record
 
 	def dataset_headers(self, d):
-		self.msg("Dataset header")
-
-		job = {
-			'NDHLEN' : struct.unpack(">H",d[0:2])[0],
-			'NDHFLAGS': d[2:3],
-			'NDHSEQ': d[3:4]
-			}
-
-		self.msg("Length {0} vs actual {1}".format(job['NDHLEN'], len(d)))
-		d = d[4:]
-		header = d[2:3]
-		length = struct.unpack(">H",d[0:2])[0]
-		job.update( {
-		'NDHGLEN'  : length,
-		'NDHGTYPE' : header,
-		'NDHGMOD'  : ord(d[3:4]),
-		'NDHGNODE' : self.EbcdicToAscii(d[4:12]),
-		'NDHGRMT'  : self.EbcdicToAscii(d[12:20]),
-		'NDHGPROC' : self.EbcdicToAscii(d[20:28]),
-		'NDHGSTEP' : self.EbcdicToAscii(d[28:36]),
-		'NDHGDD'   : self.EbcdicToAscii(d[36:44]),
-		'NDHGDSNO' : struct.unpack(">H",d[44:46])[0],
-		'NDHGCLAS' : self.EbcdicToAscii(d[47]),
-		'NDHGNREC' : struct.unpack(">i",d[48:52])[0],
-		'NDHGFLG1' : ord(d[52:53]),
-		'NDHGF1SP' : self.get_bit(ord(d[52:53]),7),
-		'NDHGF1HD' : self.get_bit(ord(d[52:53]),6),
-		'NDHGF1LG' : self.get_bit(ord(d[52:53]),5),
-		'NDHGF1OV' : self.get_bit(ord(d[52:53]),4),
-		'NDHGF1IN' : self.get_bit(ord(d[52:53]),3),
-		'NDHGF1LC' : self.get_bit(ord(d[52:53]),2),
-		'NDHGF1ST' : self.get_bit(ord(d[52:53]),1),
-		'NDHGF1DF' : self.get_bit(ord(d[52:53]),0),
-		'NDHGRCFM' : ord(d[53:54]),
-		'NDHGLREC' : struct.unpack(">H",d[54:56])[0],
-		'NDHGDSCT' : ord(d[56:57]),
-		'NDHGFCBI' : ord(d[57:58]),
-		'NDHGLNCT' : ord(d[58:59]),
-		'NDHGFORM' : self.EbcdicToAscii(d[60:68]),
-		'NDHGFCB'  : self.EbcdicToAscii(d[68:76]),
-		'NDHGUCS'  : self.EbcdicToAscii(d[76:84]),
-		'NDHGXWTR' : self.EbcdicToAscii(d[84:92]),
-		'NDHGNAME' : self.EbcdicToAscii(d[92:100]),
-		'NDHGFLG2' : ord(d[100:101]),
-		'NDHGF2PR' : self.get_bit(ord(d[100:101]),7),
-		'NDHGF2PU' : self.get_bit(ord(d[100:101]),6),
-		'NDHGF2NM' : self.get_bit(ord(d[100:101]),5),
-		'NDHGF2HB' : self.get_bit(ord(d[100:101]),4),
-		'NDHGF2HA' : self.get_bit(ord(d[100:101]),3),
-		'NDHGUCSO' : ord(d[101:102]),
-		'NDHGUCSD' : self.get_bit(ord(d[101:102]),7),
-		'NDHGUCSF' : self.get_bit(ord(d[101:102]),6),
-		'NDHGPMDE' : self.EbcdicToAscii(d[104:112]),
-		'NDHGSEGN' : struct.unpack(">i",d[112:116])[0]
-		} )
-		d = d[length:]
-
-
-
-		while len(d) > 1:
-
-			header = d[2:3]
-			if header == b"\x8C":
-				self.msg("Security Section of the Data Set Header")
-				job.update( {
-					'NDHTLEN'  : struct.unpack(">H",d[0:2])[0],
-					'NDHTTYPE' : header,
-					'NDHTMOD'  : d[3:4],
-					'NDHTLENP' : struct.unpack(">h",d[4:6])[0], # Job identifier
-					'NDHTFLG0' : ord(d[6:7]),
-					'NDHTF0JB' : self.get_bit(ord(d[7:8]),7)
-					} )
-				d = d[8:]
-				job.update( {
-					'NDHTLENT' : ord(d[0:1]),
-					'NDHTVERS' : ord(d[1:2]),
-					'NDHTFLG1' : ord(d[2:3]),
-					'NDHT1EN'  : self.get_bit(ord(d[2:3]),7),
-					'NDHT1EXT' : self.get_bit(ord(d[2:3]),6),
-					'NDHTSTYP' : ord(d[3:4]),
-					'NDHTFLG2' : ord(d[4:5]),
-					'NDHT2DFT' : self.get_bit(ord(d[4:5]),7),
-					'NDHT2MLO' : self.get_bit(ord(d[4:5]),5),
-					'NDHT2SHI' : self.get_bit(ord(d[4:5]),4),
-					'NDHT2TRS' : self.get_bit(ord(d[4:5]),3),
-					'NDHT2SUS' : self.get_bit(ord(d[4:5]),2),
-					'NDHT2RMT' : self.get_bit(ord(d[4:5]),1),
-					'NDHTPOEX' : ord(d[5:6]),
-					'RESERVED' : d[6:8],
-					'NDHTSECL' : self.EbcdicToAscii(d[8:16]),
-					'NDHTCNOD' : self.EbcdicToAscii(d[16:24]),
-					'NDHTSUSR' : self.EbcdicToAscii(d[24:32]),
-					'NDHTSNOD' : self.EbcdicToAscii(d[32:40]),
-					'NDHTSGRP' : self.EbcdicToAscii(d[40:48]),
-					'NDHTPOEN' : self.EbcdicToAscii(d[48:56]),
-					'RESERVED' : self.EbcdicToAscii(d[56:64]),
-					'NDHTOUSR' : self.EbcdicToAscii(d[64:72]),
-					'NDHTOGRP' : self.EbcdicToAscii(d[72:80]),
-				} )
-				d = d[job['NDHTLEN']:]
-
-
+		""" Returns the data set header (NDH) in d as a DatasetHeader. Fields are
+			decoded when they're read. """
+		self.records_log.debug("Dataset header")
+		job = njerecords.DatasetHeader(d, self.codec)
+		if self.records_log.isEnabledFor(logging.DEBUG):
+			self.records_log.debug("Length %s vs actual %s", job['NDHLEN'], len(d))
 		return job
 
-
-
 	def job_headers(self, d):
-		self.msg("Job header")
-
-		job = {
-			'NJHLEN' : struct.unpack(">H",d[0:2])[0],
-			'NJHFLAGS': d[2:3],
-			'NJHSEQ': d[3:4]
-			}
-
-		self.msg("Length {0} vs actual {1}".format(job['NJHLEN'], len(d)))
-		#Job Header General Section
-		d = d[4:]
-		header = d[2:3]
-		length = struct.unpack(">H",d[0:2])[0]
-
-		self.msg("Type: {0}".format(header))
-		self.msg(self.phex(d))
-		job.update( {
-		'NJHGLEN' : length,
-		'NJHGTYPE' : header,
-		'NJHGMOD' : d[3:4],
-		'NJHGJID' : struct.unpack(">h",d[4:6])[0], # Job identifier
-		'NJHGJCLS' : self.EbcdicToAscii(d[6:7]), # Job class
-		'NJHGMCLS' : self.EbcdicToAscii(d[7:8]), # Message class
-		'NJHGFLG1' : ord(d[8:9]),
-		'NJHGF1PR' : self.get_bit(ord(d[8:9]),7),
-		'NJHGF1CF' : self.get_bit(ord(d[8:9]),3),
-		'NJHGF1CA' : self.get_bit(ord(d[8:9]),2),
-		'NJHGF1PE' : self.get_bit(ord(d[8:9]),1),
-		'NJHGF1NE' : self.get_bit(ord(d[8:9]),0),
-		'NJHGPRIO' : ord(d[9:10]),
-		'NJHGORGQ' : d[10:11],
-		'NJHGJCPY' : d[11:12],
-		'NJHGLNCT' : d[12:13],
-		# d[13] = Reserved for IBM use
-		'NJHGHOPS' : d[14:16],
-		'NJHGACCT' : self.EbcdicToAscii(d[16:24]),
-		'NJHGJNAM' : self.EbcdicToAscii(d[24:32]),
-		'NJHGUSID' : self.EbcdicToAscii(d[32:40]),
-		'NJHGPASS' : self.EbcdicToAscii(d[40:48]),
-		'NJHGNPAS' : self.EbcdicToAscii(d[48:56]),
-		'NJHGETS'  : d[56:64],
-		'NJHGORGN' : self.EbcdicToAscii(d[64:72]),
-		'NJHGORGR' : self.EbcdicToAscii(d[72:80]),
-		'NJHGXEQN' : self.EbcdicToAscii(d[80:88]),
-		'NJHGXEQU' : self.EbcdicToAscii(d[88:96]),
-		'NJHGPRTN' : self.EbcdicToAscii(d[96:104]),
-		'NJHGPRTR' : self.EbcdicToAscii(d[104:112]),
-		'NJHGPUNN' : self.EbcdicToAscii(d[112:120]),
-		'NJHGPUNR' : self.EbcdicToAscii(d[120:128]),
-		'NJHGFORM' : self.EbcdicToAscii(d[128:136]),
-		'NJHGICRD' : struct.unpack(">i",d[136:140])[0],
-		'NJHGETIM' : struct.unpack(">i",d[140:144])[0],
-		'NJHGELIN' : struct.unpack(">i",d[144:148])[0],
-		'NJHGECRD' : struct.unpack(">i",d[148:152])[0],
-		'NJHGPRGN' : self.EbcdicToAscii(d[152:172]),
-		'NJHGROOM' : self.EbcdicToAscii(d[172:180]),
-		'NJHGDEPT' : self.EbcdicToAscii(d[180:188]),
-		'NJHGBLDG' : self.EbcdicToAscii(d[188:196]),
-		'NJHGNREC' : struct.unpack(">i",d[196:200])[0],
-		'NJHGJNO' : struct.unpack(">i",d[200:204])[0],
-		'NJHGNTYN' : self.EbcdicToAscii(d[204:212])
-		} )
-
-		self.msg("Msg Class: {0}".format(job['NJHGMCLS']))
-		self.msg("Job class: {0}".format(job['NJHGJCLS']))
-		self.msg("Accounting: {0}".format(job['NJHGACCT']))
-		self.msg("Job Name: {0}".format(job['NJHGJNAM']))
-		self.msg("UserID: {0}".format(job['NJHGUSID']))
-		self.msg("Origin Node: {0}".format(job['NJHGORGN']))
-		self.msg("Node User ID: {0}".format(job['NJHGORGR']))
-		self.msg("Execution Node: {0}".format(job['NJHGXEQN']))
-		d = d[length:]
-
-		while len(d) > 1:
-			self.msg("Current Remaining: {0}".format(len(d)))
-			self.msg(self.phex(d))
-			header = d[2:3]
-			if header == b"\x8A":
-				self.msg("Scheduling Section of the Job Header")
-				job['NJHELEN'] = struct.unpack(">h",d[0:2])[0]
-				job['NJHETYPE'] = d[2:3]
-				job['NJHEMOD'] = d[3:4]
-				job['NJHEPAGE'] = struct.unpack(">i",d[4:8])[0]
-				job['NJHEBYTE'] = struct.unpack(">i",d[8:12])[0]
-				d = d[job['NJHELEN']:]
-			elif header == b"\x8C":
-				self.msg("Security Section of the Job Header")
-				job['NJHTLEN'] = struct.unpack(">h",d[0:2])[0]
-				job['NJHTTYPE'] = d[2:3]
-				job['NJHTMOD'] = d[3:4]
-				job['NJHTLENP'] = struct.unpack(">h",d[4:6])[0]
-				job['NJHTFLG0'] = d[6:7]
-				#d[7] is reserved
-				d = d[8:]
-				job['NJHTLENT'] = struct.unpack("b",d[0:1])[0]
-				job['NJHTVERS'] = struct.unpack("b",d[1:2])[0]
-				job['NJHTFLG1'] = d[2:3]
-				job['NJHTSTYP'] = d[3:4]
-				job['NJHTFLG2'] = d[4:5]
-				job['NJHTPOEX'] = d[5:6]
-				#d[6:8] is reserved for IBM?
-				job['NJHTSECL'] = self.EbcdicToAscii(d[8:16])
-				job['NJHTCNOD'] = self.EbcdicToAscii(d[16:24])
-				job['NJHTSUSR'] = self.EbcdicToAscii(d[24:32])
-				job['NJHTSNOD'] = self.EbcdicToAscii(d[32:40])
-				job['NJHTSGRP'] = self.EbcdicToAscii(d[40:48])
-				job['NJHTPOEN'] = self.EbcdicToAscii(d[48:56])
-				# Reserved: d[56:64]
-				job['NJHTOUSR'] = self.EbcdicToAscii(d[64:72])
-				job['NJHTOGRP'] = self.EbcdicToAscii(d[72:80])
-				d = d[job['NJHTLENT']:]
-			elif header == b"\x8D":
-				self.msg("Job Accounting Section")
-				self.msg(self.phex(d))
-				job['NJHALEN'] = struct.unpack(">h",d[0:2])[0]
-				job['NJHATYPE'] = header
-				job['NJHAMOD'] = d[3:4]
-				job['NJHAOFFS'] = struct.unpack(">h",d[4:6])[0]
-				job['NJHAFLG1'] = d[6:7]
-				job['NJHAJLEN'] = d[8:8+job['NJHAOFFS']]
-				#These aren't document very well
-				job['NJHARecords'] = ord(d[8:9])
-				job['NJHATotal'] = ord(d[9:10])
-				job['NJHARecNum'] = ord(d[10:11])
-				job['NJHARecLen'] = ord(d[11:12])
-				job['NJHAJAC1'] = self.EbcdicToAscii(d[12:12+job['NJHARecLen']])
-				d = d[job['NJHALEN']:]
-
-			elif header == b"\x84":
-				self.msg("JES2 Section of the Job Header")
-				job['NJH2LEN'] = struct.unpack(">h",d[0:2])[0]
-				job['NJH2TYPE'] = d[2:3]
-				job['NJH2MOD'] = d[3:4]
-				job['NJH2FLG1'] = d[4:5]
-				job['NJH2ACCT'] = d[8:12]
-				job['NJH2USID'] = d[12:20]
-				job['NJH2USR'] = d[20:28]
-				job['NJH2GRP'] = d[28:36]
-				job['NJH2SUSR'] = d[36:44]
-				job['NJH2SGRP'] = d[44:52]
-				d = d[job['NJH2LEN']:]
+		""" Returns the job header (NJH) in d as a JobHeader. Fields are
+			decoded when they're read. """
+		self.records_log.debug("Job header")
+		job = njerecords.JobHeader(d, self.codec)
+		if self.records_log.isEnabledFor(logging.DEBUG):
+			self.records_log.debug("Length %s vs actual %s", job['NJHLEN'], len(d))
+			self.records_log.debug("%s", LazyHex(d))
+			self.records_log.debug("Msg Class: %s", job['NJHGMCLS'])
+			self.records_log.debug("Job class: %s", job['NJHGJCLS'])
+			self.records_log.debug("Accounting: %s", job['NJHGACCT'])
+			self.records_log.debug("Job Name: %s", job['NJHGJNAM'])
+			self.records_log.debug("UserID: %s", job['NJHGUSID'])
+			self.records_log.debug("Origin Node: %s", job['NJHGORGN'])
+			self.records_log.debug("Node User ID: %s", job['NJHGORGR'])
+			self.records_log.debug("Execution Node: %s", job['NJHGXEQN'])
 		return job
 
 	def job_footers(self, d):
-		self.msg("Job Trailer")
-		job = {
-			'NJTLEN'  : struct.unpack(">H",d[0:2])[0],
-			'NJTFLAGS': d[2:3],
-			'NJTSEQ'  : d[3:4]
-			}
-		self.msg("Total Length: {0}".format(job['NJTLEN']))
-		d = d[4:]
-		job.update( {
-			'NJTGLEN'  : struct.unpack(">h",d[0:2])[0],
-			'NJTGTYPE' : ord(d[2:3]),
-			'NJTGMOD'  : ord(d[3:4]),
-			'NJTGFLG1' : d[4:5],
-			'NJTGXCLS' : d[5:6],
-			'NJTGSTRT' : d[8:16],
-			'NJTGSTOP' : d[16:24],
-			'NJTGALIN' : struct.unpack(">i",d[28:32])[0],
-			'NJTGACRD' : struct.unpack(">i",d[32:36])[0],
-			'NJTGIXPR' : ord(d[40:41]),
-			'NJTGAXPR' : ord(d[41:42]),
-			'NJTGIOPR' : ord(d[42:43]),
-			'NJTGAOPR' : ord(d[43:44]),
-			'NJTGCOMP' : ord(d[44:45])
-			} )
+		""" Returns the job trailer (NJT) in d as a JobTrailer """
+		self.records_log.debug("Job Trailer")
+		job = njerecords.JobTrailer(d, self.codec)
+		if self.records_log.isEnabledFor(logging.DEBUG):
+			self.records_log.debug("Total Length: %s", job['NJTLEN'])
 		return job
 
 	def process_nmr(self, packet):
-		self.msg('Processing Operator command/console message')
-		d = packet['Data']
-
-		record = {}
-		# From http://www-01.ibm.com/support/knowledgecenter/SSB27U_5.4.0/com.ibm.zvm.v54.dmta7/hnmr.htm
-		#NMRFLAG
-		#record['NMRFLAG'] = ord(d[0])
-		record['NMRFLAG'] = d[0:1]
-		#NMRFLAGC EQU	B'10000000'		NMRMSG contains a command
-	#NMRFLAGW EQU	B'01000000'		NMROUT has JES2 RMT number
-	#NMRFLAGT EQU	B'00100000'		NMROUT has user ID
-	#NMRFLAGU EQU	B'00010000'		NMROUT has UCMID information
-	#NMRFLAGR EQU	B'00001000'		Console is only remote authorized
-	#NMRFLAGJ EQU	B'00000100'		Console not job authorized
-	#NMRFLAGD EQU	B'00000010'		Console not device authorized
-	#NMRFLAGS EQU	B'00000001'		Console not system authorized
-
-		record.update( {
-			'NMRFLAGC' : self.get_bit(record['NMRFLAG'],7),
-			'NMRFLAGW' : self.get_bit(record['NMRFLAG'],6),
-			'NMRFLAGT' : self.get_bit(record['NMRFLAG'],5),
-			'NMRFLAGU' : self.get_bit(record['NMRFLAG'],4),
-			'NMRFLAGR' : self.get_bit(record['NMRFLAG'],3),
-			'NMRFLAGJ' : self.get_bit(record['NMRFLAG'],2),
-			'NMRFLAGD' : self.get_bit(record['NMRFLAG'],1),
-			'NMRFLAGS' : self.get_bit(record['NMRFLAG'],0),
-		#   'NMRLEVEL' : (d[1] & 0xF0). to_bytes(1,"big"), 			
-			'NMRLEVEL' : my_to_bytes(d[1] & 0xF0),
-		#	'NMRPRIO'  : (d[1] & 0x0F).to_bytes(1,"big"),
-			'NMRPRIO'  : my_to_bytes(d[1] & 0x0F),	
-			'NMRTYPE'  : d[2:3],
-				#NMRTYPE
-			#NMRTYPEX EQU	B'11110000'		Reserved bits
-			#NMRTYPED EQU	B'00000001'		DOM (not supported)
-			#NMRTYPEF EQU	B'00000010'		Formatted command in NMRMSG
-			#NMRTYPET EQU	B'00000100'		Msg text only in NMRMSG
-			#NMRTYPE4 EQU	B'00001000'		Msg text contains control info
-			'NMRTYPEX' : my_to_bytes(d[2] & 0xF0),
-		#	'NMRTYPEX' : (d[2] & 0xF0).to_bytes(1,"big"),
-			'NMRTYPED' : self.get_bit(d[2:3], 0),
-			'NMRTYPEF' : self.get_bit(d[2:3], 1),
-			'NMRTYPET' : self.get_bit(d[2:3], 2),
-			'NMRTYPE4' : self.get_bit(d[2:3], 3),
-			'NMRML'	   : d[3:4],  #Length of the message
-			'NMRTONOD' : self.EbcdicToAscii(d[4:12]),
-			'NMRFMQUL' : d[12],
-			'NMROUT'   : d[13:21],
-			'NMRFMNOD' : self.EbcdicToAscii(d[21:29]),
-			'NMRTOQUL' : d[29]
-		} )
-
-
-		if not(record['NMRFLAGW'] or record['NMRFLAGT'] or record['NMRFLAGU']):
-			self.msg("Logical Routed Message")
-			#NMROUT format for logical routed msgs
-			# 0 NMRDESC  MCS descriptor codes
-			# 2 NMRROUT  MCS console routings
-			# 4 NMRDOMID MCS DOM ID
-			#self.msg("[NMROUT] MCS routing code: %r", record['NMROUT'])
-			record['NMRDESC']  = record['NMROUT'][0:2]
-			record['NMRROUT']  = record['NMROUT'][2:4]
-			record['NMRDOMID'] = record['NMROUT'][4:]
-		elif not(record['NMRFLAGW'] or record['NMRFLAGT']) and record['NMRFLAGU']:
-			self.msg("UCMID Message")
-			#NMROUT format for UCMID messages
-			#
-			# 0 NMRUCM   MCS console ID
-			# 1 NMRUCMA  MCS console area
-			# 2 NMRLINET Line type for MLWTO
-			# 4		 Spacer
-			record['NMRUCM']   = record['NMROUT'][0:1]
-			record['NMRUCMA']  = record['NMROUT'][1:2]
-			# Line Types:
-			# 0x8000 = First Line
-			# 0x2000 = Middle Line(s)
-			# 0x3000 = Last Line
-			# 0x9000 = Only line
-			self.msg("NMROUT: {0}".format(self.phex(record['NMROUT'])))
-			record['NMRLINET'] = struct.unpack("h",record['NMROUT'][2:4])[0]
-			self.msg("[NMROUT] MCS Console ID: {0}".format(record['NMRUCM']))
-			self.msg("[NMROUT] Line Type: {0} {1}".format(record['NMRLINET'], self.phex(record['NMROUT'][2:4])))
-		elif not(record['NMRFLAGW'] or record['NMRFLAGU']) and record['NMRFLAGT']:
-			self.msg("User Message")
-			# NMROUT format for user messages (NMRFLAGT on and NMRFLAGC off)
-			# NMRUSER Receiving user ID
-			record['NMRUSER'] = self.EbcdicToAscii(record['NMROUT'])
-			self.msg("[NMROUT] UserID: {0}".format(record['NMRUSER']))
-		elif not(record['NMRFLAGT'] or record['NMRFLAGU']) and record['NMRFLAGW']:
-			# NMROUT format for remote messages
-			# 0 NMRRMT Remote name 'RNNNNNNN'
-			self.msg("[NMROUT] Remote Workstation ID: {0}".format(record['NMROUT']))
-			record['NMRRMT'] = record['NMROUT']
-		elif (record['NMRFLAGT'] or record['NMRFLAGW']) and not record['NMRFLAGU']:
-			self.msg("[NMROUT] User ID / Remove Workstation ID: {0}".format(record['NMROUT']))
-
-
-		d = d[30:]
-		#Determining NMR Contents
-		if record['NMRFLAGC']:
-			if record['NMRTYPEF']:
-				self.msg("Type: Formatted Command")
-				#TO DO
+		""" Returns the operator command/console message in packet as an NmrRecord """
+		self.records_log.debug('Processing Operator command/console message')
+		record = njerecords.NmrRecord(packet['Data'], self.codec)
+		if self.records_log.isEnabledFor(logging.DEBUG):
+			keys = record.keys()
+			if 'NMRDESC' in keys:
+				self.records_log.debug("Logical Routed Message")
+			elif 'NMRUCM' in keys:
+				self.records_log.debug("UCMID Message")
+				self.records_log.debug("NMROUT: %s", LazyHex(record['NMROUT']))
+				self.records_log.debug("[NMROUT] MCS Console ID: %s", record['NMRUCM'])
+				self.records_log.debug("[NMROUT] Line Type: %s %s", record['NMRLINET'], LazyHex(record['NMROUT'][2:4]))
+			elif 'NMRUSER' in keys:
+				self.records_log.debug("User Message")
+				self.records_log.debug("[NMROUT] UserID: %s", record['NMRUSER'])
+			elif 'NMRRMT' in keys:
+				self.records_log.debug("[NMROUT] Remote Workstation ID: %s", record['NMROUT'])
 			else:
-				self.msg("Type: Unformatted Command")
-				#TO DO
-				record['NMRMSG'] = self.EbcdicToAscii(d[:record['NMRML'][0]])
-		else:
-			self.msg("Type: Message")
-			# Here's the actual contents of the message!
-			record['NMRMSG'] = self.EbcdicToAscii(d[:record['NMRML'][0]])
-			if not(record['NMRTYPE4'] or record['NMRTYPET']):
-				record['timestamp'] = record['NMRMSG'][0:8]
-			elif record['NMRTYPE4'] and not record['NMRTYPET']:
-				record['timestamp'] = record['NMRMSG'][0:8]
-				record['NMRECSID'] = record['NMRMSG'][8:16]
-			elif record['NMRTYPE4'] and record['NMRTYPET']:
-				record['NMRECSID'] = record['NMRMSG'][0:8]
-
+				self.records_log.debug("[NMROUT] User ID / Remove Workstation ID: %s", record['NMROUT'])
+			if not record['NMRFLAGC']:
+				self.records_log.debug("Type: Message")
+			elif record['NMRTYPEF']:
+				self.records_log.debug("Type: Formatted Command")
+			else:
+				self.records_log.debug("Type: Unformatted Command")
 		return record
 
 	def get_bit(self, Bbyte, i):
@@ -1491,7 +1690,7 @@ class NJE:
 		# Here's the next important parts: NJHTOUSR and NJHTOGRP
 		# Using these two fields we can specify any userid and group we want.
 		# The default is IBMUSER and SYS1.
-		self.msg("Setting Target User/Group: {0}/{1}".format(userid.upper(), group.upper()))
+		self.msg("Setting Target User/Group: %s/%s", userid.upper(), group.upper())
 		sec_subsec += NJHTOUSR + NJHTOGRP
 		sec_header = sec_prefix + sec_subsec
 
@@ -1520,93 +1719,19 @@ class NJE:
 
 	def makeSCB(self, buf):
 		''' Implements SCB compression. Returns a tuple of compressed bytes and
-			the number of bytes remaining in buf. '''
-
-	# This version implements compression better than IBM for some reason.
-
-		# String Control Byte				(Pg 123)
-		# More information available here:
-		# http://www-01.ibm.com/support/knowledgecenter/SSLTBW_2.1.0/com.ibm.zos.v2r1.hasa600/nscb.htm
-
-		self.msg("Compressing {0} bytes using \"String Control Byte\" compression".format(len(buf)))
-		self.msg("Raw Message before compression: {0}".format(self.phex(buf)))
-
-		#self.msg("Recieved: %r", self.phex(buf))
-		if len(buf) == '':
-			return ''
-		ebc_space = bytes(" ".encode('EBCDIC-CP-BE')) # byte representation of EBCDIC space (0x40, ascii @ ) 
-		processed_bytes = 0
-		c = 0
-		d = b'' # The compressed data < 252 bytes
-		t = b'' # Temp data while we count
-#		print(self.phex(buf))
-		while len(buf) > 0 and processed_bytes < 253:
-			if buf[0:1] == ebc_space and buf[1:2] == ebc_space:
-				if c > 0:
-#					d += (0xC0 + c).to_bytes(1,"big") + t # If we go straight from repeat char to repeat spaces this creates an extra char
-					d += my_to_bytes(0xC0 + c) + t # If we go straight from repeat char to repeat spaces this creates an extra char
-				t = b''
-				c = 1
-				while c < len(buf) and (buf[c:c+1] == ebc_space and (processed_bytes + c < 253)):
-					if c == 31: 
-						break
-					c += 1
-#				d += (0x80 + c).to_bytes(1,"big")
-				d += my_to_bytes(0x80 + c)
-				#self.msg("Repeated %r %i times", buf[0], c)
-				buf = buf[c-1:]
-				processed_bytes += c
-				c = 0
-			elif len(buf) > 2 and buf[0:1] == buf[2:3] and buf[0:1] == buf[1:2]:
-				if c > 0: 
-#					d += (0xC0 + c).to_bytes(1,"big") + t # Same as above. This if fixes that
-					d += my_to_bytes(0xC0 + c) + t # Same as above. This if fixes that
-				t = b''
-				c = 2
-				while c < len(buf) and ( buf[c:c+1] == buf[0:1] and (processed_bytes + c < 253) ):
-					if c == 31: 
-						break
-					c += 1
-#				d += (0xA0 + c).to_bytes(1,"big") + buf[0:1]
-				d += my_to_bytes(0xA0 + c) + buf[0:1]
-				buf = buf[c-1:]
-				processed_bytes += c
-				c = 0
-			elif c == 63:
-#				d += (0xC0 + c).to_bytes(1,"big") + t
-				d += my_to_bytes(0xC0 + c) + t
-				t = b''
-				processed_bytes += c
-				c = 0
-			else:
-				t += buf[0:1]
-				c += 1
-				processed_bytes += 1
-
-			buf = buf[1:]
-			#print(self.phex(d))
-		if c > 0: 
-#			d += (0xC0 + c).to_bytes(1,"big") + t
-			d += my_to_bytes(0xC0 + c) + t
-		self.msg("Total bytes: {0} compressed to {1}".format(processed_bytes, len(d)))
-		#self.msg("Remaining bytes: %i", len(buf))
-		self.msg("Compressed: {0}".format(self.phex(d)))
-		# print(d+b'\x00', len(buf))
-		# sys.exit(99)
-		return (d+b'\x00', len(buf))
+			the number of bytes remaining in buf. Use scb_segments() to compress
+			data of any size in one go. '''
+
+		self.compress_log.debug("Compressing %s bytes using \"String Control Byte\" compression", len(buf))
+		self.compress_log.debug("Raw Message before compression: %s", LazyHex(buf))
+		d = next(scb_segments(memoryview(buf)[:SCB_MAX]))
+		remaining = max(len(buf) - SCB_MAX, 0)
+		self.compress_log.debug("Total bytes: %s compressed to %s", len(buf) - remaining, len(d))
+		self.compress_log.debug("Compressed: %s", LazyHex(d))
+		return (d, remaining)
 
 	def compressed(self, RCB_bytes):
-		# print(type(RCB_string))
-		# print(RCB_string)
-		# sys.exit(-3)
-		#RCB = ord(RCB_string)
-		#RCB = ord(RCB_string)
-##		RCB = int.from_bytes(RCB_bytes,"big")
-		RCB = my_from_bytes(RCB_bytes)
-		if (RCB == 0x9A) or ((RCB & 0x0F) == 0x08) or ((RCB & 0x0F) == 0x09):
-			return True
-		else:
-			return False
+		return scb_compressed(my_from_bytes(RCB_bytes))
 
 
 	def readSCB(self, data):
@@ -1615,93 +1740,296 @@ class NJE:
 			the ammount of bytes processed. 0x00 represents the end of an
 			NJE record """
 
-		# initialize our vars
-		buf = b''  #output buffer
-		skip = 0
-		count = 0
-		b = 0      # len of final buffer
-		i = 0      # counter
-		repeat = False   # identify repeating segments to unpack
-		lenData = len(data)
-		ebc_space = bytes(" ".encode('EBCDIC-CP-BE')) # byte representation of EBCDIC space (0x40, ascii @ ) 
-
-		for i in range(0,lenData):
-			iByte = data[i:i+1] # get current byte
-			b += 1              # increment length of final buffer
-			if skip > 0:
-				skip -= 1
-				buf += iByte
-				continue
-			if repeat:
-				#self.msg("Char %r repeats %r times", self.phex(i), count)
-				buf += iByte * count
-				repeat = False
-				continue
-			#SCB = ord(i)
-##			SCB = int.from_bytes(iByte,"big")
-			SCB = my_from_bytes(iByte)
-			SCB_type = SCB & 0xC0
-			#self.msg("Current Char: %r, Count: %r, Type: %r", self.phex(i), (SCB & 0x3F), self.phex(chr(SCB_type)))
-			if SCB_type == 0x00:
-				#self.msg("End of Record. Total Processed: %i", b)
-				break
-			elif SCB_type == 0xC0:
-				skip = SCB & 0x3F
-				#self.msg("Type 0xC0: %r Uncompressed chars follow", skip)
-			elif SCB_type == 0x80:
-				#self.msg("Either of type b'101' (chars) or b'100' (blanks aka 0x40): %r", self.phex(i))
-				sub_type = SCB & 0xE0
-				count = SCB & 0x1F
-				if sub_type == 0xA0:
-					repeat = True
-				else:
-					#self.msg("%i spaces added", count)
-					buf += ebc_space * count
-
-		self.msg("Decompressed {0} bytes to {1} bytes".format(b, len(buf)))
-		return (buf, b)
+		buf = bytearray()
+		processed = scb_decode_into(data, buf)[0]
+		self.compress_log.debug("Decompressed %s bytes to %s bytes", processed, len(buf))
+		return (bytes(buf), processed)
+
+	def set_store(self, policy='unbounded', limit=None, directory=None):
+		""" Sets how this session keeps the NMR, SYSIN and SYSOUT records it
+			receives. policy is one of:
+				'unbounded' - keep everything (default)
+				'ring'      - keep the newest limit records of each kind
+				              (10000 by default)
+				'spill'     - keep limit bytes of each kind in memory (16 MB
+				              by default) and pickle the rest to a temporary
+				              file in directory
+			Records already received are thrown away. """
+		for store in ('nmr', 'sysin', 'sysout'):
+			old = getattr(self, store, None)
+			if old is not None:
+				old.clear()
+			setattr(self, store, njestore.make_store(policy, limit, directory))
+
+	def set_spool(self, directory, raw=False):
+		""" Writes SYSOUT to one file per spool data set in directory instead
+			of keeping it in getSYSOUT(). In raw mode the EBCDIC records are
+			written untouched with an RDW in front of each one. Pass None
+			to go back to keeping SYSOUT in memory. """
+		if self.spool is not None:
+			self.spool.close()
+		self.spool = njespool.SpoolWriter(directory, raw) if directory else None
+		return self.spool
 
 	def getNMR(self):
-		""" Returns NRM an array of dictionaries """
-		return NMR
+		""" Returns the store of NMR records. It works like a list, use
+			drain() or consume() to take the records out. """
+		return self.nmr
 
 	def getSYSIN(self):
-		""" Returns SYSIN an array of dictionaries """
-		return SYSIN
+		""" Returns the store of SYSIN records """
+		return self.sysin
 
 	def getSYSOUT(self):
-		""" Returns SYSOUT an array of dictionaries """
-		return SYSOUT
-
-	def sendMessage(self, message, user=''):
+		""" Returns the store of SYSOUT records """
+		return self.sysout
+
+	def drain(self):
+		""" Returns (NMR, SYSIN, SYSOUT) lists of every record received so
+			far and empties the stores """
+		return (self.nmr.drain(), self.sysin.drain(), self.sysout.drain())
+
+	def sendMessage(self, message, user='', signoff=True, wait=None):
+		""" Sends message to user (or the console). Returns True as soon as
+			it's written to the socket, or with wait waits up to that many
+			seconds for a reply NMR and returns its text (False if none
+			came). Pass signoff=False to keep the session open. """
 		msg = "Sending Message: " + message
 		if user:
 			msg += " to user " + user.upper()
 		self.msg(msg)
-		msg = self.sendNMR(message, False, user)
-		time.sleep(5)
-		self.signoff()
-
-	def sendCommand(self, command):
-		""" uses 'command' to create a node message record (NMR) and sends it """
-		self.msg("Sending command: {0}".format(command))
-		self.sendNMR(command, True)
-		self.records = self.processData(self.getData())
-		self.process_RCB()
+		return self.sendMessages([(message, user)], signoff=signoff, wait=wait)
+
+	def sendMessages(self, messages, user='', signoff=True, wait=None):
+		""" Sends many messages at once, packed into as few transmission
+			blocks as they fit in. messages holds strings, sent to user,
+			or (message, user) tuples. Returns True once they're written
+			to the socket, or with wait the text of the replies that
+			arrived within wait seconds (False if none did). NJE doesn't
+			acknowledge NMRs, so True doesn't mean the other node got them;
+			signing off (which waits for the other side to close) is what
+			makes sure they were read. """
+		records = []
+		for message in messages:
+			to = user
+			if not isinstance(message, str):
+				message, to = message
+			records.append({'RCB': b"\x9A", 'SRCB': b"\x00", 'Data': self.nmr_record(message, False, to)})
+		self.msg("Sending %s messages", len(records))
+		self.replies = [] if wait else None
+		try:
+			self.sendNJE_multiple(records)
+			result = self.wait_replies(wait) if wait else True
+		finally:
+			self.replies = None
+		if signoff:
+			self.signoff()
+		return result
+
+	def wait_replies(self, wait):
+		""" Processes what arrives until an NMR turns up in self.replies or
+			wait seconds have passed. Returns the text of the replies. """
+		deadline = time.monotonic() + wait
+		timeout = self.sock.gettimeout() if self.sock else None
+		try:
+			while self.sock and not self.replies:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					break
+				self.sock.settimeout(remaining)
+				self.receive()
+		finally:
+			if self.sock:
+				self.sock.settimeout(timeout)
+		return self.command_reply(self.replies)
+
+	def sendCommand(self, command, signoff=True, wait=None):
+		""" uses 'command' to create a node message record (NMR), sends it
+			and returns the reply. The reply is whatever has arrived once its
+			first block is in; with wait, blocks that come in within wait
+			seconds of each other are added to it too. Pass signoff=False to
+			keep the session open for the next operation. """
+		self.msg("Sending command: %s", command)
+		self.replies = []
+		try:
+			self.sendNMR(command, True)
+			self.records = self.processData(self.getData())
+			self.process_RCB()
+			# Multi-line replies can span several blocks
+			self.records = self.processData(self.getMoreData(wait))
+			self.process_RCB()
+			message = self.command_reply(self.replies)
+		finally:
+			self.replies = None
+		if signoff:
+			self.signoff()
+		return message
+
+	def command_reply(self, records=None):
+		""" Returns the text of the NMRs in records (by default every NMR
+			received so far), or False if there aren't any """
+		if records is None:
+			records = self.getNMR()
 		message = ''
-		for record in self.getNMR():
+		for record in records:
 			for i in record:
-				self.msg("record[{0}]: {1}".format(i, record[i]))
+				self.msg("record[%s]: %s", i, record[i])
 			if 'NMRMSG' in record:
-				message += record['NMRMSG'].decode('ascii') + "\n"
-		self.signoff()
+				message += record['NMRMSG'].decode('latin-1') + "\n"
 		if len(message) <= 0:
 			return False
 		else:
 			return message
 
-	def sendJCL(self, filename, userid='ibmuser', group='sys1'):
-		""" sends JCL file as user """
+	def route_sysout(self, record, RCB):
+		""" Hands a SYSOUT record that came in on stream RCB to the job it
+			belongs to. Returns False if it isn't one of our jobs. """
+		stream = self.streams.get(RCB)
+		if stream is None:
+			return False
+		job = stream.job
+		if job is None:
+			job = self.claim_job(record)
+			if job is None:
+				return False
+			stream.job = job
+		job.feed(record)
+		if job.keep:
+			self.sysout.append(record)
+		if job.done:
+			self.jobs.remove(job)
+			stream.job = None
+		return True
+
+	def claim_job(self, record):
+		""" Returns the waiting job a job header starts the output of: the
+			one with the header's job number (NJHGJID), else the first one
+			with its job name (NJHGJNAM). None if there isn't one, the
+			output then only goes to the session's SYSOUT store. """
+		if not isinstance(record, njerecords.JobHeader):
+			return None
+		for job in self.jobs:
+			if job.header is None and job.number == record['NJHGJID']:
+				return job
+		waiting = [job for job in self.jobs if job.sent and job.header is None]
+		if not waiting:
+			return None
+		name = record['NJHGJNAM'].strip().decode('latin-1')
+		for job in waiting:
+			if job.name == name:
+				return job
+		return None
+
+	def route_nmr(self, record):
+		""" Adds an NMR to the messages of the waiting job it mentions """
+		if 'NMRMSG' not in record:
+			return
+		for job in self.jobs:
+			if job.mentioned(record['NMRMSG']):
+				job.messages.append(record)
+				return
+
+	def receive(self):
+		""" Reads the next block(s) off the wire, processes the records and
+			sends whatever queued jobs can go now. Returns False if nothing
+			arrived. Holds the I/O lock throughout, so the keepalive thread
+			can't process records in between. """
+		with self.io_lock:
+			data = self.getData()
+			self.records = self.processData(data)
+			self.process_RCB()
+			self.pump()
+		return bool(data)
+
+	def next_job_number(self):
+		""" Hands out job numbers for the JOB cards we send, 49 onwards """
+		self.job_number = self.job_number % MAX_JOB_NUMBER + 1
+		return self.job_number
+
+	def open_stream(self):
+		""" Allocates a free SYSIN stream and asks for permission to use it.
+			Returns the stream or None if all of them are in use. """
+		stream = self.streams.allocate()
+		if stream is None:
+			self.msg("All %s SYSIN streams are in use", len(njestreams.SYSIN_RCBS))
+			return None
+		self.request_stream(my_to_bytes(stream.rcb))
+		return stream
+
+	def pump(self):
+		""" Asks for a stream for each queued job while there are free ones,
+			then sends the records of every stream we got permission for,
+			interleaved in shared transmission blocks """
+		while self.queue and self.sock and self.streams.free():
+			job, records = self.queue.popleft()
+			stream = self.open_stream()
+			stream.job = job
+			stream.queue(records)
+		ready = [stream for stream in self.streams if stream.sysin and stream.state == njestreams.ACTIVE]
+		if ready:
+			self.send_streams(ready)
+
+	def send_streams(self, streams):
+		""" Sends the queued records of streams interleaved in shared
+			transmission blocks, each stream ending with its end of file record """
+		self.sendNJE_multiple(self.streams.interleave(streams))
+
+	def enqueue(self, filename, userid='ibmuser', group='sys1', keep=False, timeout=None, callback=None):
+		""" Adds JCL file to the submission queue and returns its Job handle.
+			Queued jobs go out back to back, up to seven at a time, whenever
+			the session reads from the other node (receive(), iterating a
+			job, send_queue()). job.future is resolved with the job once its
+			output is complete and callback(job) is called then too. """
+		num, name, records = self.jcl_records(filename, userid, group)
+		job = Job(self, num, name, keep, timeout, callback)
+		self.queue.append((job, records))
+		self.jobs.append(job)
+		self.pump()
+		return job
+
+	def queued(self, jobs=None):
+		""" True while any of jobs (or any job at all) hasn't been sent """
+		if jobs is None:
+			return bool(self.queue) or any(not job.sent for job in self.jobs)
+		return any(not (job.sent or job.done) for job in jobs)
+
+	def send_queue(self, jobs=None):
+		""" Processes what arrives until jobs (or everything in the queue)
+			has been sent or nothing more comes in """
+		while self.sock and self.queued(jobs):
+			if not self.receive():
+				break
+
+	def sendJCL(self, filename, userid='ibmuser', group='sys1', signoff=True):
+		""" sends JCL file as user and waits for the job's output, which
+			ends up in getSYSOUT(). Pass signoff=False to keep the session
+			open for the next operation. """
+		job = self.submit(filename, userid, group, keep=True)
+		job.wait()
+		if signoff:
+			self.signoff()
+		return job
+
+	def submit(self, filename, userid='ibmuser', group='sys1', keep=False, timeout=None, callback=None):
+		""" Sends JCL file as user and returns a Job handle as soon as the
+			job is sent. Iterate over the handle to get the job's SYSOUT
+			records as they arrive. Unless keep is set they don't go into
+			getSYSOUT(). """
+		job = self.enqueue(filename, userid, group, keep, timeout, callback)
+		self.send_queue([job])
+		return job
+
+	def submit_all(self, filenames, userid='ibmuser', group='sys1', keep=False, timeout=None, callback=None):
+		""" Sends several JCL files back to back over parallel SYSIN
+			streams, with their records sharing transmission blocks.
+			Returns the list of Job handles once they're all sent. """
+		jobs = [self.enqueue(filename, userid, group, keep, timeout, callback) for filename in filenames]
+		self.send_queue(jobs)
+		return jobs
+
+	def jcl_records(self, filename, userid='ibmuser', group='sys1'):
+		""" Reads JCL file and returns (job number, job name, records) with
+			the SYSIN records that submit it as user """
 		self.msg("Processing JCL file")
 
 		with open (filename, "r") as myfile:
@@ -1717,68 +2045,86 @@ class NJE:
 				break
 
 
-		job = header.strip()[2:10]
+		job = header[2:].split()[0]
 		acc = header[header.find("(")+1:header.find(")")]
 		quoted = re.compile("(?<=')[^']+(?=')")
 		prog = quoted.findall(header)[0]
 
 		self.msg("Creating SYSIN Headers with the following:")
-		self.msg("Job Name: {0}".format(job))
-		self.msg("Accounting: {0}".format(acc))
-		self.msg("Programmer: {0}".format(prog))
-		self.msg("UserID: {0}".format(userid))
-		self.msg("Group: {0}".format(group))
+		self.msg("Job Name: %s", job)
+		self.msg("Accounting: %s", acc)
+		self.msg("Programmer: %s", prog)
+		self.msg("UserID: %s", userid)
+		self.msg("Group: %s", group)
 
 		jcl = []
-		jcl.append(data[0].strip("\n") + " " * (72 - len(data[0].strip("\n"))) + "JOB00049" )
+		num = self.next_job_number()
+		jcl.append(data[0].strip("\n") + " " * (72 - len(data[0].strip("\n"))) + "JOB{0:05d}".format(num))
 		jcl += data[1:]
-		num = int(jcl[0][-5:])
-		self.msg("Job Number: {0}".format(num))
+		self.msg("Job Number: %s", num)
 		jcl_class = "A"
 		msg_class = "K"
 		nje_jcl = self.makeSYSIN_header(len(jcl), num, prog, jcl_class, msg_class, job, acc, userid, group)
 		records = []
 		records.append({'RCB':b"\x98",'SRCB':b"\xC0", 'Data':nje_jcl})
-		for line in jcl:
-			self.msg("[JCL] Len {0}: {1}".format(len(line.strip("\n")), line.strip("\n")))
-			records.append({'RCB':b"\x98",'SRCB':b"\x80", 'Data':b"\x50"+ self.AsciiToEbcdic(line.strip("\n"))})
+		lines = [line.strip("\n") for line in jcl]
+		for line, ebcdic_line in zip(lines, self.codec.encode_records(lines)):
+			self.msg("[JCL] Len %s: %s", len(line), line)
+			records.append({'RCB':b"\x98",'SRCB':b"\x80", 'Data':b"\x50"+ ebcdic_line})
 
 		records.append({'RCB':b"\x98",'SRCB':b"\xD0", 'Data':self.makeSYSIN_footer()})
-
-		# Step 1: Tell the mainframe we're making a stream
-		self.request_stream()
-		self.records = self.processData(self.getData())
-		self.process_RCB()
-		# Step 2: Send the stream (SYSIN)
-		self.sendNJE_multiple(records)
-		# Step 3: Close the stream
-		self.sendNJE(b"\x98", b"\x00",b"\x00\x00")
-		self.records = self.processData(self.getData())
-		self.process_RCB()
-
-		while len(self.getSYSOUT()) <= 0:
-			self.records = self.processData(self.getData())
-			self.process_RCB()
-		self.signoff()
+		return (num, job, records)
 
 	def dumbClient(self):
 		""" Connects to an NJE server and does nothing """
 		self.msg("Starting Dumb Client")
-		while True:
+		while self.sock:
 			self.records = self.processData(self.getData())
 			self.process_RCB()
 
-	def analyze(self, njefile):
-		with open (njefile, "r") as myfile:
-			data=myfile.read()
-		self.msg("Length: {0}".format(len(data)))
-		self.msg('Raw Bytes as Hex:')
-		self.msg(" >> {0}".format(self.phex(data)))
-		self.records = self.processData(data)
-		self.process_RCB()
-		for i in self.records:
-			for x in i:
-				self.msg("nje.records["+x+"] : {0}".format(i[x]))
+	def analyze(self, njefile, ports=None):
+		""" Decodes the NJE records in njefile, either raw NJE data or a pcap
+			or pcapng capture (only the TCP ports in ports are followed,
+			175 and 2252 by default). The file is read a piece at a time. """
+		with open (njefile, "rb") as myfile:
+			if njepcap.is_capture(myfile.read(4)):
+				myfile.seek(0)
+				self.analyze_capture(myfile, ports or njepcap.NJE_PORTS)
+				return
+			myfile.seek(0)
+			while True:
+				data = myfile.read(RECV_SIZE)
+				if not data:
+					break
+				self.wire_log.debug("Length: %s", len(data))
+				self.wire_log.debug('Raw Bytes as Hex:')
+				self.wire_log.debug(" >> %s", LazyHex(data))
+				self.records = self.parser.feed(data)
+				self.process_RCB()
+
+	def analyze_capture(self, capture, ports=None):
+		""" Stores the NMR, SYSIN and SYSOUT records of every NJE connection
+			in an open capture file """
+		for found in njepcap.records(capture, ports or njepcap.NJE_PORTS, self.codec.codepage):
+			self.records_log.debug("%s:%s > %s:%s RCB %02X", found.flow.src, found.flow.sport,
+						found.flow.dst, found.flow.dport, found.RCB)
+			self.store_record(found.RCB, found.record)
+
+	def analyze_files(self, paths, workers=None, ports=None):
+		""" Decodes raw NJE and capture files on a pool of worker processes
+			(one per core if workers is None) and stores their records in
+			timestamp order. See njeparallel. """
+		for path, found in njeparallel.records(paths, workers, ports, self.codec.codepage):
+			self.store_record(found.RCB, found.record)
+
+	def store_record(self, RCB, record):
+		""" Stores an NMR, SYSIN or SYSOUT record decoded offline """
+		if RCB == 0x9A:
+			self.nmr.append(record)
+		elif (RCB & 0x0F) == 0x08:
+			self.sysin.append(record)
+		else:
+			self.sysout.append(record)
 
 def test():
 	"""Test program for njelib.
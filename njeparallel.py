@@ -0,0 +1,169 @@
+#!/usr/bin/python
+
+## Parallel offline analysis for njelib
+#
+# Decoding NJE records (TCP reassembly, SCB decompression, spanned
+# records) is pure Python and runs on one core. This spreads the work of
+# analysing one or more files over a process pool: every raw NJE file is
+# one piece of work and every capture file is split further by TCP
+# connection, each worker following only the connections of its shard.
+#
+#	for path, found in njeparallel.records(["mon.pcapng", "tue.pcapng"], workers=8):
+#		print(path, found.time, found.record)
+#
+# Workers write the decompressed payload of each record (not record
+# objects) to a temporary file, in runs sorted by timestamp, and send back
+# only where the runs are. The runs of all the pieces are then merged a
+# record at a time, so memory use doesn't grow with the size of the files.
+# Records from raw NJE files have no timestamp and come first, in file
+# order.
+#
+#########
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########
+
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import os
+import pickle
+import tempfile
+
+import ebcdic
+import njelib
+import njepcap
+
+SHARDS_PER_WORKER = 2 # Capture files are split in this many shards per worker, so a busy connection doesn't hold up the rest
+RUN_RECORDS = 10000 # Records a worker sorts in memory at a time
+
+log = logging.getLogger('njelib.parallel')
+
+def raw_payloads(path):
+	""" Yields (flow, time, offset, seq, RCB, SRCB, data) for the records of
+		a raw NJE file. There's no flow, time or seq; offset is where the
+		piece of the file that completed the record's block starts. """
+	parser = njelib.NJEParser()
+	decoder = njepcap.Decoder()
+	offset = 0
+	with open(path, 'rb') as f:
+		while True:
+			data = f.read(njelib.RECV_SIZE)
+			if not data:
+				break
+			for RCB, SRCB, payload in decoder.payloads(parser.feed(data)):
+				yield None, None, offset, None, RCB, SRCB, payload
+			offset += len(data)
+
+def sort_key(entry):
+	time = entry[1]
+	return (-1.0 if time is None else time, entry[2])
+
+def decode(path, shard, ports, directory=None):
+	""" Worker: decodes one shard of one file into a temporary file in
+		directory and returns (file name, runs). Every run is an
+		(offset, count) of payloads pickled one after the other, sorted by
+		time. Chunks of RUN_RECORDS payloads are sorted in memory and a
+		chunk that carries on in order from the one before joins its run,
+		so a capture that's in time order is one run. shard is
+		(index, count) for captures and None for raw NJE files. """
+	if shard is None:
+		found = raw_payloads(path)
+	else:
+		found = njepcap.payloads(path, ports, shard)
+	runs = []
+	last = None
+	total = 0
+	with tempfile.NamedTemporaryFile(prefix='njelib-', suffix='.runs', dir=directory, delete=False) as spill:
+		while True:
+			chunk = list(itertools.islice(found, RUN_RECORDS))
+			if not chunk:
+				break
+			chunk.sort(key=sort_key)
+			if last is not None and sort_key(chunk[0]) >= last:
+				runs[-1][1] += len(chunk)
+			else:
+				runs.append([spill.tell(), len(chunk)])
+			for entry in chunk:
+				pickle.dump(entry, spill, pickle.HIGHEST_PROTOCOL)
+			last = sort_key(chunk[-1])
+			total += len(chunk)
+	log.debug("%s shard %s: %s records in %s runs", path, shard, total, len(runs))
+	return spill.name, [tuple(run) for run in runs]
+
+def read_run(name, offset, count):
+	""" Yields the count payloads of the run at offset in file name """
+	with open(name, 'rb') as f:
+		f.seek(offset)
+		for _ in range(count):
+			yield pickle.load(f)
+
+def tasks(paths, shards):
+	""" (path, shard) for every piece of work in paths """
+	for path in paths:
+		with open(path, 'rb') as f:
+			capture = njepcap.is_capture(f.read(4))
+		if capture:
+			for index in range(shards):
+				yield path, (index, shards)
+		else:
+			yield path, None
+
+def payloads(paths, workers=None, ports=None, shards=None, directory=None):
+	""" Yields (path, (flow, time, offset, seq, RCB, SRCB, data)) for every NMR,
+		SYSIN and SYSOUT record in paths, in timestamp order. workers is
+		the number of processes (all cores if None, 1 decodes in this
+		process), ports the TCP ports to follow (175 and 2252 if None),
+		shards the number of pieces each capture is split in and directory
+		where the temporary files of decoded records go. """
+	if isinstance(paths, str):
+		paths = [paths]
+	ports = ports or njepcap.NJE_PORTS
+	workers = workers or os.cpu_count() or 1
+	if shards is None:
+		shards = 1 if workers == 1 else workers * SHARDS_PER_WORKER
+	work = list(tasks(paths, shards))
+	log.info("Decoding %s files in %s pieces with %s workers", len(paths), len(work), workers)
+	results = []
+	try:
+		if workers == 1:
+			for path, shard in work:
+				results.append(decode(path, shard, ports, directory))
+		else:
+			with concurrent.futures.ProcessPoolExecutor(min(workers, len(work) or 1)) as pool:
+				futures = [pool.submit(decode, path, shard, ports, directory) for path, shard in work]
+				for future in futures:
+					results.append(future.result())
+		tagged = [with_path(path, read_run(name, offset, count))
+			for (path, shard), (name, runs) in zip(work, results) for offset, count in runs]
+		yield from heapq.merge(*tagged, key=lambda tagged: sort_key(tagged[1]))
+	finally:
+		for name, runs in results:
+			try:
+				os.remove(name)
+			except OSError:
+				pass
+
+def with_path(path, entries):
+	for entry in entries:
+		yield path, entry
+
+def records(paths, workers=None, ports=None, codepage=ebcdic.DEFAULT_CODEPAGE, shards=None, directory=None):
+	""" Yields (path, FlowRecord) for every NMR, SYSIN and SYSOUT record in
+		paths, in timestamp order, see payloads() """
+	decoder = njepcap.Decoder(codepage)
+	for path, (flow, time, offset, seq, RCB, SRCB, data) in payloads(paths, workers, ports, shards, directory):
+		yield path, njepcap.FlowRecord(flow, time, offset, RCB, decoder.record(RCB, SRCB, data), seq)
@@ -0,0 +1,488 @@
+#!/usr/bin/python
+
+## Capture file reader used by njelib
+#
+# Reads pcap and pcapng files (Wireshark, tcpdump, network taps) without
+# any third party modules, puts the TCP streams on the NJE ports (175 and
+# 2252 for TLS-less NJE over TCP/IP by default) back together and hands
+# each direction of each connection to its own NJEParser:
+#
+#	for found in njepcap.records("tap.pcapng"):
+#		print(found.flow, found.time, found.record)
+#
+# The file is read one packet at a time and only the out of order data
+# and partial blocks of open connections are kept, so memory use doesn't
+# grow with the size of the capture. Every record comes with the flow it
+# was seen on, the time of the packet that completed its block and the
+# offset in the file to read from to get its block back (the packet the
+# block started in, or an earlier one when packets came out of order).
+#
+#########
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########
+
+import collections
+import itertools
+import logging
+import socket
+import struct
+import zlib
+
+import ebcdic
+import njelib
+
+NJE_PORTS = (175, 2252)
+MAX_PENDING = 4 * 1024 * 1024 # Out of order bytes kept per direction before giving up on a gap
+
+# pcap
+PCAP_MAGIC = {
+	b'\xa1\xb2\xc3\xd4': ('>', 1e-6), b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+	b'\xa1\xb2\x3c\x4d': ('>', 1e-9), b'\x4d\x3c\xb2\xa1': ('<', 1e-9) }
+PCAP_HEADER_LEN = 24
+PCAP_RECORD_LEN = 16
+
+# pcapng
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+SECTION_HEADER = 0x0A0D0D0A
+INTERFACE = 0x00000001
+OLD_PACKET = 0x00000002
+SIMPLE_PACKET = 0x00000003
+ENHANCED_PACKET = 0x00000006
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+OPT_TSRESOL = 9
+OPT_TSOFFSET = 14
+
+# Link layer types
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8, 0x9100)
+IPV6_SKIPPED = (0, 43, 60) # hop-by-hop, routing and destination options headers
+IPV6_FRAGMENT = 44
+TCP = 6
+
+# TCP flags
+FIN = 0x01
+SYN = 0x02
+RST = 0x04
+
+U16 = struct.Struct('>H')
+TCP_HEADER = struct.Struct('>HHIIBB')
+
+# First 8 bytes of the OPEN/ACK/NAK control record, which isn't in a TTB
+CONTROL_TYPES = tuple(ebcdic.Codec().encode(word.ljust(8)) for word in ('OPEN', 'ACK', 'NAK'))
+
+Packet = collections.namedtuple('Packet', 'time linktype data offset')
+Flow = collections.namedtuple('Flow', 'src sport dst dport')
+FlowBlock = collections.namedtuple('FlowBlock', 'flow time offset seq block')
+FlowRecord = collections.namedtuple('FlowRecord', 'flow time offset RCB record seq', defaults=(None,))
+
+log = logging.getLogger('njelib.pcap')
+
+def is_capture(head):
+	""" True if head, the first four bytes of a file, start a pcap or pcapng file """
+	return head[:4] in PCAP_MAGIC or head[:4] == PCAPNG_MAGIC
+
+def packets(capture, start=None):
+	""" Yields a Packet for every packet in an open pcap or pcapng file, or
+		for the packets from file offset start on """
+	head = capture.read(4)
+	if head in PCAP_MAGIC:
+		return pcap_packets(capture, head, start)
+	if head == PCAPNG_MAGIC:
+		return pcapng_packets(capture, head, start)
+	raise ValueError("Not a pcap or pcapng file")
+
+def pcap_packets(capture, magic, start=None):
+	order, resolution = PCAP_MAGIC[magic]
+	header = capture.read(PCAP_HEADER_LEN - 4)
+	if len(header) < PCAP_HEADER_LEN - 4:
+		return
+	linktype = struct.unpack(order + 'I', header[16:20])[0] & 0x0FFFFFFF
+	record = struct.Struct(order + 'IIII')
+	offset = PCAP_HEADER_LEN
+	if start is not None:
+		capture.seek(start)
+		offset = start
+	while True:
+		header = capture.read(PCAP_RECORD_LEN)
+		if len(header) < PCAP_RECORD_LEN:
+			return
+		seconds, fraction, length, original = record.unpack(header)
+		data = capture.read(length)
+		if len(data) < length:
+			return
+		yield Packet(seconds + fraction * resolution, linktype, data, offset)
+		offset += PCAP_RECORD_LEN + length
+
+def pcapng_options(data, order):
+	""" Yields (code, value) for the options in a pcapng block body """
+	pos = 0
+	option = struct.Struct(order + 'HH')
+	while pos + 4 <= len(data):
+		code, length = option.unpack_from(data, pos)
+		if code == 0:
+			return
+		yield code, data[pos + 4:pos + 4 + length]
+		pos += 4 + length + (-length % 4)
+
+def pcapng_packets(capture, magic, start=None):
+	offset = 0
+	order = '<'
+	interfaces = [] # (linktype, seconds per tick, offset in seconds) per interface of the section
+	head = magic
+	while True:
+		head += capture.read(8 - len(head))
+		if len(head) < 8:
+			return
+		if head[:4] == PCAPNG_MAGIC:
+			# Section header: its byte order magic says how to read everything
+			bom = capture.read(4)
+			if len(bom) < 4:
+				return
+			order = '<' if struct.unpack('<I', bom)[0] == BYTE_ORDER_MAGIC else '>'
+			interfaces = []
+			length = struct.unpack(order + 'I', head[4:8])[0]
+			body = bom + capture.read(length - 12)
+			kind = SECTION_HEADER
+		else:
+			kind, length = struct.unpack(order + 'II', head)
+			body = capture.read(length - 8)
+		if length < 12 or len(body) < length - 8:
+			return
+		body = body[:-4] # trailing copy of the length
+		if kind == INTERFACE:
+			linktype = struct.unpack(order + 'H', body[:2])[0]
+			tick, shift = 1e-6, 0
+			for code, value in pcapng_options(body[8:], order):
+				if code == OPT_TSRESOL and value:
+					tick = 2.0 ** -(value[0] & 0x7F) if value[0] & 0x80 else 10.0 ** -value[0]
+				elif code == OPT_TSOFFSET and len(value) == 8:
+					shift = struct.unpack(order + 'q', value)[0]
+			interfaces.append((linktype, tick, shift))
+		elif start is not None and kind in (ENHANCED_PACKET, OLD_PACKET, SIMPLE_PACKET):
+			# The interfaces of the section are known now, skip to start
+			capture.seek(start)
+			offset, start, head = start, None, b''
+			continue
+		elif kind in (ENHANCED_PACKET, OLD_PACKET):
+			if kind == ENHANCED_PACKET:
+				interface, high, low, caplen = struct.unpack(order + 'IIII', body[:16])
+			else:
+				interface, drops, high, low, caplen = struct.unpack(order + 'HHIII', body[:16])
+			if interface < len(interfaces):
+				linktype, tick, shift = interfaces[interface]
+				yield Packet(((high << 32) | low) * tick + shift, linktype, body[20:20 + caplen], offset)
+		elif kind == SIMPLE_PACKET:
+			if interfaces:
+				linktype, tick, shift = interfaces[0]
+				yield Packet(None, linktype, body[4:], offset)
+		offset += length
+		head = b''
+
+def ip_packet(linktype, data):
+	""" Returns the IP packet in a link layer frame, or None """
+	if linktype == LINKTYPE_ETHERNET:
+		if len(data) < 14:
+			return None
+		ethertype = U16.unpack_from(data, 12)[0]
+		pos = 14
+		while ethertype in ETHERTYPE_VLAN and len(data) >= pos + 4:
+			ethertype = U16.unpack_from(data, pos + 2)[0]
+			pos += 4
+		if ethertype not in (ETHERTYPE_IPV4, ETHERTYPE_IPV6):
+			return None
+		return data[pos:]
+	if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+		return data
+	if linktype == LINKTYPE_LINUX_SLL:
+		return data[16:] if len(data) >= 16 and U16.unpack_from(data, 14)[0] in (ETHERTYPE_IPV4, ETHERTYPE_IPV6) else None
+	if linktype == LINKTYPE_LINUX_SLL2:
+		return data[20:] if len(data) >= 20 and U16.unpack_from(data, 0)[0] in (ETHERTYPE_IPV4, ETHERTYPE_IPV6) else None
+	if linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+		return data[4:]
+	return None
+
+def tcp_segment(packet):
+	""" Returns (src, dst, TCP segment) for an IPv4 or IPv6 packet carrying
+		TCP, or None. Fragments are skipped. """
+	if len(packet) < 20:
+		return None
+	version = packet[0] >> 4
+	if version == 4:
+		header = (packet[0] & 0x0F) * 4
+		total = U16.unpack_from(packet, 2)[0]
+		if packet[9] != TCP or U16.unpack_from(packet, 6)[0] & 0x3FFF:
+			return None
+		return (socket.inet_ntoa(packet[12:16]), socket.inet_ntoa(packet[16:20]), packet[header:total or len(packet)])
+	if version == 6:
+		if len(packet) < 40:
+			return None
+		after = 40 + U16.unpack_from(packet, 4)[0]
+		kind = packet[6]
+		pos = 40
+		while kind in IPV6_SKIPPED and pos + 8 <= len(packet):
+			kind = packet[pos]
+			pos += (packet[pos + 1] + 1) * 8
+		if kind != TCP:
+			return None
+		return (socket.inet_ntop(socket.AF_INET6, packet[8:24]), socket.inet_ntop(socket.AF_INET6, packet[24:40]), packet[pos:after])
+	return None
+
+class Direction:
+	""" One direction of a TCP connection, put back in order and fed to an
+		NJEParser """
+	def __init__(self, seq=None, synced=False):
+		self.next = seq # sequence number of the next byte we need
+		self.pending = {} # out of order (data, file offset) by sequence number
+		self.pending_size = 0
+		self.parser = njelib.NJEParser()
+		self.position = 0 # bytes delivered to the parser
+		self.segments = collections.deque() # (position, file offset) of the delivered packets
+		self.synced = synced # found where the blocks start
+
+	def add(self, seq, data, offset):
+		""" Takes one TCP segment and returns (offset, seq, block) for every
+			TTB block it completes """
+		if self.next is None:
+			self.next = seq
+		ahead = (seq - self.next) & 0xFFFFFFFF
+		if ahead >= 0x80000000:
+			# Starts before what we have, keep only the new part
+			skip = (self.next - seq) & 0xFFFFFFFF
+			if skip >= len(data):
+				return []
+			data = data[skip:]
+			ahead = 0
+		if ahead:
+			if seq not in self.pending:
+				self.pending[seq] = (bytes(data), offset)
+				self.pending_size += len(data)
+			if self.pending_size > MAX_PENDING:
+				# The gap isn't going to be filled, carry on after it
+				log.info("Gap of %s bytes in a flow, skipping it", (min(self.pending, key=lambda s: (s - self.next) & 0xFFFFFFFF) - self.next) & 0xFFFFFFFF)
+				self.next = min(self.pending, key=lambda s: (s - self.next) & 0xFFFFFFFF)
+				self.parser.reset()
+				self.synced = False
+				return self.deliver_pending()
+			return []
+		found = self.deliver(data, offset)
+		if self.pending:
+			found += self.deliver_pending()
+		return found
+
+	def deliver_pending(self):
+		found = []
+		while self.next in self.pending:
+			data, offset = self.pending.pop(self.next)
+			self.pending_size -= len(data)
+			found += self.deliver(data, offset)
+		return found
+
+	def deliver(self, data, offset):
+		self.next = (self.next + len(data)) & 0xFFFFFFFF
+		if not self.synced:
+			data = self.sync(data)
+			if not data:
+				return []
+		self.segments.append((self.position, offset))
+		self.position += len(data)
+		blocks = self.parser.blocks(data)
+		found = []
+		if blocks:
+			start = self.position - self.parser.pending() - sum(len(block) for block in blocks)
+			for block in blocks:
+				found.append((self.offset_of(start), (self.next - self.position + start) & 0xFFFFFFFF, block))
+				start += len(block)
+		# Forget the packets before the data still held by the parser
+		keep = self.position - self.parser.pending()
+		while len(self.segments) > 1 and self.segments[1][0] <= keep:
+			self.segments.popleft()
+		return found
+
+	def sync(self, data):
+		""" Drops the control record at the start of a connection, and any
+			data before the first block when the capture started after
+			the connection did. Returns what's left of data. """
+		if data[:8] in CONTROL_TYPES:
+			data = data[njelib.CONTROL_LEN:]
+		if len(data) >= njelib.TTB_LEN and data[4:8] == b'\x00\x00\x00\x00' and U16.unpack_from(data, 2)[0] >= njelib.TTB_LEN + 4:
+			self.synced = True
+			return data
+		return b''
+
+	def offset_of(self, position):
+		""" File offset to read from to see every byte of the stream from
+			position on: the packet that held it, or an earlier packet that
+			held later bytes (they can arrive out of order) """
+		first = 0
+		for index, (start, offset) in enumerate(self.segments):
+			if start > position:
+				break
+			first = index
+		found = min(offset for start, offset in itertools.islice(self.segments, first, None))
+		for data, offset in self.pending.values():
+			found = min(found, offset)
+		return found
+
+def shard_of(flow, count):
+	""" Which of count shards a connection belongs to. Both directions of
+		a connection land in the same shard, in every process. """
+	ends = sorted(('%s:%s' % (flow.src, flow.sport), '%s:%s' % (flow.dst, flow.dport)))
+	return zlib.crc32(' '.join(ends).encode('ascii')) % count
+
+class FlowTracker:
+	""" Follows the TCP connections on ports and returns the NJE blocks
+		sent on them, one Direction per side of every connection """
+	def __init__(self, ports=NJE_PORTS, shard=None):
+		self.ports = set(ports)
+		self.shard = shard # (index, count): only follow the connections of this shard
+		self.follow = None # set of Flows: only follow these directions
+		self.flows = {} # Flow -> Direction
+
+	def add(self, packet):
+		""" Takes a Packet and returns a list of FlowBlocks it completed """
+		ip = ip_packet(packet.linktype, packet.data)
+		if ip is None:
+			return []
+		found = tcp_segment(ip)
+		if found is None:
+			return []
+		src, dst, segment = found
+		if len(segment) < 20:
+			return []
+		sport, dport, seq, ack, header, flags = TCP_HEADER.unpack_from(segment)
+		if sport not in self.ports and dport not in self.ports:
+			return []
+		flow = Flow(src, sport, dst, dport)
+		if self.follow is not None and flow not in self.follow:
+			return []
+		if self.shard is not None and shard_of(flow, self.shard[1]) != self.shard[0]:
+			return []
+		payload = memoryview(segment)[(header >> 4) * 4:]
+		if flags & SYN:
+			self.flows[flow] = Direction((seq + 1) & 0xFFFFFFFF)
+			return []
+		direction = self.flows.get(flow)
+		if direction is None:
+			if not payload:
+				return []
+			direction = self.flows[flow] = Direction()
+		found = []
+		if payload:
+			found = [FlowBlock(flow, packet.time, offset, start, block) for offset, start, block in direction.add(seq, payload, packet.offset)]
+		if flags & (FIN | RST):
+			del self.flows[flow]
+			if flags & RST:
+				self.flows.pop(Flow(dst, dport, src, sport), None)
+		return found
+
+def blocks(capture, ports=NJE_PORTS, shard=None):
+	""" Yields a FlowBlock for every NJE block in a capture file (a path or
+		an open binary file) """
+	if isinstance(capture, str):
+		with open(capture, 'rb') as f:
+			yield from blocks(f, ports, shard)
+		return
+	tracker = FlowTracker(ports, shard)
+	for packet in packets(capture):
+		yield from tracker.add(packet)
+
+class Decoder:
+	""" Turns the NJE records in the blocks of one flow direction into
+		record objects, using an offline NJE session for the decoding """
+	def __init__(self, codepage=ebcdic.DEFAULT_CODEPAGE):
+		self.session = njelib.NJE(codepage=codepage)
+		self.session.set_offline()
+
+	def payloads(self, records):
+		""" Yields (RCB, SRCB, data) for the NMR, SYSIN and SYSOUT records out
+			of (RCB, SRCB, payload) records, with spanned SYSOUT records
+			joined together """
+		spanned = self.session.spanned
+		for RCB, SRCB, payload in records:
+			if RCB is None:
+				continue
+			if RCB == 0x9A:
+				yield RCB, SRCB, bytes(payload)
+			elif (RCB & 0x0F) not in (0x08, 0x09):
+				continue
+			elif not SRCB:
+				spanned.discard(RCB)
+			elif (RCB & 0x0F) == 0x08:
+				yield RCB, SRCB, bytes(payload)
+			else:
+				whole = spanned.add(RCB, SRCB, payload)
+				if whole is not None:
+					yield RCB, whole[0], whole[1]
+
+	def record(self, RCB, SRCB, data):
+		""" Returns the record object for a payload from payloads() """
+		session = self.session
+		if RCB == 0x9A:
+			return session.process_nmr({'Data': data})
+		if (RCB & 0x0F) == 0x08:
+			return session.process_SYSIN({'SRCB': bytes((SRCB,)), 'Data': data})
+		return session.process_SYSOUT({'SRCB': bytes((SRCB,)), 'Data': data})
+
+	def decode(self, block):
+		""" Yields (RCB, record) for the NMR, SYSIN and SYSOUT records in block """
+		for RCB, SRCB, data in self.payloads(njelib.parse_records(block)):
+			yield RCB, self.record(RCB, SRCB, data)
+
+def payloads(capture, ports=NJE_PORTS, shard=None, resume=None):
+	""" Yields (flow, time, offset, seq, RCB, SRCB, data) for every NMR, SYSIN
+		and SYSOUT record in a capture file, see Decoder.payloads(). seq is
+		the TCP sequence number the record's block starts at.
+
+		resume is (offset, flow, seq) of a block seen before: only that
+		direction of that connection is followed, starting with the block,
+		and the file is read from offset on. """
+	if isinstance(capture, str):
+		with open(capture, 'rb') as f:
+			yield from payloads(f, ports, shard, resume)
+		return
+	tracker = FlowTracker(ports, shard)
+	start = None
+	if resume is not None:
+		start, flow, seq = resume
+		tracker.follow = set([flow])
+		tracker.flows[flow] = Direction(seq, synced=True)
+	decoders = {}
+	for packet in packets(capture, start):
+		for found in tracker.add(packet):
+			decoder = decoders.get(found.flow)
+			if decoder is None:
+				if len(decoders) > 2 * len(tracker.flows) + 64:
+					# Forget the decoders of connections that are gone
+					decoders = dict((flow, decoder) for flow, decoder in decoders.items() if flow in tracker.flows)
+				decoder = decoders[found.flow] = Decoder()
+			for RCB, SRCB, data in decoder.payloads(njelib.parse_records(found.block)):
+				yield found.flow, found.time, found.offset, found.seq, RCB, SRCB, data
+
+def records(capture, ports=NJE_PORTS, codepage=ebcdic.DEFAULT_CODEPAGE):
+	""" Yields a FlowRecord for every NMR, SYSIN and SYSOUT record sent on
+		the NJE ports in a capture file (a path or an open binary file) """
+	decoder = Decoder(codepage)
+	for flow, time, offset, seq, RCB, SRCB, data in payloads(capture, ports):
+		yield FlowRecord(flow, time, offset, RCB, decoder.record(RCB, SRCB, data), seq)
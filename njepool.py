@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+## Session pool for njelib
+#
+# Connecting and signing on (TCP connect, OPEN/ACK, SOH ENQ and the I/J/K/L
+# signon records) costs several round trips, which is most of the time a
+# single command takes. A SessionPool keeps signed-on sessions for every
+# link, keyed by (host, port, RHOST, OHOST), and hands them out again:
+#
+#	pool = njepool.SessionPool()
+#	with pool.session("3.1.33.7", 175, "NEWYORK", "WASHDC") as nje:
+#		print(nje.sendCommand("$D NJEDEF", signoff=False))
+#
+# Idle sessions run the keepalive service, so they stay warm and a dead
+# link is noticed. A background thread replaces idle sessions whose link
+# dropped by signing on again.
+#
+#########
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########
+
+import collections
+import contextlib
+import logging
+import threading
+
+import njekeepalive
+import njelib
+
+SIZE = 4 # Most sessions per link
+CHECK_INTERVAL = 5 # Seconds between checks of the idle sessions
+STORE_LIMIT = 1000 # Pooled sessions keep the newest records of each kind
+
+Link = collections.namedtuple('Link', 'host port rhost ohost')
+log = logging.getLogger('njelib.pool')
+
+class SessionPool:
+	""" Keeps signed-on NJE sessions per link and hands them out again.
+		setup(nje) is called for every new session before it signs on
+		(e.g. to call setTLS()). """
+	def __init__(self, size=SIZE, password='', timeout=30, keepalive=njekeepalive.INTERVAL,
+			check=CHECK_INTERVAL, factory=njelib.NJE, setup=None):
+		self.size = size
+		self.password = password
+		self.timeout = timeout
+		self.keepalive = keepalive
+		self.check = check
+		self.factory = factory
+		self.setup = setup
+		self.lock = threading.Condition()
+		self.idle = collections.defaultdict(collections.deque) # Link -> signed-on sessions
+		self.in_use = collections.Counter() # Link -> sessions handed out or being made
+		self.closed = threading.Event()
+		self.maintainer = None
+
+	def link(self, host, port, rhost, ohost):
+		return Link(host, port or njelib.NJE_PORT, rhost.upper(), ohost.upper())
+
+	def connect(self, link):
+		""" Returns a new session signed on to link, or None """
+		nje = self.factory(link.rhost, link.ohost)
+		if self.setup is not None:
+			self.setup(nje)
+		nje.set_store('ring', STORE_LIMIT)
+		if not nje.session(link.host, link.port, self.timeout, self.password):
+			log.info("Couldn't sign on to %s", link)
+			nje.disconnect()
+			return None
+		nje.pool_link = link
+		if self.keepalive:
+			nje.start_keepalive(self.keepalive)
+		return nje
+
+	def healthy(self, nje):
+		""" Without the keepalive service nothing reads an idle session, so
+			its liveness says nothing. The socket is polled instead, which
+			notices a link the other side closed. """
+		if not self.keepalive:
+			nje.poll()
+			return bool(nje.sock)
+		return nje.link_state() in (njekeepalive.ALIVE, njekeepalive.WAITING)
+
+	def get(self, host, port, rhost, ohost, wait=None):
+		""" Returns a signed-on session for the link, reusing an idle one if
+			there is one. Waits up to wait seconds (forever if None) when
+			all of the link's sessions are in use. Returns None if no
+			session could be had. """
+		link = self.link(host, port, rhost, ohost)
+		self.start()
+		with self.lock:
+			while True:
+				idle = self.idle[link]
+				while idle:
+					nje = idle.popleft()
+					if self.healthy(nje):
+						self.in_use[link] += 1
+						return nje
+					nje.disconnect()
+				if self.in_use[link] < self.size:
+					self.in_use[link] += 1
+					break
+				if not self.lock.wait(wait):
+					log.info("No free session for %s", link)
+					return None
+		nje = self.connect(link)
+		if nje is None:
+			with self.lock:
+				self.in_use[link] -= 1
+				self.lock.notify()
+		return nje
+
+	def put(self, nje):
+		""" Gives a session back. Sessions whose link dropped are thrown away. """
+		link = nje.pool_link
+		with self.lock:
+			self.in_use[link] -= 1
+			if self.healthy(nje) and not self.closed.is_set():
+				self.idle[link].append(nje)
+			else:
+				nje.disconnect()
+			self.lock.notify()
+
+	@contextlib.contextmanager
+	def session(self, host, port, rhost, ohost, wait=None):
+		""" Context manager that gets a session and gives it back. It hands
+			out None if no session could be had. """
+		nje = self.get(host, port, rhost, ohost, wait)
+		try:
+			yield nje
+		finally:
+			if nje is not None:
+				self.put(nje)
+
+	def sendCommand(self, host, port, rhost, ohost, command, wait=None):
+		""" Sends command over a pooled session and returns the reply, see
+			NJE.sendCommand() for wait """
+		with self.session(host, port, rhost, ohost) as nje:
+			if nje is None:
+				return False
+			return nje.sendCommand(command, signoff=False, wait=wait)
+
+	def sendMessage(self, host, port, rhost, ohost, message, user=''):
+		with self.session(host, port, rhost, ohost) as nje:
+			if nje is None:
+				return False
+			nje.sendMessage(message, user, signoff=False)
+			return True
+
+	def start(self):
+		if self.maintainer is None and self.check:
+			self.maintainer = threading.Thread(target=self.maintain, name='njelib-pool', daemon=True)
+			self.maintainer.start()
+
+	def maintain(self):
+		""" Replaces idle sessions whose link dropped with new ones """
+		while not self.closed.wait(self.check):
+			with self.lock:
+				dropped = []
+				for link, idle in self.idle.items():
+					for nje in [nje for nje in idle if not self.healthy(nje)]:
+						idle.remove(nje)
+						nje.disconnect()
+						dropped.append(link)
+						self.in_use[link] += 1
+			for link in dropped:
+				log.info("Link %s dropped, signing on again", link)
+				nje = self.connect(link)
+				with self.lock:
+					self.in_use[link] -= 1
+					if nje is not None and not self.closed.is_set():
+						self.idle[link].append(nje)
+					elif nje is not None:
+						nje.disconnect()
+					self.lock.notify()
+
+	def close(self):
+		""" Signs off every idle session. Sessions in use are closed when
+			they're given back. """
+		self.closed.set()
+		with self.lock:
+			for idle in self.idle.values():
+				while idle:
+					idle.popleft().signoff()
+			self.lock.notify_all()
+		if self.maintainer is not None and self.maintainer is not threading.current_thread():
+			self.maintainer.join()
+
+	def __len__(self):
+		""" Number of idle sessions """
+		with self.lock:
+			return sum(len(idle) for idle in self.idle.values())
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
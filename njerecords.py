@@ -0,0 +1,549 @@
+#!/usr/bin/python
+
+## NJE record types used by njelib
+#
+# Every SYSIN/SYSOUT record and NMR that njelib decodes is one of the
+# classes below. They use __slots__ and keep a single reference to the
+# record's raw (decompressed) bytes, decoding fields only when they're read.
+#
+# Job headers (NJH), data set headers (NDH) and job trailers (NJT) are made
+# of fixed layout sections. Each section is decoded with one precompiled
+# struct.Struct and unpack_from(), and only once somebody asks for a field
+# in it. EBCDIC fields are translated and flag bits looked up when the field
+# is read, so a header nobody looks at costs next to nothing.
+#
+# Field names and offsets are from IBM book HAS2A620:
+#  "Network Job Entry: Formats and Protocols"
+#
+#########
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########
+
+import struct
+from collections.abc import Mapping
+
+import ebcdic
+
+# FLAG_BITS[byte][i] is True if bit i (0 = low order) of byte is set
+FLAG_BITS = tuple(tuple(bool(byte & (1 << i)) for i in range(8)) for byte in range(256))
+
+# How a field is turned into a value when it is read
+VALUE, EBCDIC, BIT, CALL = range(4)
+
+SECTION_HEADER = struct.Struct('>HB') # Every section starts with its length and type
+
+class Section:
+	""" One fixed layout section of a header.
+
+		fmt is the struct format of the section and fields names each item
+		of it in order (None for the ones nobody needs). ebcdic lists the
+		fields that get translated, bits adds flag fields as
+		(name, field, bit) and calls adds computed fields as (name, function).
+	"""
+	def __init__(self, fmt, fields, ebcdic=(), bits=(), calls=()):
+		self.layout = struct.Struct(fmt)
+		self.fields = {}
+		for pos, name in enumerate(fields):
+			if name:
+				self.fields[name] = (self, EBCDIC if name in ebcdic else VALUE, pos, None)
+		for name, field, bit in bits:
+			self.fields[name] = (self, BIT, self.fields[field][2], bit)
+		for name, function in calls:
+			self.fields[name] = (self, CALL, None, function)
+
+	def unpack(self, data, offset):
+		if offset + self.layout.size <= len(data):
+			return self.layout.unpack_from(data, offset)
+		# Short section, pad it out rather than fail
+		return self.layout.unpack(bytes(data[offset:offset + self.layout.size]).ljust(self.layout.size, b"\x00"))
+
+class Record(Mapping):
+	""" Base for the typed records. A record keeps one reference to its raw
+		buffer and decodes fields when they're read, either as record['NAME']
+		like the dicts they replace or as record.NAME. to_dict() decodes every
+		field into a plain dict. """
+	__slots__ = ()
+
+	def keys(self):
+		""" Names of the fields this record has """
+		return ()
+
+	def field(self, name):
+		raise KeyError(name)
+
+	def __getitem__(self, name):
+		if name not in self.keys():
+			raise KeyError(name)
+		return self.field(name)
+
+	def __getattr__(self, name):
+		# Unset slots and dunder lookups (pickle, copy) must not turn into
+		# field lookups
+		if name.startswith('__') or name in self.__slots__:
+			raise AttributeError(name)
+		try:
+			return self[name]
+		except KeyError:
+			raise AttributeError(name)
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.keys())
+
+	def __contains__(self, name):
+		return name in self.keys()
+
+	def to_dict(self):
+		return dict((name, self.field(name)) for name in self.keys())
+
+	def __repr__(self):
+		return '{0}({1!r})'.format(type(self).__name__, self.to_dict())
+
+class Header(Record):
+	""" Base for the lazily decoded headers. PREFIX and GENERAL are always
+		present, the optional SECTIONS are found by their type byte the
+		first time one of their fields is read. """
+	__slots__ = ('data', 'codec', 'prefix', 'general', 'extra')
+	PREFIX = None
+	GENERAL = None
+	SECTIONS = {}
+	ORDER = ()
+	FIELDS = {}
+
+	def __init__(self, data, codec=None):
+		self.data = data
+		self.codec = codec or DEFAULT_CODEC
+		self.prefix = None
+		self.general = None
+		self.extra = None # {section: (offset, values)} once optional sections are looked for
+
+	def locate(self):
+		""" Works out where each optional section starts """
+		extra = {}
+		data = self.data
+		pos = self.PREFIX.layout.size
+		pos += SECTION_HEADER.unpack_from(data, pos)[0] if pos + 3 <= len(data) else len(data)
+		while pos + 3 <= len(data):
+			length, kind = SECTION_HEADER.unpack_from(data, pos)
+			section = self.SECTIONS.get(kind)
+			if section is not None and section not in extra:
+				extra[section] = (pos, None)
+			if length <= 0:
+				break
+			pos += length
+		self.extra = extra
+		return extra
+
+	def offset(self, section):
+		if section is self.PREFIX:
+			return 0
+		if section is self.GENERAL:
+			return self.PREFIX.layout.size
+		extra = self.extra if self.extra is not None else self.locate()
+		return extra[section][0]
+
+	def unpack(self, section):
+		if section is self.GENERAL:
+			if self.general is None:
+				self.general = section.unpack(self.data, self.PREFIX.layout.size)
+			return self.general
+		if section is self.PREFIX:
+			if self.prefix is None:
+				self.prefix = section.unpack(self.data, 0)
+			return self.prefix
+		extra = self.extra if self.extra is not None else self.locate()
+		offset, values = extra[section]
+		if values is None:
+			values = section.unpack(self.data, offset)
+			extra[section] = (offset, values)
+		return values
+
+	def field(self, name):
+		section, kind, pos, arg = self.FIELDS[name]
+		try:
+			values = self.unpack(section)
+		except KeyError:
+			raise KeyError(name)
+		if kind == VALUE:
+			return values[pos]
+		if kind == EBCDIC:
+			return values[pos].translate(self.codec.to_latin1)
+		if kind == BIT:
+			return FLAG_BITS[values[pos]][arg]
+		return arg(self, values, self.offset(section))
+
+	__getitem__ = field
+
+	def sections(self):
+		extra = self.extra if self.extra is not None else self.locate()
+		return [s for s in self.ORDER if s is self.PREFIX or s is self.GENERAL or s in extra]
+
+	def keys(self):
+		return [name for section in self.sections() for name in section.fields]
+
+	def __len__(self):
+		return sum(len(section.fields) for section in self.sections())
+
+	def __contains__(self, name):
+		spec = self.FIELDS.get(name)
+		if spec is None:
+			return False
+		if spec[0] is self.PREFIX or spec[0] is self.GENERAL:
+			return True
+		return spec[0] in (self.extra if self.extra is not None else self.locate())
+
+	def to_dict(self):
+		job = {}
+		for section in self.sections():
+			values = self.unpack(section)
+			for name, (_, kind, pos, arg) in section.fields.items():
+				if kind == VALUE:
+					job[name] = values[pos]
+				elif kind == EBCDIC:
+					job[name] = values[pos].translate(self.codec.to_latin1)
+				elif kind == BIT:
+					job[name] = FLAG_BITS[values[pos]][arg]
+				else:
+					job[name] = arg(self, values, self.offset(section))
+		return job
+
+def all_fields(*sections):
+	fields = {}
+	for section in sections:
+		fields.update(section.fields)
+	return fields
+
+DEFAULT_CODEC = ebcdic.shared()
+
+#### Job Header (NJH)
+
+NJH_PREFIX = Section('>H1s1s', ('NJHLEN', 'NJHFLAGS', 'NJHSEQ'))
+
+NJHG = Section('>H1s1sh1s1sBB1s1s1sx2s' + '8s' * 15 + 'iiii20s8s8s8sii8s', (
+	'NJHGLEN', 'NJHGTYPE', 'NJHGMOD', 'NJHGJID', 'NJHGJCLS', 'NJHGMCLS', 'NJHGFLG1',
+	'NJHGPRIO', 'NJHGORGQ', 'NJHGJCPY', 'NJHGLNCT', 'NJHGHOPS',
+	'NJHGACCT', 'NJHGJNAM', 'NJHGUSID', 'NJHGPASS', 'NJHGNPAS', 'NJHGETS',
+	'NJHGORGN', 'NJHGORGR', 'NJHGXEQN', 'NJHGXEQU', 'NJHGPRTN', 'NJHGPRTR',
+	'NJHGPUNN', 'NJHGPUNR', 'NJHGFORM',
+	'NJHGICRD', 'NJHGETIM', 'NJHGELIN', 'NJHGECRD',
+	'NJHGPRGN', 'NJHGROOM', 'NJHGDEPT', 'NJHGBLDG', 'NJHGNREC', 'NJHGJNO', 'NJHGNTYN'),
+	ebcdic=('NJHGJCLS', 'NJHGMCLS', 'NJHGACCT', 'NJHGJNAM', 'NJHGUSID', 'NJHGPASS',
+		'NJHGNPAS', 'NJHGORGN', 'NJHGORGR', 'NJHGXEQN', 'NJHGXEQU', 'NJHGPRTN',
+		'NJHGPRTR', 'NJHGPUNN', 'NJHGPUNR', 'NJHGFORM', 'NJHGPRGN', 'NJHGROOM',
+		'NJHGDEPT', 'NJHGBLDG', 'NJHGNTYN'),
+	bits=(('NJHGF1PR', 'NJHGFLG1', 7), ('NJHGF1CF', 'NJHGFLG1', 3), ('NJHGF1CA', 'NJHGFLG1', 2),
+		('NJHGF1PE', 'NJHGFLG1', 1), ('NJHGF1NE', 'NJHGFLG1', 0)) )
+
+# Scheduling Section
+NJHE = Section('>h1s1sii', ('NJHELEN', 'NJHETYPE', 'NJHEMOD', 'NJHEPAGE', 'NJHEBYTE'))
+
+# Security Section
+NJHT = Section('>h1s1sh1sxbb1s1s1s1s2x8s8s8s8s8s8s8x8s8s', (
+	'NJHTLEN', 'NJHTTYPE', 'NJHTMOD', 'NJHTLENP', 'NJHTFLG0',
+	'NJHTLENT', 'NJHTVERS', 'NJHTFLG1', 'NJHTSTYP', 'NJHTFLG2', 'NJHTPOEX',
+	'NJHTSECL', 'NJHTCNOD', 'NJHTSUSR', 'NJHTSNOD', 'NJHTSGRP', 'NJHTPOEN',
+	'NJHTOUSR', 'NJHTOGRP'),
+	ebcdic=('NJHTSECL', 'NJHTCNOD', 'NJHTSUSR', 'NJHTSNOD', 'NJHTSGRP', 'NJHTPOEN',
+		'NJHTOUSR', 'NJHTOGRP') )
+
+# Job Accounting Section. These aren't documented very well
+def njha_jlen(header, values, offset):
+	return header.data[offset + 8:offset + 8 + values[3]]
+
+def njha_jac1(header, values, offset):
+	return header.codec.decode(header.data[offset + 12:offset + 12 + values[8]])
+
+NJHA = Section('>h1s1sh1sxBBBB', (
+	'NJHALEN', 'NJHATYPE', 'NJHAMOD', 'NJHAOFFS', 'NJHAFLG1',
+	'NJHARecords', 'NJHATotal', 'NJHARecNum', 'NJHARecLen'),
+	calls=(('NJHAJLEN', njha_jlen), ('NJHAJAC1', njha_jac1)) )
+
+# JES2 Section
+NJH2 = Section('>h1s1s1s3x4s8s8s8s8s8s', (
+	'NJH2LEN', 'NJH2TYPE', 'NJH2MOD', 'NJH2FLG1', 'NJH2ACCT', 'NJH2USID',
+	'NJH2USR', 'NJH2GRP', 'NJH2SUSR', 'NJH2SGRP') )
+
+class JobHeader(Header):
+	__slots__ = ()
+	PREFIX = NJH_PREFIX
+	GENERAL = NJHG
+	SECTIONS = {0x8A: NJHE, 0x8C: NJHT, 0x8D: NJHA, 0x84: NJH2}
+	ORDER = (NJH_PREFIX, NJHG, NJHE, NJHT, NJHA, NJH2)
+	FIELDS = all_fields(*ORDER)
+
+#### Data Set Header (NDH)
+
+NDH_PREFIX = Section('>H1s1s', ('NDHLEN', 'NDHFLAGS', 'NDHSEQ'))
+
+NDHG = Section('>H1sB8s8s8s8s8sHx1siBBHBBBx8s8s8s8s8sBB2x8si', (
+	'NDHGLEN', 'NDHGTYPE', 'NDHGMOD', 'NDHGNODE', 'NDHGRMT', 'NDHGPROC', 'NDHGSTEP',
+	'NDHGDD', 'NDHGDSNO', 'NDHGCLAS', 'NDHGNREC', 'NDHGFLG1', 'NDHGRCFM', 'NDHGLREC',
+	'NDHGDSCT', 'NDHGFCBI', 'NDHGLNCT', 'NDHGFORM', 'NDHGFCB', 'NDHGUCS', 'NDHGXWTR',
+	'NDHGNAME', 'NDHGFLG2', 'NDHGUCSO', 'NDHGPMDE', 'NDHGSEGN'),
+	ebcdic=('NDHGNODE', 'NDHGRMT', 'NDHGPROC', 'NDHGSTEP', 'NDHGDD', 'NDHGCLAS',
+		'NDHGFORM', 'NDHGFCB', 'NDHGUCS', 'NDHGXWTR', 'NDHGNAME', 'NDHGPMDE'),
+	bits=(('NDHGF1SP', 'NDHGFLG1', 7), ('NDHGF1HD', 'NDHGFLG1', 6), ('NDHGF1LG', 'NDHGFLG1', 5),
+		('NDHGF1OV', 'NDHGFLG1', 4), ('NDHGF1IN', 'NDHGFLG1', 3), ('NDHGF1LC', 'NDHGFLG1', 2),
+		('NDHGF1ST', 'NDHGFLG1', 1), ('NDHGF1DF', 'NDHGFLG1', 0),
+		('NDHGF2PR', 'NDHGFLG2', 7), ('NDHGF2PU', 'NDHGFLG2', 6), ('NDHGF2NM', 'NDHGFLG2', 5),
+		('NDHGF2HB', 'NDHGFLG2', 4), ('NDHGF2HA', 'NDHGFLG2', 3),
+		('NDHGUCSD', 'NDHGUCSO', 7), ('NDHGUCSF', 'NDHGUCSO', 6)) )
+
+# Security Section
+NDHT = Section('>H1s1shBBBBBBBB2x8s8s8s8s8s8s8s8s8s', (
+	'NDHTLEN', 'NDHTTYPE', 'NDHTMOD', 'NDHTLENP', 'NDHTFLG0', None,
+	'NDHTLENT', 'NDHTVERS', 'NDHTFLG1', 'NDHTSTYP', 'NDHTFLG2', 'NDHTPOEX',
+	'NDHTSECL', 'NDHTCNOD', 'NDHTSUSR', 'NDHTSNOD', 'NDHTSGRP', 'NDHTPOEN',
+	'RESERVED', 'NDHTOUSR', 'NDHTOGRP'),
+	ebcdic=('NDHTSECL', 'NDHTCNOD', 'NDHTSUSR', 'NDHTSNOD', 'NDHTSGRP', 'NDHTPOEN',
+		'RESERVED', 'NDHTOUSR', 'NDHTOGRP'),
+	bits=(('NDHT1EN', 'NDHTFLG1', 7), ('NDHT1EXT', 'NDHTFLG1', 6),
+		('NDHT2DFT', 'NDHTFLG2', 7), ('NDHT2MLO', 'NDHTFLG2', 5), ('NDHT2SHI', 'NDHTFLG2', 4),
+		('NDHT2TRS', 'NDHTFLG2', 3), ('NDHT2SUS', 'NDHTFLG2', 2), ('NDHT2RMT', 'NDHTFLG2', 1)) )
+NDHT.fields['NDHTF0JB'] = (NDHT, BIT, 5, 7) # High bit of the byte after NDHTFLG0
+
+class DatasetHeader(Header):
+	__slots__ = ()
+	PREFIX = NDH_PREFIX
+	GENERAL = NDHG
+	SECTIONS = {0x8C: NDHT}
+	ORDER = (NDH_PREFIX, NDHG, NDHT)
+	FIELDS = all_fields(*ORDER)
+
+#### Job Trailer (NJT)
+
+NJT_PREFIX = Section('>H1s1s', ('NJTLEN', 'NJTFLAGS', 'NJTSEQ'))
+
+NJTG = Section('>hBB1s1s2x8s8s4xii4xBBBBB', (
+	'NJTGLEN', 'NJTGTYPE', 'NJTGMOD', 'NJTGFLG1', 'NJTGXCLS', 'NJTGSTRT', 'NJTGSTOP',
+	'NJTGALIN', 'NJTGACRD', 'NJTGIXPR', 'NJTGAXPR', 'NJTGIOPR', 'NJTGAOPR', 'NJTGCOMP') )
+
+class JobTrailer(Header):
+	__slots__ = ()
+	PREFIX = NJT_PREFIX
+	GENERAL = NJTG
+	SECTIONS = {}
+	ORDER = (NJT_PREFIX, NJTG)
+	FIELDS = all_fields(*ORDER)
+
+#### Node Message Record (NMR)
+# From http://www-01.ibm.com/support/knowledgecenter/SSB27U_5.4.0/com.ibm.zvm.v54.dmta7/hnmr.htm
+
+NMR_FIELDS = {
+	'NMRFLAG'  : lambda r: r.data[0:1],
+	#NMRFLAGC EQU	B'10000000'		NMRMSG contains a command
+	#NMRFLAGW EQU	B'01000000'		NMROUT has JES2 RMT number
+	#NMRFLAGT EQU	B'00100000'		NMROUT has user ID
+	#NMRFLAGU EQU	B'00010000'		NMROUT has UCMID information
+	#NMRFLAGR EQU	B'00001000'		Console is only remote authorized
+	#NMRFLAGJ EQU	B'00000100'		Console not job authorized
+	#NMRFLAGD EQU	B'00000010'		Console not device authorized
+	#NMRFLAGS EQU	B'00000001'		Console not system authorized
+	'NMRFLAGC' : lambda r: FLAG_BITS[r.data[0]][7],
+	'NMRFLAGW' : lambda r: FLAG_BITS[r.data[0]][6],
+	'NMRFLAGT' : lambda r: FLAG_BITS[r.data[0]][5],
+	'NMRFLAGU' : lambda r: FLAG_BITS[r.data[0]][4],
+	'NMRFLAGR' : lambda r: FLAG_BITS[r.data[0]][3],
+	'NMRFLAGJ' : lambda r: FLAG_BITS[r.data[0]][2],
+	'NMRFLAGD' : lambda r: FLAG_BITS[r.data[0]][1],
+	'NMRFLAGS' : lambda r: FLAG_BITS[r.data[0]][0],
+	'NMRLEVEL' : lambda r: bytes((r.data[1] & 0xF0,)),
+	'NMRPRIO'  : lambda r: bytes((r.data[1] & 0x0F,)),
+	'NMRTYPE'  : lambda r: r.data[2:3],
+	#NMRTYPEX EQU	B'11110000'		Reserved bits
+	#NMRTYPED EQU	B'00000001'		DOM (not supported)
+	#NMRTYPEF EQU	B'00000010'		Formatted command in NMRMSG
+	#NMRTYPET EQU	B'00000100'		Msg text only in NMRMSG
+	#NMRTYPE4 EQU	B'00001000'		Msg text contains control info
+	'NMRTYPEX' : lambda r: bytes((r.data[2] & 0xF0,)),
+	'NMRTYPED' : lambda r: FLAG_BITS[r.data[2]][0],
+	'NMRTYPEF' : lambda r: FLAG_BITS[r.data[2]][1],
+	'NMRTYPET' : lambda r: FLAG_BITS[r.data[2]][2],
+	'NMRTYPE4' : lambda r: FLAG_BITS[r.data[2]][3],
+	'NMRML'    : lambda r: r.data[3:4], #Length of the message
+	'NMRTONOD' : lambda r: r.codec.decode(r.data[4:12]),
+	'NMRFMQUL' : lambda r: r.data[12],
+	'NMROUT'   : lambda r: r.data[13:21],
+	'NMRFMNOD' : lambda r: r.codec.decode(r.data[21:29]),
+	'NMRTOQUL' : lambda r: r.data[29],
+	# NMROUT format for logical routed msgs
+	'NMRDESC'  : lambda r: r.data[13:15], # MCS descriptor codes
+	'NMRROUT'  : lambda r: r.data[15:17], # MCS console routings
+	'NMRDOMID' : lambda r: r.data[17:21], # MCS DOM ID
+	# NMROUT format for UCMID messages
+	'NMRUCM'   : lambda r: r.data[13:14], # MCS console ID
+	'NMRUCMA'  : lambda r: r.data[14:15], # MCS console area
+	# Line type for MLWTO:
+	# 0x8000 = First Line
+	# 0x2000 = Middle Line(s)
+	# 0x3000 = Last Line
+	# 0x9000 = Only line
+	'NMRLINET' : lambda r: struct.unpack("h", r.data[15:17])[0],
+	# NMROUT format for user messages (NMRFLAGT on and NMRFLAGC off)
+	'NMRUSER'  : lambda r: r.codec.decode(r.data[13:21]), # Receiving user ID
+	# NMROUT format for remote messages, remote name 'RNNNNNNN'
+	'NMRRMT'   : lambda r: r.data[13:21],
+	# Here's the actual contents of the message!
+	'NMRMSG'   : lambda r: r.codec.decode(r.data[30:30 + r.data[3]]),
+	'timestamp': lambda r: r.NMRMSG[0:8],
+	'NMRECSID' : lambda r: r.NMRMSG[8:16] if not FLAG_BITS[r.data[2]][2] else r.NMRMSG[0:8],
+}
+
+NMR_HEADER = ('NMRFLAG', 'NMRFLAGC', 'NMRFLAGW', 'NMRFLAGT', 'NMRFLAGU', 'NMRFLAGR',
+	'NMRFLAGJ', 'NMRFLAGD', 'NMRFLAGS', 'NMRLEVEL', 'NMRPRIO', 'NMRTYPE', 'NMRTYPEX',
+	'NMRTYPED', 'NMRTYPEF', 'NMRTYPET', 'NMRTYPE4', 'NMRML', 'NMRTONOD', 'NMRFMQUL',
+	'NMROUT', 'NMRFMNOD', 'NMRTOQUL')
+
+def nmr_keys(flag, nmrtype):
+	""" Which fields an NMR has depends on its NMRFLAG and NMRTYPE bytes """
+	C, W, T, U = (flag & 0x80, flag & 0x40, flag & 0x20, flag & 0x10)
+	F, T4, TT = (nmrtype & 0x02, nmrtype & 0x08, nmrtype & 0x04)
+	keys = list(NMR_HEADER)
+	if not (W or T or U):
+		keys += ['NMRDESC', 'NMRROUT', 'NMRDOMID'] # Logical Routed Message
+	elif not (W or T) and U:
+		keys += ['NMRUCM', 'NMRUCMA', 'NMRLINET'] # UCMID Message
+	elif not (W or U) and T:
+		keys += ['NMRUSER'] # User Message
+	elif not (T or U) and W:
+		keys += ['NMRRMT'] # Remote Workstation
+	if C:
+		if not F:
+			keys += ['NMRMSG'] # Unformatted Command
+	else:
+		keys += ['NMRMSG']
+		if not (T4 or TT):
+			keys += ['timestamp']
+		elif T4 and not TT:
+			keys += ['timestamp', 'NMRECSID']
+		elif T4 and TT:
+			keys += ['NMRECSID']
+	return tuple(keys)
+
+# All 256 x 16 combinations that matter are small, work them out once
+NMR_KEYS = dict(((flag, nmrtype), nmr_keys(flag, nmrtype)) for flag in range(0, 256, 16) for nmrtype in range(16))
+
+class NmrRecord(Record):
+	""" Node Message Record: an operator command or a console/user message """
+	__slots__ = ('data', 'codec')
+
+	def __init__(self, data, codec=None):
+		self.data = data
+		self.codec = codec or DEFAULT_CODEC
+
+	def keys(self):
+		return NMR_KEYS[(self.data[0] & 0xF0, self.data[2] & 0x0F)]
+
+	def field(self, name):
+		return NMR_FIELDS[name](self)
+
+#### SYSIN/SYSOUT data records
+
+class DataRecord(Record):
+	""" A SYSIN or SYSOUT data record. The first byte of data is the record
+		length, the rest is the record in EBCDIC.
+
+		SYSOUT carriage control types (SRCB 10cc ....):
+			1000 - No carriage control
+			1001 - Machine carriage control (MCC is the CCW command byte)
+			1010 - ASA carriage control (ASA is the control character)
+			1011 - CPDS page mode records, not decoded
+	"""
+	__slots__ = ('data', 'codec', 'srcb')
+	NONE, MACHINE, ASA, CPDS = (0x80, 0x90, 0xA0, 0xB0)
+	KEYS = {NONE: ('Record',), MACHINE: ('MCC', 'Record'), ASA: ('ASA', 'Record'), CPDS: ()}
+
+	def __init__(self, data, srcb=0x80, codec=None):
+		self.data = data
+		self.srcb = srcb
+		self.codec = codec or DEFAULT_CODEC
+
+	@property
+	def carriage(self):
+		return self.srcb & 0xB0
+
+	@property
+	def raw(self):
+		""" The record in EBCDIC, without the length byte """
+		return self.data[1:]
+
+	def keys(self):
+		return self.KEYS[self.srcb & 0xB0]
+
+	def field(self, name):
+		if name == 'Record':
+			if self.carriage == self.NONE:
+				return self.codec.decode(self.data[1:]).ljust(self.data[0])
+			return self.codec.decode(self.data[1:])
+		if name == 'ASA':
+			return self.data[1:2].translate(self.codec.to_latin1)[0]
+		if name == 'MCC':
+			return self.data[1]
+		raise KeyError(name)
+
+#### Spanned SYSOUT records
+# SYSOUT records too long for one NJE record are sent as segments, each
+# with its own length byte. The SRCB says which part of the record it is:
+#	10cc 0000 - Standard record (not spanned)
+#	10cc 1000 - First segment of spanned record
+#	10cc 0100 - Middle segment of spanned record
+#	10cc 1100 - Last segment of spanned record
+
+SPAN_MASK = 0x0C
+SPAN_FIRST, SPAN_MIDDLE, SPAN_LAST = (0x08, 0x04, 0x0C)
+
+class Reassembler:
+	""" Glues spanned SYSOUT segments back into whole records. Segments are
+		appended to one bytearray per stream (RCB), so a record of any
+		length is put together in linear time. """
+	def __init__(self):
+		self.streams = {} # RCB -> bytearray of the record so far, length byte first
+
+	def add(self, RCB, SRCB, data):
+		""" Takes one SYSOUT record, data can be any bytes-like object.
+			Returns (SRCB, data) of a whole record, with the span bits
+			cleared, or None while a record is incomplete. """
+		span = SRCB & SPAN_MASK
+		if not span or SRCB & 0xC0 == 0xC0:
+			return (SRCB, bytes(data))
+		segment = memoryview(data)[1:]
+		if span == SPAN_FIRST:
+			self.streams[RCB] = buf = bytearray(1)
+		else:
+			buf = self.streams.get(RCB)
+			if buf is None:
+				# Lost the start of the record, keep what we've got
+				self.streams[RCB] = buf = bytearray(1)
+		buf += segment
+		if span != SPAN_LAST:
+			return None
+		del self.streams[RCB]
+		buf[0] = min(len(buf) - 1, 255)
+		return (SRCB & ~SPAN_MASK, buf)
+
+	def discard(self, RCB):
+		""" Drops the incomplete record of stream RCB, if any, when the
+			stream ends """
+		self.streams.pop(RCB, None)
+
+	def pending(self):
+		""" Number of streams with a record that isn't complete yet """
+		return len(self.streams)
+
+	def reset(self):
+		self.streams.clear()
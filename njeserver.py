@@ -0,0 +1,422 @@
+#!/usr/bin/python
+
+## Loopback NJE node for testing njelib
+#
+# A stand-in for a JES2 node, built from the same record builders and
+# parsers as the client, so sessions, commands and jobs can be tried and
+# timed on any machine instead of against a real mainframe:
+#
+#	with njeserver.NJEServer('NEWYORK', port=1175) as server:
+#		server.start()
+#		nje = njelib.NJE('WASHDC', 'NEWYORK')
+#		nje.session('127.0.0.1', 1175)
+#		print(nje.sendCommand('$D NJEDEF'))
+#
+# It answers the OPEN control record with ACK (or NAK for a node it doesn't
+# know), SOH ENQ with DLE ACK0 and the I record with a J record, then waits
+# for the L record (or a K record, answered with L, if the J record's event
+# number is 0). Once signed on it answers heartbeats, grants SYSIN
+# streams, replies to commands with scripted $HASP output and "runs" every
+# job it receives: a $HASP165 message says the job ended, then the job's
+# header, a data set header with its JCL and one with sysout_lines synthetic
+# print lines come back on a SYSOUT stream followed by a job trailer.
+#
+# Run it on its own with: python njeserver.py [-p port] [-n node]
+#
+#########
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########
+
+import argparse
+import collections
+import logging
+import socket
+import struct
+import threading
+import time
+
+import ebcdic
+import njelib
+import njerecords
+import njestreams
+
+SYSOUT_LINES = 100 # Synthetic print lines in every job's output
+LINE_LENGTH = 133
+TIMEOUT = 600 # Seconds a signed-on peer may stay silent
+SIGNON_EVENT = 1 # NCCIEVNT of our J record, the peer answers with L (or resets the signon with K if it's 0)
+
+# Scripted replies to operator commands, by longest matching prefix. The
+# lines are formatted with node, peer, command, date and time.
+REPLIES = collections.OrderedDict([
+	('$D NJEDEF', [
+		"$HASP831 NJEDEF  OWNNAME={node},OWNNODE=1,CONNECT=(YES,10),",
+		"$HASP831 NJEDEF  DELAY=120,HDRBUF=(LIMIT=10,WARN=80,FREE=10),",
+		"$HASP831 NJEDEF  JRNUM=1,JTNUM=3,SRNUM=7,STNUM=7,LINENUM=10,",
+		"$HASP831 NJEDEF  MAILMSG=NO,MAXHOP=0,NODENUM=2,PATH=1,",
+		"$HASP831 NJEDEF  RESTMAX=8000,RESTNODE=100,RESTTOL=0,TIMETOL=1440"]),
+	('$D NODE', [
+		"$HASP826 NODE(1)   NODE(1)   NAME={node},STATUS=(OWNNODE)",
+		"$HASP826 NODE(2)   NODE(2)   NAME={peer},STATUS=(CONNECTED/SOCKET)"]),
+	('$D SPL', [
+		"$HASP893 VOLUME(SPOOL1)  STATUS=ACTIVE,PERCENT=3",
+		"$HASP646 3.0000 PERCENT SPOOL UTILIZATION"]),
+	('$D', [
+		"$HASP003 RC=(52),{command} - NO SELECTABLE ENTRIES FOUND MATCHING SPECIFICATION"]),
+	('D T', [
+		"IEE136I LOCAL: TIME={time} DATE={date}  UTC: TIME={time} DATE={date}"]),
+	('', [
+		"$HASP000 OK"]),
+])
+
+log = logging.getLogger('njelib.server')
+
+def dataset_header(codec, node, dsno, step, dd, records, length=LINE_LENGTH):
+	""" Builds a data set header (NDH) with only the general section """
+	e = lambda text, size=8: codec.encode(text.upper().ljust(size)[:size])
+	general = njerecords.NDHG.layout.pack(njerecords.NDHG.layout.size, b"\x00", 0, e(node), e(''), e('JES2'),
+		e(step), e(dd), dsno, e('A', 1), records, 0, 0, length, 1, 0, 60, e('STD'), e(''), e(''), e(''),
+		e(dd), 0, 0, e('LINE'), 0)
+	return struct.pack('>HBB', len(general) + 4, 0, 0) + general
+
+def shutdown(sock):
+	""" Closes sock, waking up a thread blocked in accept() or recv() on it """
+	try:
+		sock.shutdown(socket.SHUT_RDWR)
+	except OSError:
+		pass
+	sock.close()
+
+class NJEServer:
+	""" Listens on host:port (port 0 picks a free one, see address) and
+		serves every connection on its own thread as node. peers limits
+		the nodes that may sign on (any if None) and password is checked
+		against the I record if set. replies replaces REPLIES and
+		signon_event is the event number sent in the J record. """
+	def __init__(self, node='NEWYORK', host='127.0.0.1', port=0, peers=None, password='', replies=None,
+			sysout_lines=SYSOUT_LINES, line_length=LINE_LENGTH, timeout=TIMEOUT, codepage=ebcdic.DEFAULT_CODEPAGE,
+			signon_event=SIGNON_EVENT):
+		if not 1 <= line_length <= 255:
+			raise ValueError("Line length has to be between 1 and 255")
+		self.node = node.upper()
+		self.peers = set(peer.upper() for peer in peers) if peers is not None else None
+		self.password = password
+		self.replies = replies if replies is not None else REPLIES
+		self.sysout_lines = sysout_lines
+		self.line_length = line_length
+		self.timeout = timeout
+		self.codepage = codepage
+		self.signon_event = signon_event
+		self.stats = collections.Counter()
+		self.lock = threading.Lock()
+		self.sessions = set()
+		self.closed = threading.Event()
+		self.thread = None
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind((host, port))
+		self.listener.listen(64)
+
+	@property
+	def address(self):
+		return self.listener.getsockname()
+
+	def count(self, name, amount=1):
+		with self.lock:
+			self.stats[name] += amount
+
+	def start(self):
+		""" Accepts connections on a background thread """
+		self.thread = threading.Thread(target=self.serve_forever, name='njelib-server', daemon=True)
+		self.thread.start()
+		return self
+
+	def serve_forever(self):
+		while not self.closed.is_set():
+			try:
+				sock, peer = self.listener.accept()
+			except OSError:
+				break
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			session = ServerSession(self, sock, peer)
+			with self.lock:
+				self.sessions.add(session)
+			threading.Thread(target=session.run, name='njelib-server-session', daemon=True).start()
+
+	def reply(self, command, peer=''):
+		""" The lines of the scripted reply to command """
+		upper = command.upper()
+		prefix = max((prefix for prefix in self.replies if upper.startswith(prefix)), key=len, default=None)
+		if prefix is None:
+			return []
+		now = time.gmtime()
+		return [line.format(node=self.node, peer=peer, command=command, time=time.strftime('%H.%M.%S', now),
+			date=time.strftime('%Y.%j', now)) for line in self.replies[prefix]]
+
+	def close(self):
+		""" Stops listening and drops every connection """
+		self.closed.set()
+		shutdown(self.listener)
+		with self.lock:
+			sessions = list(self.sessions)
+		for session in sessions:
+			session.close()
+		if self.thread is not None and self.thread is not threading.current_thread():
+			self.thread.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+class ServerSession:
+	""" One connection to the server. Uses an NJE session, with our node as
+		RHOST and the peer as OHOST, to build and send records. """
+	def __init__(self, server, sock, address):
+		self.server = server
+		self.address = address
+		self.nje = njelib.NJE(server.node, '', codepage=server.codepage)
+		self.nje.sock = sock
+		self.nje.connected = True
+		self.nje.FCS = b"\x8F\xCF"
+		self.peer = ''
+		self.streams = njestreams.StreamManager()
+		self.incoming = collections.defaultdict(list) # SYSIN RCB -> (SRCB, data) of the job coming in
+		self.outgoing = collections.deque() # job output waiting for a SYSOUT stream
+		sock.settimeout(server.timeout)
+
+	def run(self):
+		try:
+			if self.handshake():
+				self.server.count('signons')
+				self.serve()
+		except (OSError, ValueError) as e:
+			log.info("%s: %s", self.address, e)
+		finally:
+			self.close()
+			with self.server.lock:
+				self.server.sessions.discard(self)
+
+	def handshake(self):
+		""" OPEN/ACK, SOH ENQ/DLE ACK0 and the I/J/L (or I/J/K/L) signon
+			records. Returns True once the peer is signed on. """
+		nje = self.nje
+		self.server.count('connections')
+		started = time.monotonic()
+		control = nje.getControlRecord()
+		if len(control) < njelib.CONTROL_LEN or control[:8] != nje.padding('OPEN'):
+			return False
+		self.peer = nje.EbcdicToAscii(control[8:16]).decode('latin-1').strip()
+		target = nje.EbcdicToAscii(control[20:28]).decode('latin-1').strip()
+		if target != self.server.node:
+			reason = 1
+		elif self.server.peers is not None and self.peer not in self.server.peers:
+			reason = 1
+		else:
+			reason = 0
+		word = 'ACK' if reason == 0 else 'NAK'
+		nje.sendData(nje.padding(word) + control[20:28] + control[28:32] + control[8:16] + control[16:20] + bytes((reason,)))
+		if reason:
+			log.info("Refused %s for %s", self.peer, target)
+			self.server.count('refused')
+			return False
+		nje.OHOST = nje.padding(self.peer)
+
+		if nje.getData()[12:14] != b"\x01\x2D":
+			return False
+		nje.sendData(nje.makeTTB(nje.makeTTR(b"\x10\x70")))
+
+		found = self.control_record(0xC9) # I
+		if found is None:
+			return False
+		signon = found[1]
+		nje.target_node = signon[9:10]
+		nje.peer_bufsize = nje.hsize(signon[16:18])
+		if self.server.password and signon[18:26] != nje.padding(self.server.password):
+			log.info("Wrong password from %s", self.peer)
+			self.server.count('refused')
+			nje.sendData(nje.signoff_record())
+			return False
+		J = (b"\x29" + nje.RHOST + nje.own_node + struct.pack('>I', self.server.signon_event) + b"\x00\x64" +
+			struct.pack('>H', nje.bufsize) + njelib.SPACE * 16 + b"\x00" + b"\x00" * 10)
+		nje.sendNJE(b"\xF0", b"\xD1", J)
+		found = self.control_record(0xD2, 0xD3) # K or L
+		if found is None:
+			return False
+		if found[0] == 0xD2:
+			# The peer reset the signon, agree to its event number
+			nje.send_concurrence(found[1][1:5])
+		log.info("%s signed on in %.1f ms", self.peer, (time.monotonic() - started) * 1000)
+		return True
+
+	def control_record(self, *wanted):
+		""" Waits for an F0 control record with one of the wanted SRCBs and
+			returns (SRCB, data) """
+		while True:
+			data = self.nje.getData()
+			if not data:
+				return None
+			for RCB, SRCB, payload in njelib.parse_records(data):
+				if RCB == 0xF0 and SRCB in wanted:
+					return SRCB, bytes(payload)
+
+	def serve(self):
+		nje = self.nje
+		while nje.sock:
+			data = nje.getData()
+			if not data:
+				return
+			if not self.process(data):
+				return
+
+	def process(self, data):
+		""" Handles the records in data. Returns False once the peer signed off. """
+		nje = self.nje
+		for RCB, SRCB, payload in njelib.parse_records(data):
+			if RCB is None:
+				continue
+			if RCB == 0x00:
+				if SRCB == 0x00 and payload == b"\x00":
+					self.server.count('heartbeats')
+					nje.sendHeartbeat()
+			elif RCB == 0xF0:
+				if SRCB == 0xC2: # B
+					log.info("%s signed off", self.peer)
+					return False
+			elif RCB == njestreams.REQUEST:
+				if SRCB in njestreams.SYSIN_RCBS and self.streams.incoming(SRCB) is not None:
+					nje.sendNJE(b"\xA0", bytes((SRCB,)), b"\x00\x00")
+				else:
+					nje.sendNJE(b"\xB0", bytes((SRCB,)), b"\x00\x00")
+			elif RCB in (njestreams.PERMIT, njestreams.DENY, njestreams.COMPLETE):
+				self.stream_control(RCB, SRCB)
+			elif RCB == 0x9A:
+				self.nmr(bytes(payload))
+			elif (RCB & 0x0F) == 0x08:
+				if SRCB == 0x00:
+					nje.sendNJE(b"\xC0", bytes((RCB,)), b"\x00\x00")
+					self.streams.finished(RCB)
+					self.job(self.incoming.pop(RCB, []))
+				else:
+					self.incoming[RCB].append((SRCB, bytes(payload)))
+		return True
+
+	def nmr(self, data):
+		""" Replies to a command with its scripted lines """
+		record = self.nje.process_nmr({'Data': data})
+		if not record['NMRFLAGC']:
+			self.server.count('messages')
+			return
+		self.server.count('commands')
+		command = record['NMRMSG'].decode('latin-1')
+		self.send_messages(self.server.reply(command, self.peer))
+
+	def send_messages(self, lines):
+		if lines:
+			self.nje.sendNJE_multiple([{'RCB': b"\x9A", 'SRCB': b"\x00", 'Data': self.nje.nmr_record(line, False)} for line in lines])
+
+	def job(self, records):
+		""" "Runs" a job that came in on a SYSIN stream: queues its output
+			for a SYSOUT stream """
+		headers = []
+		for SRCB, data in records:
+			if SRCB & 0xF0 != 0xC0:
+				break
+			headers.append(data)
+		if not headers:
+			return
+		self.server.count('jobs received')
+		codec = self.nje.codec
+		header = njerecords.JobHeader(headers[0], codec)
+		name = header['NJHGJNAM'].decode('latin-1').strip()
+		number = header['NJHGJID']
+		jcl = [data[1:] for SRCB, data in records if SRCB & 0xF0 == 0x80]
+		lines = self.server.sysout_lines
+		length = self.server.line_length
+		output = [{'RCB': b"\x99", 'SRCB': b"\xC0", 'Data': data} for data in headers]
+		output.append({'RCB': b"\x99", 'SRCB': b"\xE0", 'Data': dataset_header(codec, self.server.node, 1, 'JES2', 'JESJCL', len(jcl), length)})
+		output += [{'RCB': b"\x99", 'SRCB': b"\x80", 'Data': bytes((len(card[:length]),)) + card[:length]} for card in jcl]
+		output.append({'RCB': b"\x99", 'SRCB': b"\xE0", 'Data': dataset_header(codec, self.server.node, 2, 'STEP1', 'SYSPRINT', lines, length)})
+		text = ("%-8s JOB%05d " % (name, number)).ljust(length)
+		for line in codec.encode_records(["{0}{1:08d}".format(text[:length - 8], i)[-length:] for i in range(lines)]):
+			output.append({'RCB': b"\x99", 'SRCB': b"\x80", 'Data': bytes((len(line),)) + line})
+		output.append({'RCB': b"\x99", 'SRCB': b"\xD0", 'Data': self.nje.makeSYSIN_footer()})
+		self.send_messages(["JOB%05d $HASP165 %-8s ENDED AT %s  MAXCC=0000" % (number, name, self.server.node)])
+		self.outgoing.append((name, number, output))
+		self.start_output()
+
+	def start_output(self):
+		""" Asks for a SYSOUT stream for every job output that's waiting,
+			as long as there are free streams """
+		while self.outgoing:
+			stream = self.streams.allocate(njestreams.SYSOUT_RCBS)
+			if stream is None:
+				return
+			stream.job = self.outgoing.popleft()
+			stream.queue(stream.job[2])
+			self.nje.sendNJE(b"\x90", bytes((stream.rcb,)), b"\x00\x00")
+
+	def stream_control(self, RCB, SRCB):
+		stream = self.streams[SRCB] if SRCB in self.streams.streams else None
+		job = stream.job if stream is not None else None
+		if RCB == njestreams.DENY and job is not None and stream.state == njestreams.REQUESTED:
+			# Try again once a stream frees up
+			self.outgoing.appendleft(job)
+		elif RCB == njestreams.COMPLETE and job is not None and stream.state == njestreams.CLOSING:
+			self.server.count('jobs returned')
+			self.server.count('sysout records', len(job[2]))
+		self.streams.control(RCB, SRCB)
+		if RCB == njestreams.PERMIT:
+			records = list(self.streams.interleave(self.streams))
+			if records:
+				self.nje.sendNJE_multiple(records)
+		else:
+			self.start_output()
+
+	def close(self):
+		sock = self.nje.sock
+		self.nje.sock = 0
+		if sock:
+			shutdown(sock)
+
+def main():
+	parser = argparse.ArgumentParser(description='Loopback NJE node for testing')
+	parser.add_argument('-n', '--node', default='NEWYORK', help='our node name (default: NEWYORK)')
+	parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+	parser.add_argument('-p', '--port', type=int, default=njelib.NJE_PORT, help='port to listen on (default: 175)')
+	parser.add_argument('--peer', action='append', help='node allowed to sign on, can be repeated (default: any)')
+	parser.add_argument('--password', default='', help='signon password to require')
+	parser.add_argument('-l', '--lines', type=int, default=SYSOUT_LINES, help='print lines in every job\'s output (default: %d)' % SYSOUT_LINES)
+	parser.add_argument('-e', '--event', type=int, default=SIGNON_EVENT,
+		help='event number of the J record, 0 makes the peer reset the signon (default: %d)' % SIGNON_EVENT)
+	parser.add_argument('-d', '--debug', action='store_true', help='log connections')
+	args = parser.parse_args()
+	if args.debug:
+		logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+	server = NJEServer(args.node, args.host, args.port, args.peer, args.password, sysout_lines=args.lines,
+		signon_event=args.event)
+	print("[+] %s listening on %s:%d" % (server.node, server.address[0], server.address[1]))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.close()
+		for name, value in sorted(server.stats.items()):
+			print("[+] %-16s %d" % (name, value))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+## SYSOUT spool writer used by njelib
+#
+# Writes job output straight to disk, one file per spool data set, instead
+# of keeping it in memory. A data set header (NDH) opens a new file named
+# after the job and the header's NDHGDSNO, NDHGSTEP and NDHGDD fields, data
+# records are written to it through a buffered file and the file is closed
+# when the next data set header or the job trailer shows up. Memory use
+# doesn't grow with the size of the output.
+#
+# By default records are translated and written as text lines. In raw mode
+# the EBCDIC records are written untouched, each one behind a four byte
+# record descriptor word (RDW) like FTP's RDW mode, so they can be handed
+# to anything that reads variable length mainframe records.
+#
+#########
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########
+
+import os
+import re
+import struct
+
+import njerecords
+
+BUFFER_SIZE = 1024 * 1024 # Write buffer for each open data set file
+RDW = struct.Struct('>HH') # Record length (including the RDW) and two zero bytes
+UNSAFE = re.compile(rb'[^A-Za-z0-9$#@_-]+') # Characters kept out of file names
+
+def name_part(value, default):
+	""" Turns a header field into something that's safe in a file name """
+	if isinstance(value, int):
+		return str(value)
+	value = UNSAFE.sub(b'', value.strip())
+	return value.decode('latin-1') if value else default
+
+class SpoolWriter:
+	""" Writes SYSOUT records to one file per spool data set in directory.
+		Pass every record, in order, to write(). """
+	def __init__(self, directory, raw=False, buffering=BUFFER_SIZE):
+		self.directory = directory
+		self.raw = raw
+		self.buffering = buffering
+		self.job = None # JobHeader of the job being written
+		self.file = None
+		self.path = None
+		self.paths = [] # every file written so far
+		self.records = 0
+		os.makedirs(directory, exist_ok=True)
+
+	def write(self, record):
+		if isinstance(record, njerecords.DataRecord):
+			if self.file is None:
+				self.open(None)
+			if self.raw:
+				data = record.raw
+				self.file.write(RDW.pack(len(data) + RDW.size, 0))
+				self.file.write(data)
+			elif 'Record' in record:
+				self.file.write(record['Record'].rstrip(b' '))
+				self.file.write(b'\n')
+			self.records += 1
+		elif isinstance(record, njerecords.DatasetHeader):
+			self.open(record)
+		elif isinstance(record, njerecords.JobHeader):
+			self.close()
+			self.job = record
+		elif isinstance(record, njerecords.JobTrailer):
+			self.close()
+			self.job = None
+
+	def write_all(self, records):
+		""" Writes every record in an iterable (a Job handle, a store's
+			consume()) and returns the list of files written """
+		for record in records:
+			self.write(record)
+		self.close()
+		return self.paths
+
+	def filename(self, header):
+		""" JOBNAME.JOBNUM.DSNO.STEP.DD, e.g. H4CKRNJE.49.2.TSOCMD.SYSTSPRT """
+		if self.job is not None:
+			parts = [name_part(self.job['NJHGJNAM'], 'JOB'), name_part(self.job['NJHGJID'], '0')]
+		else:
+			parts = ['JOB', '0']
+		if header is not None:
+			parts += [name_part(header['NDHGDSNO'], '0'), name_part(header['NDHGSTEP'], 'STEP'),
+				name_part(header['NDHGDD'], 'DD')]
+		else:
+			parts += [str(len(self.paths) + 1), 'STEP', 'DD']
+		name = '.'.join(parts) + ('.rdw' if self.raw else '.txt')
+		path = os.path.join(self.directory, name)
+		count = 1
+		while path in self.paths or os.path.exists(path):
+			count += 1
+			path = os.path.join(self.directory, '{0}.{1}'.format(name, count))
+		return path
+
+	def open(self, header):
+		""" Closes the current data set file and starts a new one """
+		self.close()
+		self.path = self.filename(header)
+		self.file = open(self.path, 'wb', buffering=self.buffering)
+		self.paths.append(self.path)
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+			self.path = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
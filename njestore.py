@@ -0,0 +1,258 @@
+#!/usr/bin/python
+
+## Result stores used by njelib
+#
+# Every NJE session keeps the NMR, SYSIN and SYSOUT records it receives in
+# its own stores instead of module wide lists. What a store does once it
+# gets big depends on its policy:
+#
+#   unbounded : keeps everything (what the library has always done)
+#   ring      : keeps the newest N records and drops the oldest
+#   spill     : keeps up to a byte budget in memory and pickles older
+#               records to a temporary file
+#
+# Stores can be read like a list (len(), iteration, indexing) and have
+# drain() and consume() so a long running listener can hand records off
+# and keep its memory flat.
+#
+#########
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########
+
+import collections
+import itertools
+import pickle
+import sys
+import tempfile
+import threading
+
+POLICIES = ('unbounded', 'ring', 'spill')
+RING_LIMIT = 10000 # Records a ring store keeps if no limit is given
+SPILL_BUDGET = 16 * 1048576 # Bytes a spill store keeps in memory if no limit is given
+SPILL_COMPACT = 1048576 # Bytes already handed out before the spill file is compacted
+
+def record_size(record):
+	""" Roughly how many bytes a record keeps in memory: the record object
+		and its data. The codec is shared by every record of a session. """
+	return sys.getsizeof(record) + sys.getsizeof(getattr(record, 'data', b''))
+
+class RecordStore:
+	""" Unbounded store, keeps every record until it is drained """
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.records = collections.deque()
+		self.dropped = 0 # records thrown away by the policy
+
+	def append(self, record):
+		with self.lock:
+			self.records.append(record)
+
+	def drain(self):
+		""" Returns every record in the store as a list and empties it """
+		with self.lock:
+			records = list(self.records)
+			self.records.clear()
+		return records
+
+	def consume(self):
+		""" Yields records oldest first, removing each one from the store as
+			it's handed out. Records added while consuming are yielded too. """
+		while True:
+			with self.lock:
+				if not self.records:
+					return
+				record = self.records.popleft()
+			yield record
+
+	def clear(self):
+		with self.lock:
+			self.records.clear()
+
+	def __len__(self):
+		return len(self.records)
+
+	def __iter__(self):
+		with self.lock:
+			records = list(self.records)
+		return iter(records)
+
+	def __getitem__(self, index):
+		with self.lock:
+			if not isinstance(index, slice):
+				return self.records[index]
+			start, stop, step = index.indices(len(self.records))
+			if step < 0:
+				return list(self.records)[index]
+			return list(itertools.islice(self.records, start, stop, step))
+
+	def __bool__(self):
+		return len(self) > 0
+
+	def __repr__(self):
+		return '{0}({1} records, {2} dropped)'.format(type(self).__name__, len(self), self.dropped)
+
+class RingStore(RecordStore):
+	""" Keeps the newest maxlen records """
+	def __init__(self, maxlen=RING_LIMIT):
+		if maxlen < 1:
+			raise ValueError("Ring store needs room for at least one record")
+		RecordStore.__init__(self)
+		self.records = collections.deque(maxlen=maxlen)
+
+	def append(self, record):
+		with self.lock:
+			if len(self.records) == self.records.maxlen:
+				self.dropped += 1
+			self.records.append(record)
+
+class SpillStore(RecordStore):
+	""" Keeps up to budget bytes of records in memory. Older records are
+		pickled to a temporary file in directory and read back when the
+		store is iterated, drained or consumed. """
+	def __init__(self, budget=SPILL_BUDGET, directory=None):
+		if budget < 1:
+			raise ValueError("Spill store needs a budget of at least one byte")
+		RecordStore.__init__(self)
+		self.budget = budget
+		self.directory = directory
+		self.size = 0 # bytes of records held in memory
+		self.spill = None
+		self.spilled = 0 # records in the spill file not handed out yet
+		self.read_pos = 0
+
+	def append(self, record):
+		with self.lock:
+			self.records.append(record)
+			self.size += record_size(record)
+			while self.size > self.budget and len(self.records) > 1:
+				self.spill_oldest()
+
+	def spill_oldest(self):
+		if self.spill is None:
+			self.spill = tempfile.TemporaryFile(prefix='njelib-', dir=self.directory)
+		record = self.records.popleft()
+		self.size -= record_size(record)
+		self.spill.seek(0, 2)
+		pickle.dump(record, self.spill, pickle.HIGHEST_PROTOCOL)
+		self.spilled += 1
+
+	def read_spilled(self):
+		""" Yields the spilled records that haven't been handed out, leaving
+			them in the file """
+		pos = self.read_pos
+		for _ in range(self.spilled):
+			self.spill.seek(pos)
+			record = pickle.load(self.spill)
+			pos = self.spill.tell()
+			yield record
+
+	def unspill(self):
+		""" Hands out the oldest spilled record. The file is emptied once
+			everything in it has been handed out, and compacted once more
+			than SPILL_COMPACT bytes and half of it have been. """
+		self.spill.seek(self.read_pos)
+		record = pickle.load(self.spill)
+		self.read_pos = self.spill.tell()
+		self.spilled -= 1
+		if not self.spilled:
+			self.spill.seek(0)
+			self.spill.truncate()
+			self.read_pos = 0
+		elif self.read_pos > SPILL_COMPACT and self.read_pos * 2 > self.spill.seek(0, 2):
+			self.compact()
+		return record
+
+	def compact(self):
+		""" Moves the records not handed out yet to the start of the file """
+		write_pos = 0
+		while True:
+			self.spill.seek(self.read_pos)
+			block = self.spill.read(SPILL_COMPACT)
+			if not block:
+				break
+			self.read_pos += len(block)
+			self.spill.seek(write_pos)
+			self.spill.write(block)
+			write_pos += len(block)
+		self.spill.truncate(write_pos)
+		self.read_pos = 0
+
+	def drain(self):
+		with self.lock:
+			records = [self.unspill() for _ in range(self.spilled)]
+			records += self.records
+			self.records.clear()
+			self.size = 0
+		return records
+
+	def consume(self):
+		while True:
+			with self.lock:
+				if self.spilled:
+					record = self.unspill()
+				elif self.records:
+					record = self.records.popleft()
+					self.size -= record_size(record)
+				else:
+					return
+			yield record
+
+	def clear(self):
+		with self.lock:
+			self.records.clear()
+			self.size = 0
+			self.spilled = 0
+			self.read_pos = 0
+			if self.spill is not None:
+				self.spill.close()
+				self.spill = None
+
+	def close(self):
+		self.clear()
+
+	def __len__(self):
+		return self.spilled + len(self.records)
+
+	def __iter__(self):
+		with self.lock:
+			records = list(self.read_spilled()) if self.spilled else []
+			records += self.records
+		return iter(records)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return list(self)[index]
+		with self.lock:
+			length = self.spilled + len(self.records)
+			if index < 0:
+				index += length
+			if not 0 <= index < length:
+				raise IndexError("store index out of range")
+			if index >= self.spilled:
+				return self.records[index - self.spilled]
+			return next(itertools.islice(self.read_spilled(), index, None))
+
+def make_store(policy='unbounded', limit=None, directory=None):
+	""" Returns a new store for policy. limit is the number of records for
+		'ring' (RING_LIMIT if None) and the byte budget for 'spill'
+		(SPILL_BUDGET if None). """
+	if policy == 'unbounded':
+		return RecordStore()
+	if policy == 'ring':
+		return RingStore(RING_LIMIT if limit is None else limit)
+	if policy == 'spill':
+		return SpillStore(SPILL_BUDGET if limit is None else limit, directory)
+	raise ValueError("Unknown store policy {0}. Use one of: {1}".format(policy, ', '.join(POLICIES)))
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+## Stream manager used by njelib
+#
+# One NJE link carries up to seven SYSIN streams (RCB 98, A8 ... F8) and
+# seven SYSOUT streams (RCB 99, A9 ... F9) at the same time. A sender asks
+# for a stream with a request record (RCB 90, SRCB = the stream's RCB) and
+# waits for permission (A0) or a refusal (B0). The stream's records follow,
+# then an empty record with SRCB 00 ends it and the receiver acknowledges
+# that with C0, after which the stream is free again.
+#
+# The StreamManager keeps the state of every stream on a session, hands out
+# free ones and interleaves the records of several active streams, so they
+# share transmission blocks instead of going out one job at a time.
+#
+#########
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########
+
+import collections
+
+SYSIN_RCBS = tuple(range(0x98, 0x100, 0x10)) # 98, A8 ... F8
+SYSOUT_RCBS = tuple(range(0x99, 0x100, 0x10)) # 99, A9 ... F9
+
+# Stream control records, the SRCB is the RCB of the stream
+REQUEST = 0x90 # Request to initiate stream
+PERMIT = 0xA0 # Permission to initiate stream
+DENY = 0xB0 # Negative permission or receiver cancel
+COMPLETE = 0xC0 # Acknowledge transmission complete
+
+# Stream states
+IDLE = 'idle' # free
+REQUESTED = 'requested' # we sent a 90, waiting for A0 or B0
+ACTIVE = 'active' # we're allowed to send
+CLOSING = 'closing' # we sent the end of file record, waiting for C0
+RECEIVING = 'receiving' # the other side is sending to us
+
+class Stream:
+	""" One SYSIN or SYSOUT stream of a link """
+	def __init__(self, rcb):
+		self.rcb = rcb
+		self.state = IDLE
+		self.outgoing = collections.deque() # records waiting to be sent
+		self.job = None # Job the stream's records belong to
+		self.denied = False # last request got a B0
+
+	@property
+	def sysin(self):
+		return (self.rcb & 0x0F) == 0x08
+
+	def queue(self, records):
+		""" Adds records (dicts with RCB, SRCB and Data) to send on this
+			stream. Their RCB is set to the stream's. """
+		RCB = bytes((self.rcb,))
+		for record in records:
+			record['RCB'] = RCB
+			self.outgoing.append(record)
+
+	def eof(self):
+		""" The empty record that ends the stream """
+		return {'RCB': bytes((self.rcb,)), 'SRCB': b'\x00', 'Data': b''}
+
+	def release(self):
+		self.state = IDLE
+		self.outgoing.clear()
+		self.job = None
+
+	def __repr__(self):
+		return 'Stream({0:02X}, {1})'.format(self.rcb, self.state)
+
+class StreamManager:
+	""" Tracks the state of every stream on one link """
+	def __init__(self):
+		self.streams = collections.OrderedDict((rcb, Stream(rcb)) for rcb in SYSIN_RCBS + SYSOUT_RCBS)
+
+	def __getitem__(self, rcb):
+		return self.streams[rcb]
+
+	def get(self, rcb):
+		""" Returns stream rcb, or None if rcb isn't a stream """
+		return self.streams.get(rcb)
+
+	def __iter__(self):
+		return iter(self.streams.values())
+
+	def job(self, rcb, state):
+		""" Returns the job on stream rcb if the stream is in state """
+		stream = self.streams.get(rcb)
+		if stream is None or stream.state != state:
+			return None
+		return stream.job
+
+	def allocate(self, rcbs=SYSIN_RCBS):
+		""" Returns the first idle stream out of rcbs, marked as requested,
+			or None if they're all busy """
+		for rcb in rcbs:
+			stream = self.streams[rcb]
+			if stream.state == IDLE:
+				stream.state = REQUESTED
+				stream.denied = False
+				return stream
+		return None
+
+	def free(self, rcbs=SYSIN_RCBS):
+		""" Number of idle streams out of rcbs """
+		return sum(1 for rcb in rcbs if self.streams[rcb].state == IDLE)
+
+	def control(self, RCB, SRCB):
+		""" Updates a stream for a control record (A0, B0 or C0) received
+			for it and returns the stream, or None if SRCB isn't a stream """
+		stream = self.streams.get(SRCB)
+		if stream is None:
+			return None
+		if RCB == PERMIT:
+			if stream.state == REQUESTED:
+				stream.state = ACTIVE
+		elif RCB == DENY:
+			stream.denied = stream.state == REQUESTED
+			stream.release()
+		elif RCB == COMPLETE:
+			if stream.state == CLOSING:
+				stream.release()
+		return stream
+
+	def incoming(self, rcb):
+		""" The other side asked to send on stream rcb. Returns the stream,
+			or None if rcb isn't a stream or it's already in use. """
+		stream = self.streams.get(rcb)
+		if stream is None or stream.state not in (IDLE, RECEIVING):
+			return None
+		stream.state = RECEIVING
+		return stream
+
+	def finished(self, rcb):
+		""" The other side ended stream rcb """
+		stream = self.streams.get(rcb)
+		if stream is not None and stream.state == RECEIVING:
+			stream.release()
+		return stream
+
+	def interleave(self, streams):
+		""" Yields the queued records of the active streams in streams, one
+			record from each in turn, and each stream's end of file record
+			once it has nothing left. The streams are then closing. """
+		active = [stream for stream in streams if stream.state == ACTIVE]
+		while active:
+			for stream in list(active):
+				if stream.outgoing:
+					yield stream.outgoing.popleft()
+				else:
+					active.remove(stream)
+					stream.state = CLOSING
+					yield stream.eof()
+
+	def reset(self):
+		for stream in self:
+			stream.release()
+			stream.denied = False